@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional
+
+import db_utils.simple_pg_protocol as pg
+import db_utils.odbc_driver as odbc
+from db_utils import pep_249
+from db_utils.fake_pg_server import FakePostgresServer, ResultShape
+from db_utils.columnar_file import ColumnarFile
+from db_utils.parallel_decode import ParallelDecoder
+from db_utils.result_cache import ResultCache
+
+# Benchmarks for the result reading paths, run against the in process
+# fake server (db_utils.fake_pg_server) so no docker / postgres is needed.
+#
+# python benchmarks/run_benchmarks.py --output results.json
+# python benchmarks/run_benchmarks.py --baseline results.json --threshold 0.1
+#
+# Each benchmark runs the same query --repeat times and reports rows/s,
+# bytes/s and latency, then runs it once more under tracemalloc for the
+# peak memory. With --baseline, exits with 1 if rows/s dropped or peak memory
+# grew by more than the threshold.
+#
+# --transport unix runs them over a Unix domain socket instead of TCP,
+# --transport tcp --transport unix runs both, round_trip shows the latency difference:
+# python benchmarks/run_benchmarks.py --only round_trip --transport tcp --transport unix
+
+
+def _query(shape: ResultShape) -> str:
+    return (
+        f"select rows={shape.rows} columns={shape.columns} width={shape.width} "
+        f"nulls={shape.null_ratio} types={','.join(shape.types)}"
+    )
+
+
+# queries per round_trip run
+ROUND_TRIPS = 200
+ROUND_TRIP_QUERY = "select rows=1 columns=1 types=int4"
+
+
+def _bench_round_trip(handle: pg.ConnectionHandle, query: str) -> int:
+    # latency of small queries, rows/s is round trips/s
+    for _ in range(ROUND_TRIPS):
+        pg.execute(handle, ROUND_TRIP_QUERY)
+        pg.get_data(pg.fetch_events(handle))
+    return ROUND_TRIPS
+
+
+def _bench_process_chunk(handle: pg.ConnectionHandle, query: str) -> int:
+    pg.execute(handle, query)
+    _, rows = pg.process_chunk(handle)
+    return len(rows)
+
+
+def _bench_get_data(handle: pg.ConnectionHandle, query: str) -> int:
+    pg.execute(handle, query)
+    _, rows = pg.get_data(pg.fetch_events(handle))
+    return len(rows)
+
+
+def _bench_get_row(handle: pg.ConnectionHandle, query: str) -> int:
+    pg.execute(handle, query)
+    events = pg.fetch_events(handle)
+    description = []
+    count = 0
+    while True:
+        _, row = pg.get_row(events, description)
+        if row is None:
+            return count
+        count += 1
+
+
+def _bench_odbc_get_data(handle: pg.ConnectionHandle, query: str) -> int:
+    odbc.SQLExecDirect(handle, query, len(query))
+    _, rows = odbc.SQLGetData(odbc.SQLFetch(handle))
+    return len(rows)
+
+
+def _bench_fetchall(cursor: pep_249.Cursor, query: str) -> int:
+    cursor.execute(query)
+    return len(cursor.fetchall())
+
+
+def _bench_fetchall_cached(cursor: pep_249.Cursor, query: str) -> int:
+    # fetchall with the results served from a ResultCache (filled by the warm up)
+    if cursor.result_cache is None:
+        cursor.result_cache = ResultCache(max_bytes=1 << 30, ttl=3600.0, max_entry_rows=1 << 30)
+    return _bench_fetchall(cursor, query)
+
+
+def _bench_fetchall_lazy(cursor: pep_249.Cursor, query: str) -> int:
+    # fetchall with lazy_rows, reading only the first column
+    cursor.lazy_rows = True
+    cursor.execute(query)
+    rows = cursor.fetchall()
+    for row in rows:
+        row[0]
+    return len(rows)
+
+
+def _bench_fetchone(cursor: pep_249.Cursor, query: str) -> int:
+    cursor.execute(query)
+    count = 0
+    while cursor.fetchone() is not None:
+        count += 1
+    return count
+
+
+def _bench_fetch_columns(cursor: pep_249.Cursor, query: str) -> int:
+    cursor.execute(query)
+    columns = cursor.fetch_columns()
+    return len(columns[0].values) if columns else 0
+
+
+# process pool for pep249_fetch_columns_parallel, started on first use
+_decoder: Optional[ParallelDecoder] = None
+
+
+def _bench_fetch_columns_parallel(cursor: pep_249.Cursor, query: str) -> int:
+    global _decoder
+    if _decoder is None:
+        _decoder = ParallelDecoder()
+    cursor.execute(query)
+    columns = cursor.fetch_columns(decoder=_decoder)
+    return len(columns[0].values) if columns else 0
+
+
+# columnar file written by the columnar benchmarks, removed at exit
+_COLUMNAR_PATH = os.path.join(tempfile.gettempdir(), f"db_utils_benchmark_{os.getpid()}.cols")
+
+
+def _bench_export_columnar(cursor: pep_249.Cursor, query: str) -> int:
+    cursor.execute(query)
+    return cursor.export_columnar(_COLUMNAR_PATH)
+
+
+def _bench_columnar_reload(cursor: pep_249.Cursor, query: str) -> int:
+    # opening the file written by the warm up and getting every column,
+    # against the query for the other benchmarks
+    if not os.path.exists(_COLUMNAR_PATH):
+        _bench_export_columnar(cursor, query)
+    with ColumnarFile(_COLUMNAR_PATH) as file:
+        columns = [file.values(index) for index in range(len(file.columns))]
+        rows = len(columns[0]) if columns else 0
+        del columns
+    return rows
+
+
+# name: (benchmark, uses a pep_249 cursor instead of a handle, binary results)
+BENCHMARKS = {
+    'round_trip': (_bench_round_trip, False, False),
+    'process_chunk': (_bench_process_chunk, False, False),
+    'get_data': (_bench_get_data, False, False),
+    'get_row': (_bench_get_row, False, False),
+    'odbc_sqlgetdata': (_bench_odbc_get_data, False, False),
+    'pep249_fetchall': (_bench_fetchall, True, False),
+    'pep249_fetchall_binary': (_bench_fetchall, True, True),
+    'pep249_fetchall_cached': (_bench_fetchall_cached, True, False),
+    'pep249_fetchall_lazy': (_bench_fetchall_lazy, True, False),
+    'pep249_fetchone': (_bench_fetchone, True, False),
+    'pep249_fetch_columns': (_bench_fetch_columns, True, False),
+    'pep249_fetch_columns_parallel': (_bench_fetch_columns_parallel, True, False),
+    'pep249_export_columnar': (_bench_export_columnar, True, False),
+    'columnar_file_reload': (_bench_columnar_reload, True, False),
+}
+
+
+def run_benchmark(
+        server: FakePostgresServer,
+        benchmark: Callable,
+        use_cursor: bool,
+        binary: bool,
+        query: str,
+        repeat: int
+) -> dict:
+    connection = pep_249.connect(server.params)
+    handle = connection.handle
+    target = connection.cursor(binary=binary) if use_cursor else handle
+    try:
+        # warm up, also fills the server's result cache
+        benchmark(target, query)
+
+        timings = []
+        bytes_received = 0
+        rows = 0
+        for _ in range(repeat):
+            bytes_start = handle.read_buffer.bytes_received
+            start = time.perf_counter()
+            rows = benchmark(target, query)
+            timings.append(time.perf_counter() - start)
+            bytes_received = handle.read_buffer.bytes_received - bytes_start
+
+        tracemalloc.start()
+        try:
+            benchmark(target, query)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        connection.close()
+
+    median = statistics.median(timings)
+    return {
+        'rows': rows,
+        'bytes': bytes_received,
+        'rows_per_second': rows / median,
+        'bytes_per_second': bytes_received / median,
+        'latency_median': median,
+        'latency_min': min(timings),
+        'latency_max': max(timings),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    # Returns a description of each regression beyond the threshold
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result['rows_per_second'] < previous['rows_per_second'] * (1 - threshold):
+            regressions.append(
+                f"{name}: {result['rows_per_second']:,.0f} rows/s, baseline {previous['rows_per_second']:,.0f} rows/s"
+            )
+        if result['peak_memory_bytes'] > previous['peak_memory_bytes'] * (1 + threshold):
+            regressions.append(
+                f"{name}: peak memory {result['peak_memory_bytes']:,} bytes, baseline {previous['peak_memory_bytes']:,} bytes"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="db_utils result reading benchmarks")
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--columns', type=int, default=4)
+    parser.add_argument('--width', type=int, default=16, help="characters per text value")
+    parser.add_argument('--nulls', type=float, default=0.0, help="fraction of NULL values")
+    parser.add_argument('--types', default='int4,text', help="comma separated: int4, int8, float8, bool, text")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument(
+        '--transport', action='append', choices=('tcp', 'unix'),
+        help="connect over TCP (the default) or a Unix domain socket, repeat to compare them"
+    )
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed regression, 0.10 is 10%%")
+    args = parser.parse_args(argv)
+
+    shape = ResultShape(args.rows, args.columns, args.width, args.nulls, tuple(args.types.split(',')))
+    query = _query(shape)
+
+    transports = args.transport or ['tcp']
+    results = {}
+    with tempfile.TemporaryDirectory() as socket_dir:
+        for transport in transports:
+            # the Unix domain socket server listens in socket_dir
+            with FakePostgresServer(host=socket_dir if transport == 'unix' else '127.0.0.1') as server:
+                for name in args.only or BENCHMARKS:
+                    benchmark, use_cursor, binary = BENCHMARKS[name]
+                    # results of a single transport keep the plain names, to compare with older baselines
+                    key = name if len(transports) == 1 else f"{name}[{transport}]"
+                    results[key] = run_benchmark(server, benchmark, use_cursor, binary, query, args.repeat)
+                    result = results[key]
+                    print(
+                        f"{key:<30} {result['rows_per_second']:>12,.0f} rows/s "
+                        f"{result['bytes_per_second'] / 1e6:>8.1f} MB/s "
+                        f"{result['latency_median'] * 1000:>9.1f} ms "
+                        f"{result['peak_memory_bytes'] / 1e6:>8.1f} MB peak"
+                    )
+    if _decoder is not None:
+        _decoder.close()
+    if os.path.exists(_COLUMNAR_PATH):
+        os.remove(_COLUMNAR_PATH)
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'shape': {**asdict(shape), 'types': list(shape.types)},
+        'repeat': args.repeat,
+        'transports': transports,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(output, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('shape') != output['shape']:
+            print("Warning: the baseline was run with a different result shape")
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,22 @@ __all__ = [
     # ODBC Driver
     "ConnectionHandle", 
     "SQLConnect", 
+    "SQLSetConnectAttr",
     "SQLExecDirect", 
     "SQLFetch", 
     "SQLGetData", 
+    "SQLBindCol",
+    "SQLSetStmtAttr",
+    "SQLFetchScroll",
+    "SQLAllocHandle",
+    "SQLFreeHandle",
+    "SQLPrepare",
+    "SQLBindParameter",
+    "SQLExecute",
+    "SQLRowCount",
+    "SQLNumResultCols",
+    "SQLDescribeCol",
+    "SQLMoreResults",
     "SQLDisconnect",
 
     # PEP 249 Implmentation
@@ -21,9 +34,22 @@ __all__ = [
 
 from db_utils.odbc_driver import (
     SQLConnect, 
+    SQLSetConnectAttr,
     SQLExecDirect, 
     SQLFetch, 
     SQLGetData, 
+    SQLBindCol,
+    SQLSetStmtAttr,
+    SQLFetchScroll,
+    SQLAllocHandle,
+    SQLFreeHandle,
+    SQLPrepare,
+    SQLBindParameter,
+    SQLExecute,
+    SQLRowCount,
+    SQLNumResultCols,
+    SQLDescribeCol,
+    SQLMoreResults,
     SQLDisconnect
 )
 
@@ -0,0 +1,220 @@
+import db_utils.async_pg_protocol as apg
+import db_utils.pg_types as pg_types
+from db_utils.pep_249 import StatementCache, DatabaseError, _STALE_STATEMENT, _create_query, _describe_column
+from typing import List, Optional, Sequence
+
+# asyncio version of pep_249, with the same methods as coroutines
+#
+# conn = await connect(params)
+# cursor = conn.cursor()
+# await cursor.execute(query)
+# async for row in cursor:
+#     print(row)
+# await conn.close()
+
+
+async def connect(
+        params: dict,
+        statement_cache_size: int = 100,
+        type_catalog: bool = False,
+        type_catalog_path: Optional[str] = None
+):
+    # type_catalog and type_catalog_path are the same as for pep_249.connect,
+    # so both cursors return the same Python types
+    handle = await apg.startup(params)
+    if type_catalog or type_catalog_path is not None:
+        await apg.load_type_catalog(handle, params, type_catalog_path)
+    return AsyncConnection(params, handle, statement_cache_size)
+
+
+class AsyncCursor:
+    def __init__(
+            self,
+            handle: apg.AsyncConnectionHandle,
+            binary: bool = False,
+            statement_cache: Optional[StatementCache] = None
+    ) -> None:
+        # -1 until the current set of results has been read to its end
+        self.rowcount = -1
+        self.handle = handle
+        self.columns = []
+        # default number of rows for fetchmany
+        self.arraysize = 1
+        self.binary = binary
+        self.convert_types = True
+        self.statement_cache = statement_cache
+        self._column_descriptions = []
+        self._parsed_query = None
+        # see pep_249.Cursor._retry_stale_statement
+        self._retry = None
+        # set once all rows of the current results have been read
+        self._done = True
+
+    @property
+    def description(self) -> Optional[List[tuple]]:
+        if not self._column_descriptions:
+            return None
+        return [_describe_column(column) for column in self._column_descriptions]
+
+    async def close(self) -> None:
+        await apg.disconnect(self.handle)
+        return
+
+    async def execute(self, query: str, parameters: Optional[Sequence] = None) -> None:
+        self._column_descriptions = []
+        self.rowcount = -1
+        self._retry = None
+        await apg.drain(self.handle)
+
+        message, self._parsed_query = _create_query(query, parameters, self.binary, self.statement_cache)
+        if self._parsed_query is None and self.statement_cache is not None and query in self.statement_cache:
+            self._retry = (query, parameters)
+        await apg.send(self.handle, [message])
+        self._done = False
+        return
+
+    def _discard_statement(self) -> None:
+        if self._parsed_query is not None and self.statement_cache is not None:
+            self.statement_cache.discard(self._parsed_query)
+            self._parsed_query = None
+
+    async def _retry_stale_statement(self, error: DatabaseError) -> bool:
+        # Same as pep_249.Cursor._retry_stale_statement
+        retry = self._retry
+        self._retry = None
+        if retry is None or error.sqlstate not in _STALE_STATEMENT:
+            return False
+        query, parameters = retry
+        self.statement_cache.discard(query)
+        await self.execute(query, parameters)
+        return True
+
+    async def fetchone(self) -> Optional[tuple]:
+        if self._done:
+            return None
+        try:
+            columns, row = await apg.get_row(self.handle, self._column_descriptions)
+        except DatabaseError as error:
+            self._done = True
+            self._discard_statement()
+            if await self._retry_stale_statement(error):
+                return await self.fetchone()
+            raise
+        self._retry = None
+        if columns != []:
+            self.columns = columns
+        if row is None:
+            self._done = True
+            self.rowcount = self.handle.rowcount
+            return None
+        if self.convert_types:
+            row = pg_types.convert_rows([row], self._column_descriptions, self.handle.type_catalog)[0]
+        return row
+
+    async def fetchmany(self, size: Optional[int] = None) -> List[tuple]:
+        if self._done:
+            return []
+        try:
+            columns, rows, status = await apg.get_many(
+                self.handle, self.arraysize if size is None else size, self._column_descriptions
+            )
+        except DatabaseError as error:
+            self._done = True
+            self._discard_statement()
+            if await self._retry_stale_statement(error):
+                return await self.fetchmany(size)
+            raise
+        self._retry = None
+        if columns != []:
+            self.columns = columns
+        if status == "C":
+            self._done = True
+            self.rowcount = self.handle.rowcount
+        if self.convert_types:
+            rows = pg_types.convert_rows(rows, self._column_descriptions, self.handle.type_catalog)
+        return rows
+
+    async def fetchall(self) -> List[tuple]:
+        if self._done:
+            return []
+        try:
+            columns, rows = await apg.get_data(self.handle, self._column_descriptions)
+        except DatabaseError as error:
+            self._done = True
+            self._discard_statement()
+            if await self._retry_stale_statement(error):
+                return await self.fetchall()
+            raise
+        self._done = True
+        self._retry = None
+        self.rowcount = self.handle.rowcount
+        if columns != []:
+            self.columns = columns
+        if self.convert_types:
+            rows = pg_types.convert_rows(rows, self._column_descriptions, self.handle.type_catalog)
+        return rows
+
+    async def nextset(self) -> Optional[bool]:
+        # Same as pep_249.Cursor.nextset
+        try:
+            if not self._done:
+                await apg.skip_result(self.handle)
+            self._done = True
+            self._column_descriptions = []
+            result = await apg.next_result(self.handle, self._column_descriptions)
+        except DatabaseError as error:
+            self._done = True
+            self._discard_statement()
+            if await self._retry_stale_statement(error):
+                return await self.nextset()
+            raise
+
+        self._retry = None
+        self.columns = []
+        if result is None:
+            return None
+        if type(result) is apg.CommandComplete:
+            self.rowcount = result.rowcount
+        else:
+            self.columns = [column.name for column in result.columns]
+            self.rowcount = -1
+            self._done = False
+        return True
+
+    def __aiter__(self) -> "AsyncCursor":
+        return self
+
+    async def __anext__(self) -> tuple:
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+
+class AsyncConnection:
+    def __init__(self, params: dict, handle: apg.AsyncConnectionHandle, statement_cache_size: int = 100):
+        self.params = params
+        self.handle = handle
+        self.statement_cache = StatementCache(statement_cache_size)
+
+    async def close(self) -> None:
+        await apg.disconnect(self.handle)
+        return
+
+    async def commit(self) -> None:
+        await self._end_transaction("COMMIT")
+        return
+
+    async def rollback(self) -> None:
+        await self._end_transaction("ROLLBACK")
+        return
+
+    async def _end_transaction(self, query: str) -> None:
+        await apg.drain(self.handle)
+        if self.handle.transaction_status != 'I':
+            message, _ = _create_query(query, None, False, None)
+            await apg.send(self.handle, [message])
+            await apg.drain(self.handle)
+
+    def cursor(self, binary: bool = False) -> AsyncCursor:
+        return AsyncCursor(self.handle, binary, self.statement_cache)
@@ -0,0 +1,238 @@
+import asyncio
+import socket
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from db_utils import pg_types
+from db_utils.pg_machine import (
+    Authentication,
+    CommandComplete,
+    DecodedRows,
+    EmptyQueryResponse,
+    ErrorResponse,
+    ProtocolMachine,
+    ReadyForQuery,
+    ResultReader,
+)
+from db_utils.simple_pg_protocol import (
+    SOCKET_PARAMETERS,
+    TYPE_CATALOG_QUERY,
+    DatabaseError,
+    SocketOptions,
+    cached_type_catalog,
+    create_query_message,
+    create_startup_message,
+    create_terminate_message,
+    save_type_catalog,
+    set_socket_options,
+    unix_socket_path,
+)
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+# asyncio version of the simple_pg_protocol socket code.
+# Messages are built with the same functions as the sync path, the
+# bytes read are turned into events by the same pg_machine.ProtocolMachine
+# and the results are read by the same pg_machine.ResultReader and row
+# sinks, only reading and writing goes through asyncio streams.
+
+# bytes asked for per read, the StreamReader returns what it has buffered
+READ_SIZE = 65536
+
+
+@dataclass
+class AsyncConnectionHandle:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    # frames the bytes read into events and keeps the session state
+    protocol: ProtocolMachine = field(default_factory=ProtocolMachine)
+    # see load_type_catalog
+    type_catalog: Optional[pg_types.TypeCatalog] = None
+
+    @property
+    def pending_results(self) -> int:
+        # Number of Ready for Query ('Z') messages the server still owes us
+        return self.protocol.pending_results
+
+    @pending_results.setter
+    def pending_results(self, value: int) -> None:
+        self.protocol.pending_results = value
+
+    @property
+    def transaction_status(self) -> str:
+        # 'I' idle, 'T' in a transaction block, 'E' in a failed transaction block
+        return self.protocol.transaction_status
+
+    @property
+    def rowcount(self) -> int:
+        # from the Command Complete of the last set of results that ended
+        return self.protocol.rowcount
+
+    @property
+    def server_parameters(self) -> Dict[str, str]:
+        return self.protocol.server_parameters
+
+
+async def read_event(handle: AsyncConnectionHandle) -> object:
+    # The next event from the server (see pg_machine).
+    # One read usually holds many messages, so this only waits on the
+    # StreamReader when the machine has run out of complete messages
+    protocol = handle.protocol
+    while True:
+        event = protocol.next_event()
+        if event is not None:
+            return event
+        data = await handle.reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionError("Connection closed by the server")
+        protocol.receive_data(data)
+
+
+async def startup(conn_parameters: dict) -> AsyncConnectionHandle:
+    # This assumes that there is no auth (ex: POSTGRES_HOST_AUTH_METHOD=trust)
+    # host can be the directory of a Unix domain socket, like simple_pg_protocol.startup.
+    # Only connect_timeout and the buffer sizes of the socket options are used,
+    # asyncio already sets TCP_NODELAY
+    options = SocketOptions()
+    set_socket_options(options, conn_parameters)
+    host, port = conn_parameters['host'], conn_parameters.get('port', 5432)
+    if host.startswith('/'):
+        connection = asyncio.open_unix_connection(unix_socket_path(host, port))
+    else:
+        connection = asyncio.open_connection(host, port)
+    reader, writer = await asyncio.wait_for(connection, options.connect_timeout)
+    sock = writer.get_extra_info('socket')
+    if options.receive_buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options.receive_buffer_size)
+    if options.send_buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, options.send_buffer_size)
+    handle = AsyncConnectionHandle(reader, writer)
+
+    startup_parameters = {
+        key: value for key, value in conn_parameters.items()
+        if key not in ('host', 'port') and key not in SOCKET_PARAMETERS
+    }
+    writer.write(create_startup_message(startup_parameters))
+    await writer.drain()
+
+    # 'R' Authentication, 'S' Parameter Status, 'K' Backend Key Data, 'Z' Ready for Query
+    handle.protocol.queries_sent()
+    while True:
+        event = await read_event(handle)
+        kind = type(event)
+        if kind is ErrorResponse:
+            writer.close()
+            raise event.error
+        if kind is Authentication and event.auth_type != 0:
+            writer.close()
+            raise DatabaseError({'M': "Authentication methods other than trust are not supported"})
+        if kind is ReadyForQuery:
+            return handle
+
+
+async def send(handle: AsyncConnectionHandle, queries: List[bytes]) -> None:
+    # Each item is a complete simple query or set of extended protocol
+    # messages ending in a Sync (see simple_pg_protocol.execute_pipeline)
+    # writelines hands the messages to the transport without joining them first
+    handle.writer.writelines(queries)
+    handle.protocol.queries_sent(len(queries))
+    await handle.writer.drain()
+
+
+async def drain(handle: AsyncConnectionHandle) -> None:
+    # Read and throw away any results that haven't been fetched
+    while handle.pending_results > 0:
+        await read_event(handle)
+
+
+async def read_result(handle: AsyncConnectionHandle, reader: ResultReader) -> str:
+    # Same as simple_pg_protocol.read_result, the events come from read_event.
+    # There are no portals here, so no Sync is owed after an error
+    while not reader.feed(await read_event(handle)):
+        pass
+    return reader.status
+
+
+async def get_data(
+        handle: AsyncConnectionHandle,
+        description: Optional[list] = None
+) -> Tuple[list, List[tuple]]:
+    # Same as simple_pg_protocol.get_data
+    rows = DecodedRows(description, handle.type_catalog)
+    reader = ResultReader(rows.add_row, rows.describe, description=description, skip_ready=True)
+    await read_result(handle, reader)
+    return reader.columns, rows.rows
+
+
+async def get_many(
+        handle: AsyncConnectionHandle,
+        size: int,
+        description: Optional[list] = None
+) -> Tuple[list, List[tuple], str]:
+    # Same as simple_pg_protocol.get_many, there are no portals here
+    # so the results are left at 'D' (there may be more rows) or 'C' (all read)
+    rows = DecodedRows(description, handle.type_catalog)
+    reader = ResultReader(rows.add_row, rows.describe, size, description)
+    status = await read_result(handle, reader)
+    return reader.columns, rows.rows, status
+
+
+async def get_row(
+        handle: AsyncConnectionHandle,
+        description: Optional[list] = None
+) -> Tuple[list, Optional[tuple]]:
+    # Same as simple_pg_protocol.get_row
+    # Returns a None row once the results are finished
+    rows = DecodedRows(description, handle.type_catalog)
+    reader = ResultReader(rows.add_row, rows.describe, size=1, description=description, skip_ready=True)
+    await read_result(handle, reader)
+    return reader.columns, rows.rows[0] if rows.rows else None
+
+
+async def skip_result(handle: AsyncConnectionHandle) -> str:
+    # Same as simple_pg_protocol.skip_result
+    return await read_result(handle, ResultReader())
+
+
+async def next_result(handle: AsyncConnectionHandle, description: Optional[list] = None) -> Optional[object]:
+    # Same as simple_pg_protocol.next_result
+    # Returns the RowDescription or CommandComplete of the next set of results,
+    # None once the Ready for Query has been read
+    while handle.pending_results > 0:
+        reader = ResultReader(size=0, description=description)
+        await read_result(handle, reader)
+        kind = type(reader.end)
+        if kind is ReadyForQuery:
+            return None
+        if kind is not EmptyQueryResponse:
+            return reader.end
+    return None
+
+
+async def load_type_catalog(
+        handle: AsyncConnectionHandle,
+        conn_parameters: dict,
+        path: Optional[str] = None
+) -> pg_types.TypeCatalog:
+    # Same as simple_pg_protocol.load_type_catalog, the catalogs
+    # are shared with the sync connections to the same server
+    catalog = cached_type_catalog(handle, conn_parameters, path)
+    if catalog is None:
+        await drain(handle)
+        await send(handle, [create_query_message(TYPE_CATALOG_QUERY)])
+        _, rows = await get_data(handle)
+        catalog = save_type_catalog(handle, conn_parameters, rows, path)
+
+    handle.type_catalog = catalog
+    return catalog
+
+
+async def disconnect(handle: AsyncConnectionHandle) -> None:
+    # same Terminate message as simple_pg_protocol.disconnect
+    handle.writer.write(create_terminate_message())
+    handle.writer.close()
+    try:
+        await handle.writer.wait_closed()
+    except ConnectionError:
+        pass
@@ -0,0 +1,204 @@
+from array import array
+from typing import Callable, List, NamedTuple, Optional, Tuple, Union
+
+from db_utils import pg_types
+import db_utils.simple_pg_protocol as pg
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Column oriented results.
+# Data Row messages are decoded straight into one container per column,
+# instead of building a tuple per row and transposing it afterwards.
+# Fixed size numeric types are stored unboxed in an array.array,
+# everything else goes in a list.
+#
+# cursor.execute("select id, price from items;")
+# ids, prices = cursor.fetch_columns()
+# ids.values # array('i', [1, 2, 3])
+
+
+# array.array type codes for the types that can be stored unboxed
+ARRAY_TYPECODES = {
+    pg_types.BOOL_OID: 'b',
+    pg_types.INT2_OID: 'h',
+    pg_types.INT4_OID: 'i',
+    pg_types.INT8_OID: 'q',
+    pg_types.OID_OID: 'I',
+    pg_types.FLOAT4_OID: 'f',
+    pg_types.FLOAT8_OID: 'd',
+}
+
+# numpy dtypes for the array.array type codes
+_NUMPY_DTYPES = {
+    'b': 'bool',
+    'h': 'int16',
+    'i': 'int32',
+    'q': 'int64',
+    'I': 'uint32',
+    'f': 'float32',
+    'd': 'float64',
+}
+
+
+def _parse_text_bool(data: memoryview) -> bool:
+    return data[0] == 116 # 't'
+
+
+# Text format parsers for the array types, int() and float() accept
+# the raw bytes so there is no need to decode them into a str first
+_TEXT_ARRAY_PARSERS = {
+    pg_types.BOOL_OID: _parse_text_bool,
+    pg_types.INT2_OID: int,
+    pg_types.INT4_OID: int,
+    pg_types.INT8_OID: int,
+    pg_types.OID_OID: int,
+    pg_types.FLOAT4_OID: float,
+    pg_types.FLOAT8_OID: float,
+}
+
+
+class ColumnData(NamedTuple):
+    name: str
+    type_oid: int
+    # array.array for the ARRAY_TYPECODES types, a list otherwise,
+    # or a numpy array when numpy=True
+    values: Union[array, list, "numpy.ndarray"]
+    # None if there are no NULLs, otherwise a mask that is 1 (True) for NULL values.
+    # NULLs are stored as 0 in arrays and None in lists.
+    nulls: Optional[Union[bytearray, "numpy.ndarray"]]
+
+
+class ColumnBuilder:
+    # Collects the values of one result column
+    __slots__ = ('column', 'parse', 'values', 'null_indices', '_null')
+
+    def __init__(
+            self,
+            column: pg.ColumnDescription,
+            convert_types: bool = True,
+            type_catalog: Optional[pg_types.TypeCatalog] = None
+    ) -> None:
+        self.column = column
+        # binary results are always decoded, text results only with convert_types
+        binary = column.format_code == pg_types.BINARY_FORMAT
+        typecode = ARRAY_TYPECODES.get(column.type_oid) if binary or convert_types else None
+        converter = None
+        if convert_types:
+            converter = (
+                pg_types.TEXT_CONVERTERS.get(column.type_oid) if type_catalog is None
+                else type_catalog.text_converter(column.type_oid)
+            )
+
+        if binary:
+            if type_catalog is None:
+                self.parse = pg_types.get_binary_decoder(column.type_oid)
+            else:
+                self.parse = type_catalog.binary_decoder(column.type_oid)
+        elif typecode is not None:
+            self.parse = _TEXT_ARRAY_PARSERS[column.type_oid]
+        elif converter is not None:
+            self.parse = lambda data: converter(str(data, 'utf-8'))
+        else:
+            self.parse = pg_types.decode_text
+
+        self.values = array(typecode) if typecode is not None else []
+        self._null = 0 if typecode is not None else None
+        self.null_indices = []
+
+    def append(self, data: Optional[memoryview]) -> None:
+        # append a raw value from a Data Row, None for NULL
+        if data is None:
+            self.null_indices.append(len(self.values))
+            self.values.append(self._null)
+        else:
+            self.values.append(self.parse(data))
+
+    def append_value(self, value: object) -> None:
+        # append a value that has already been decoded
+        if value is None:
+            self.null_indices.append(len(self.values))
+            self.values.append(self._null)
+        else:
+            self.values.append(value)
+
+    def finish(self, use_numpy: bool = False) -> ColumnData:
+        values = self.values
+        nulls = None
+        if use_numpy:
+            if isinstance(values, array):
+                # shares the array's memory instead of copying it
+                values = numpy.frombuffer(values, dtype=_NUMPY_DTYPES[values.typecode])
+            else:
+                values = numpy.array(values, dtype=object)
+            if self.null_indices:
+                nulls = numpy.zeros(len(values), dtype=bool)
+                nulls[self.null_indices] = True
+        elif self.null_indices:
+            nulls = bytearray(len(values))
+            for index in self.null_indices:
+                nulls[index] = 1
+        return ColumnData(self.column.name, self.column.type_oid, values, nulls)
+
+
+def column_builders(
+        columns: List[pg.ColumnDescription],
+        convert_types: bool = True,
+        type_catalog: Optional[pg_types.TypeCatalog] = None
+) -> List[ColumnBuilder]:
+    return [ColumnBuilder(column, convert_types, type_catalog) for column in columns]
+
+
+def check_numpy() -> None:
+    if numpy is None:
+        raise ImportError("numpy=True requires numpy to be installed")
+
+
+def _parse_data_row_columns(message: memoryview, builders: List[ColumnBuilder]) -> None:
+    # Same as simple_pg_protocol._parse_data_row, but each value is
+    # appended to its column instead of building a row tuple
+    # Int16 - The number of column values that follow
+    # Then for each column:
+    # Int32 - The length of the column value, -1 for NULL
+    # Byten - The value of the column
+    idx = 2
+    for builder in builders:
+        field_length = int.from_bytes(message[idx:idx+4], 'big', signed=True)
+        idx += 4
+        if field_length == -1:
+            builder.append(None)
+            continue
+        builder.append(message[idx:idx+field_length])
+        idx += field_length
+
+
+def get_columns(
+        handle: pg.ConnectionHandle,
+        size: int,
+        description: list,
+        builders: List[ColumnBuilder],
+        convert_types: bool = True,
+        make_builders: Optional[Callable[[List[pg.ColumnDescription]], List[ColumnBuilder]]] = None
+) -> Tuple[list, int, str]:
+    # Column oriented version of simple_pg_protocol.get_many.
+    # Reads up to size rows (all of them if size is negative) into builders,
+    # which are created from the Row Description if it hasn't been read yet
+    # (by make_builders if given, otherwise by column_builders).
+    # Returns the column names (if a Row Description was read), the number of
+    # rows read and where the results were left ('D', 's' or 'C')
+    def describe(columns: List[pg.ColumnDescription]) -> None:
+        if make_builders is not None:
+            builders[:] = make_builders(columns)
+        else:
+            builders[:] = column_builders(columns, convert_types, handle.type_catalog)
+
+    reader = pg.ResultReader(
+        lambda event: _parse_data_row_columns(event.body, builders), describe, size, description
+    )
+    status = pg.read_result(handle, reader)
+    return reader.columns, reader.count, status
@@ -0,0 +1,375 @@
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from array import array
+from typing import IO, Iterator, List, Optional, Sequence, Union
+
+from db_utils import pg_types
+import db_utils.columnar as columnar
+import db_utils.simple_pg_protocol as pg
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+# imported as _numpy, the numpy=True arguments would shadow it
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+# Columnar result files, to keep a large extract on disk and reload it
+# without running the query again.
+#
+# cursor.execute("select * from big_table;")
+# cursor.export_columnar("big_table.cols")
+# ...
+# with ColumnarFile("big_table.cols") as file:
+#     ids = file.values('id', numpy=True) # numpy array over the mapped file
+#     names = file.values('name')         # StringColumn, decoded on access
+#     file.nulls('name')                  # None if there are no NULLs
+#
+# The file is memory mapped and the fixed size columns (see
+# columnar.ARRAY_TYPECODES) are returned as memoryviews or numpy arrays over
+# the mapping, so opening a file costs the same whatever its size and the
+# pages are only read from disk when they are used.
+#
+# Layout, all of the buffers start on a 64 byte boundary:
+#   MAGIC
+#   for each column:
+#     values: the fixed size values, NULLs are 0
+#       or offsets: int64 start of each value in data, plus the end of the last one
+#          and data: the values one after the other, UTF-8 text or raw bytes
+#     nulls: bitmap with bit i (least significant first) set if row i is NULL,
+#       left out if the column has no NULLs
+#   footer: JSON with the row count, the columns and where their buffers are
+#   uint64 little endian length of the footer
+#   MAGIC
+#
+# Columns that aren't fixed size are stored as the text the server sent,
+# binary results as the text of the decoded value (raw bytes for bytea
+# and types without a decoder).
+
+MAGIC = b"DBUCOLS1"
+VERSION = 1
+ALIGNMENT = 64
+# kinds of the columns that aren't in columnar.ARRAY_TYPECODES
+TEXT = 'utf8'
+BYTES = 'bytes'
+
+
+def export_builders(
+        columns: List[pg.ColumnDescription],
+        type_catalog: Optional[pg_types.TypeCatalog] = None
+) -> List[columnar.ColumnBuilder]:
+    # columnar.column_builders for ColumnarWriter: the fixed size types
+    # are parsed into arrays and text values are kept as raw bytes
+    builders = []
+    for column in columns:
+        builder = columnar.ColumnBuilder(column, True, type_catalog)
+        if not isinstance(builder.values, array) and column.format_code == pg_types.TEXT_FORMAT:
+            builder.parse = pg_types.decode_bytes
+        builders.append(builder)
+    return builders
+
+
+def _column_kind(builder: columnar.ColumnBuilder) -> str:
+    if isinstance(builder.values, array):
+        return builder.values.typecode
+    binary = builder.column.format_code == pg_types.BINARY_FORMAT
+    return BYTES if binary and builder.parse is pg_types.decode_bytes else TEXT
+
+
+def _encode(value: object) -> bytes:
+    # values from export_builders are bytes, rows decoded before the export (ex: by fetchone)
+    # and binary results are python objects
+    if isinstance(value, (bytes, bytearray)):
+        return value
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return str(value).encode('utf-8')
+
+
+class _ColumnSpill:
+    # The buffers of one column while it is written, in temporary files
+    # that are copied into the result file at the end
+    def __init__(self, column: pg.ColumnDescription, kind: str, spill_dir: str) -> None:
+        self.column = column
+        self.kind = kind
+        self.fixed = kind not in (TEXT, BYTES)
+        self.values = tempfile.TemporaryFile(dir=spill_dir)
+        self.data = None if self.fixed else tempfile.TemporaryFile(dir=spill_dir)
+        self.nulls = tempfile.TemporaryFile(dir=spill_dir)
+        self.null_count = 0
+        # bytes of the bitmap that aren't complete yet
+        self._pending_nulls = bytearray()
+        self._flushed_rows = 0
+        self._data_length = 0
+        if not self.fixed:
+            # offsets start with the start of the first value
+            self.values.write(array('q', [0]).tobytes())
+
+    def append(self, builder: columnar.ColumnBuilder, row_count: int, first_row: int) -> None:
+        if self.fixed:
+            builder.values.tofile(self.values)
+        else:
+            encoded = [_encode(value) if value is not None else b'' for value in builder.values]
+            offsets = array('q')
+            end = self._data_length
+            for value in encoded:
+                end += len(value)
+                offsets.append(end)
+            self.data.write(b''.join(encoded))
+            self._data_length = end
+            offsets.tofile(self.values)
+        self._append_nulls(builder.null_indices, row_count, first_row)
+
+    def _append_nulls(self, null_indices: List[int], row_count: int, first_row: int) -> None:
+        # first bit of _pending_nulls is row _flushed_rows
+        start = first_row - self._flushed_rows
+        end = start + row_count
+        pending = self._pending_nulls
+        pending.extend(bytes((end + 7) // 8 - len(pending)))
+        for index in null_indices:
+            bit = start + index
+            pending[bit >> 3] |= 1 << (bit & 7)
+        self.null_count += len(null_indices)
+        complete = end // 8
+        if complete:
+            self.nulls.write(pending[:complete])
+            del pending[:complete]
+            self._flushed_rows += complete * 8
+
+    def finish(self) -> None:
+        self.nulls.write(self._pending_nulls)
+        self._pending_nulls = bytearray()
+
+    def close(self) -> None:
+        for file in (self.values, self.data, self.nulls):
+            if file is not None:
+                file.close()
+
+
+def _copy_buffer(source: IO[bytes], file: IO[bytes]) -> List[int]:
+    # Appends source to file at the next aligned position, returns [offset, length]
+    padding = -file.tell() % ALIGNMENT
+    file.write(bytes(padding))
+    offset = file.tell()
+    source.seek(0)
+    shutil.copyfileobj(source, file, 1024 * 1024)
+    return [offset, file.tell() - offset]
+
+
+class ColumnarWriter:
+    # Streams batches of columns to a columnar file.
+    # Only the current batch is held in memory, the columns are spilled to
+    # temporary files next to path and put together by close.
+    def __init__(self, path: str, builders: List[columnar.ColumnBuilder]) -> None:
+        # builders (see export_builders) are only used for the column types here
+        self.path = path
+        self.row_count = 0
+        spill_dir = os.path.dirname(os.path.abspath(path))
+        self._columns = [_ColumnSpill(builder.column, _column_kind(builder), spill_dir) for builder in builders]
+
+    def append(self, builders: List[columnar.ColumnBuilder]) -> None:
+        # append the values collected in builders, which have the columns given to __init__
+        row_count = len(builders[0].values) if builders else 0
+        for spill, builder in zip(self._columns, builders):
+            spill.append(builder, row_count, self.row_count)
+        self.row_count += row_count
+
+    def close(self) -> None:
+        # Write the file, it replaces path in one step so readers never see a partial file
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(MAGIC)
+                columns = []
+                for spill in self._columns:
+                    spill.finish()
+                    metadata = {
+                        'name': spill.column.name,
+                        'type_oid': spill.column.type_oid,
+                        'kind': spill.kind,
+                        'null_count': spill.null_count,
+                    }
+                    if spill.fixed:
+                        metadata['values'] = _copy_buffer(spill.values, file)
+                    else:
+                        metadata['offsets'] = _copy_buffer(spill.values, file)
+                        metadata['data'] = _copy_buffer(spill.data, file)
+                    metadata['nulls'] = _copy_buffer(spill.nulls, file) if spill.null_count else None
+                    columns.append(metadata)
+
+                footer = json.dumps({
+                    'version': VERSION,
+                    'byteorder': sys.byteorder,
+                    'rows': self.row_count,
+                    'columns': columns,
+                }).encode('utf-8')
+                file.write(footer)
+                file.write(len(footer).to_bytes(8, 'little'))
+                file.write(MAGIC)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            self.abort()
+
+    def abort(self) -> None:
+        # remove the temporary files without writing the result file
+        for spill in self._columns:
+            spill.close()
+
+
+class StringColumn(Sequence):
+    # A text or bytes column of a ColumnarFile, values are decoded when they are accessed
+    __slots__ = ('offsets', 'data', 'nulls', 'text')
+
+    def __init__(self, offsets: memoryview, data: memoryview, nulls: Optional[memoryview], text: bool) -> None:
+        self.offsets = offsets # int64, one more than the number of values
+        self.data = data
+        self.nulls = nulls # the NULL bitmap, None if there are no NULLs
+        self.text = text # str values, otherwise bytes
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _value(self, index: int) -> Union[str, bytes, None]:
+        if self.nulls is not None and self.nulls[index >> 3] & (1 << (index & 7)):
+            return None
+        value = self.data[self.offsets[index]:self.offsets[index + 1]]
+        return str(value, 'utf-8') if self.text else value.tobytes()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._value(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("StringColumn index out of range")
+        return self._value(index)
+
+    def __iter__(self) -> Iterator[Union[str, bytes, None]]:
+        for index in range(len(self)):
+            yield self._value(index)
+
+    def to_list(self) -> List[Union[str, bytes, None]]:
+        return list(self)
+
+
+class ColumnarFile:
+    # Read only view of a file written by ColumnarWriter (see Cursor.export_columnar).
+    # The memoryviews and numpy arrays returned point into the mapping,
+    # it is unmapped once they are all released.
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        try:
+            self._metadata = self._read_footer(path)
+        except BaseException:
+            self.close()
+            raise
+        self.row_count: int = self._metadata['rows']
+        self.columns: List[str] = [column['name'] for column in self._metadata['columns']]
+        self.type_oids: List[int] = [column['type_oid'] for column in self._metadata['columns']]
+        # the fixed size values are in the byte order of the machine that wrote the file
+        self._swap_bytes = self._metadata['byteorder'] != sys.byteorder
+
+    def _read_footer(self, path: str) -> dict:
+        buffer = self._buffer
+        if len(buffer) < 2 * len(MAGIC) + 8 or buffer[:len(MAGIC)] != MAGIC or buffer[-len(MAGIC):] != MAGIC:
+            raise ValueError(f"{path} is not a columnar result file")
+        length_end = len(buffer) - len(MAGIC)
+        footer_length = int.from_bytes(buffer[length_end - 8:length_end], 'little')
+        metadata = json.loads(bytes(buffer[length_end - 8 - footer_length:length_end - 8]))
+        if metadata['version'] != VERSION:
+            raise ValueError(f"{path} is a version {metadata['version']} columnar file, expected {VERSION}")
+        return metadata
+
+    def close(self) -> None:
+        self._buffer.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # columns returned by values() still point into the mapping,
+            # it is unmapped once they are garbage collected
+            pass
+
+    def __enter__(self) -> "ColumnarFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    def _column(self, column: Union[int, str]) -> dict:
+        index = self.columns.index(column) if isinstance(column, str) else column
+        return self._metadata['columns'][index]
+
+    def _slice(self, location: List[int]) -> memoryview:
+        offset, length = location
+        return self._buffer[offset:offset + length]
+
+    def values(self, column: Union[int, str], numpy: bool = False) -> Union[memoryview, array, StringColumn, "numpy.ndarray"]:
+        # The values of a column, by name or position.
+        # Fixed size columns are a memoryview cast to their columnar.ARRAY_TYPECODES type code,
+        # or a numpy array with numpy=True, NULLs are 0.
+        # Other columns are a StringColumn, NULLs are None.
+        metadata = self._column(column)
+        kind = metadata['kind']
+        if kind in (TEXT, BYTES):
+            offsets = self._slice(metadata['offsets']).cast('q')
+            nulls = self._slice(metadata['nulls']) if metadata['nulls'] is not None else None
+            return StringColumn(offsets, self._slice(metadata['data']), nulls, kind == TEXT)
+
+        data = self._slice(metadata['values'])
+        if numpy:
+            columnar.check_numpy()
+            dtype = _numpy.dtype(columnar._NUMPY_DTYPES[kind])
+            if self._swap_bytes:
+                dtype = dtype.newbyteorder()
+            return _numpy.frombuffer(data, dtype=dtype)
+        if self._swap_bytes:
+            # can't be a view, the values are copied and swapped
+            values = array(kind, data)
+            values.byteswap()
+            return values
+        return data.cast(kind)
+
+    def nulls(self, column: Union[int, str], numpy: bool = False) -> Optional[Union[memoryview, "numpy.ndarray"]]:
+        # The NULL bitmap of a column (bit i, least significant first, is set if row i is NULL),
+        # with numpy=True a bool array that is True for NULLs.
+        # None if the column has no NULLs
+        metadata = self._column(column)
+        if metadata['nulls'] is None:
+            return None
+        bitmap = self._slice(metadata['nulls'])
+        if numpy:
+            columnar.check_numpy()
+            bits = _numpy.frombuffer(bitmap, dtype='uint8')
+            return _numpy.unpackbits(bits, count=self.row_count, bitorder='little').view(bool)
+        return bitmap
+
+    def column_data(self, column: Union[int, str], numpy: bool = False) -> columnar.ColumnData:
+        # The column as a columnar.ColumnData, like Cursor.fetch_columns returns.
+        # The fixed size values are still views of the file, the rest is copied
+        metadata = self._column(column)
+        values = self.values(column, numpy)
+        if isinstance(values, StringColumn):
+            values = values.to_list()
+            if numpy:
+                values = _numpy.array(values, dtype=object)
+        nulls = self.nulls(column, numpy)
+        if nulls is not None and not numpy:
+            nulls = bytearray(
+                (nulls[index >> 3] >> (index & 7)) & 1 for index in range(self.row_count)
+            )
+        return columnar.ColumnData(metadata['name'], metadata['type_oid'], values, nulls)
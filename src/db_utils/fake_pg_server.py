@@ -0,0 +1,459 @@
+import os
+import random
+import re
+import socket
+import struct
+import threading
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from db_utils import pg_types
+from db_utils.simple_pg_protocol import _create_message, unix_socket_path
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+# In process stand-in for a Postgres server, for benchmarks and tests that
+# shouldn't need docker. It speaks the startup (trust auth only) and the
+# simple and extended query protocols, and answers every query with a
+# synthetic result set. The shape of the results can be set in the query:
+#
+# with FakePostgresServer() as server:
+#     conn = pep_249.connect(server.params)
+#     cursor = conn.cursor()
+#     cursor.execute("select rows=10000 columns=4 width=16 nulls=0.1 types=int4,text")
+#     rows = cursor.fetchall()
+#
+# With host set to a directory, the server listens on a Unix domain socket
+# in it (ex: FakePostgresServer(host=tmp_dir, port=5432)), like Postgres
+# does with unix_socket_directories.
+#
+# Simple queries can have several statements separated by ';', each one
+# returns its own set of results. Statements starting with 'error' return
+# an Error Response (which ends the query), 'insert' returns only a
+# Command Complete with rows= as the row count.
+# Empty queries return an Empty Query Response.
+# Simple queries with notice=<word> send a warning Notice Response before the
+# results, 'set <name> = <value>' returns a Parameter Status, like Postgres
+# does for reported settings (ex: application_name).
+# Queries with sleep=<seconds> wait that long before answering, unless they
+# are canceled with a CancelRequest (then they return a 57014 error).
+
+
+# oid of 'posint', a domain over int4 like one created by CREATE DOMAIN.
+# Without a type catalog it is decoded as text (see pg_types.TypeCatalog)
+POSINT_OID = 16385
+
+# name, type oid, size
+_TYPES = {
+    'int4': (pg_types.INT4_OID, 4),
+    'int8': (pg_types.INT8_OID, 8),
+    'float8': (pg_types.FLOAT8_OID, 8),
+    'bool': (pg_types.BOOL_OID, 1),
+    'text': (pg_types.TEXT_OID, -1),
+    'posint': (POSINT_OID, 4),
+}
+
+
+@dataclass(frozen=True)
+class ResultShape:
+    rows: int = 1000
+    columns: int = 4
+    # characters in each text value
+    width: int = 16
+    # fraction of values that are NULL
+    null_ratio: float = 0.0
+    # column types, repeated if there are more columns than types
+    types: Tuple[str, ...] = ('int4', 'text')
+
+
+_SHAPE_SETTING = re.compile(r"(rows|columns|width|nulls|types)=([\w.,]+)")
+_SLEEP_SETTING = re.compile(r"sleep=([\d.]+)")
+_NOTICE_SETTING = re.compile(r"notice=(\w+)")
+_SET_QUERY = re.compile(r"\s*set\s+(\w+)\s*(?:=|\s+to\s+)\s*'?([^';]*)'?", re.IGNORECASE)
+
+# protocol version of a CancelRequest
+_CANCEL_REQUEST_CODE = 80877102
+
+
+def parse_shape(query: str, default: ResultShape) -> ResultShape:
+    # key=value settings in the query override the default shape
+    settings = {}
+    for key, value in _SHAPE_SETTING.findall(query):
+        if key == 'nulls':
+            settings['null_ratio'] = float(value)
+        elif key == 'types':
+            settings['types'] = tuple(value.split(','))
+        else:
+            settings[key] = int(value)
+    return replace(default, **settings) if settings else default
+
+
+def _text_value(type_name: str, row: int, width: int) -> bytes:
+    if type_name == 'bool':
+        return b't' if row % 2 else b'f'
+    if type_name == 'float8':
+        return repr(row * 0.5).encode('utf-8')
+    if type_name == 'text':
+        return (str(row) * width)[:width].encode('utf-8').ljust(width, b'x')
+    return str(row).encode('utf-8')
+
+
+def _binary_value(type_name: str, row: int, width: int) -> bytes:
+    if type_name in ('int4', 'posint'):
+        return struct.pack('!i', row % 0x7FFFFFFF)
+    if type_name == 'int8':
+        return struct.pack('!q', row)
+    if type_name == 'float8':
+        return struct.pack('!d', row * 0.5)
+    if type_name == 'bool':
+        return b'\x01' if row % 2 else b'\x00'
+    return _text_value(type_name, row, width)
+
+
+def _column_types(shape: ResultShape) -> List[str]:
+    return [shape.types[column % len(shape.types)] for column in range(shape.columns)]
+
+
+def create_row_description(shape: ResultShape, formats: Tuple[int, ...] = ()) -> bytes:
+    # Byte1('T') - Identifies the message as a row description.
+    # Int16 - Specifies the number of fields in a row (can be zero).
+    # Then, for each field:
+    # String - The field name.
+    # Int32 - table OID, Int16 - column attribute number,
+    # Int32 - data type OID, Int16 - data type size,
+    # Int32 - type modifier, Int16 - format code
+    body = [shape.columns.to_bytes(2, 'big')]
+    for column, type_name in enumerate(_column_types(shape)):
+        type_oid, type_size = _TYPES[type_name]
+        format_code = formats[column] if column < len(formats) else (formats[0] if formats else 0)
+        body.append(f"column_{column}".encode('utf-8') + b'\x00')
+        body.append(struct.pack('!ihihih', 0, 0, type_oid, type_size, -1, format_code))
+    return _create_message(b'T', b''.join(body))
+
+
+@lru_cache(maxsize=8)
+def create_data_rows(shape: ResultShape, formats: Tuple[int, ...] = ()) -> List[bytes]:
+    # One encoded Data Row message per row. Cached, so serving a result
+    # doesn't cost more than a send and benchmarks measure the client.
+    # Byte1('D') | Int32 length | Int16 column count
+    # then for each column Int32 value length (-1 for NULL) | Byten value
+    column_types = _column_types(shape)
+    binary = [
+        (formats[column] if column < len(formats) else (formats[0] if formats else 0)) == pg_types.BINARY_FORMAT
+        for column in range(shape.columns)
+    ]
+    nulls = random.Random(0)
+    column_count = shape.columns.to_bytes(2, 'big')
+    rows = []
+    for row in range(shape.rows):
+        body = [column_count]
+        for type_name, is_binary in zip(column_types, binary):
+            if shape.null_ratio and nulls.random() < shape.null_ratio:
+                body.append(b'\xff\xff\xff\xff')
+                continue
+            value = _binary_value(type_name, row, shape.width) if is_binary else _text_value(type_name, row, shape.width)
+            body.append(len(value).to_bytes(4, 'big') + value)
+        rows.append(_create_message(b'D', b''.join(body)))
+    return rows
+
+
+def create_error_response(message: str, sqlstate: str = '42601') -> bytes:
+    # Byte1('E') then fields: Byte1 field type | String value, ending with a zero byte
+    body = b'SERROR\x00' + f"C{sqlstate}\x00M{message}\x00".encode('utf-8') + b'\x00'
+    return _create_message(b'E', body)
+
+
+def create_notice_response(message: str, sqlstate: str = '01000') -> bytes:
+    # Byte1('N'), same fields as an Error Response
+    body = b'SWARNING\x00' + f"C{sqlstate}\x00M{message}\x00".encode('utf-8') + b'\x00'
+    return _create_message(b'N', body)
+
+
+def _read_exactly(file: BinaryIO, num_bytes: int) -> bytes:
+    data = file.read(num_bytes)
+    if len(data) < num_bytes:
+        raise ConnectionError("Connection closed by client")
+    return data
+
+
+def _read_string(body: bytes, idx: int) -> Tuple[str, int]:
+    end = body.index(b'\x00', idx)
+    return body[idx:end].decode('utf-8'), end + 1
+
+
+class _Portal:
+    __slots__ = ('query', 'shape', 'formats', 'sent', 'error')
+
+    def __init__(self, query: str, shape: ResultShape, formats: Tuple[int, ...]) -> None:
+        self.query = query
+        self.shape = shape
+        self.formats = formats
+        self.sent = 0 # rows sent so far, for Execute with a row limit
+        self.error = query.lstrip().lower().startswith('error')
+
+
+class FakePostgresServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, shape: Optional[ResultShape] = None) -> None:
+        self.shape = shape or ResultShape()
+        self._socket_path = None
+        if host.startswith('/'):
+            # there is no port to pick for a Unix domain socket, it is only part of the file name
+            self.host, self.port = host, port or 5432
+            self._socket_path = unix_socket_path(host, self.port)
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self._socket_path)
+        else:
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listener.bind((host, port))
+            self.host, self.port = self._listener.getsockname()[:2]
+        self._thread = None
+        self._closed = False
+        self._connections: List[socket.socket] = []
+        self._lock = threading.Lock()
+        # backend pid: (secret key, set by a CancelRequest)
+        self._backends: Dict[int, Tuple[bytes, threading.Event]] = {}
+        self._next_pid = 1000
+
+    @property
+    def params(self) -> dict:
+        # connection parameters for startup / pep_249.connect
+        return {'host': self.host, 'port': self.port, 'user': 'postgres', 'database': 'postgres'}
+
+    def start(self) -> "FakePostgresServer":
+        self._listener.listen()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._closed = True
+        self._listener.close()
+        if self._socket_path is not None and os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def __enter__(self) -> "FakePostgresServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _serve(self) -> None:
+        while not self._closed:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=self._handle_connection, args=(connection,), daemon=True).start()
+
+    def _handle_connection(self, connection: socket.socket) -> None:
+        if connection.family != socket.AF_UNIX:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        file = connection.makefile('rb')
+        pid = None
+        try:
+            pid = self._startup(connection, file)
+            if pid is not None:
+                self._message_loop(connection, file, self._backends[pid][1])
+        except (ConnectionError, OSError) as e:
+            _logger.debug(f"Fake server connection closed: {e}")
+        finally:
+            if pid is not None:
+                with self._lock:
+                    self._backends.pop(pid, None)
+            file.close()
+            connection.close()
+
+    def _startup(self, connection: socket.socket, file: BinaryIO) -> Optional[int]:
+        # Int32 length | Int32 protocol version | parameters
+        # Returns the backend pid, None for a CancelRequest
+        length = int.from_bytes(_read_exactly(file, 4), 'big')
+        body = _read_exactly(file, length - 4)
+        if int.from_bytes(body[0:4], 'big') == _CANCEL_REQUEST_CODE:
+            # Int32 pid | Byten secret key, there is no reply
+            with self._lock:
+                backend = self._backends.get(int.from_bytes(body[4:8], 'big'))
+            if backend is not None and backend[0] == body[8:]:
+                backend[1].set()
+            return None
+
+        secret_key = random.getrandbits(32).to_bytes(4, 'big')
+        with self._lock:
+            pid = self._next_pid
+            self._next_pid += 1
+            self._backends[pid] = (secret_key, threading.Event())
+        connection.sendall(
+            _create_message(b'R', b'\x00\x00\x00\x00') # Authentication Ok
+            + _create_message(b'S', b'server_version\x0016.0\x00')
+            + _create_message(b'S', b'client_encoding\x00UTF8\x00')
+            + _create_message(b'K', pid.to_bytes(4, 'big') + secret_key)
+            + _create_message(b'Z', b'I')
+        )
+        return pid
+
+    def _sleep(self, query: str, canceled: threading.Event) -> bool:
+        # Wait for sleep=<seconds> in the query, returns False if the query was canceled
+        match = _SLEEP_SETTING.search(query)
+        if match is None:
+            return True
+        if canceled.wait(float(match.group(1))):
+            canceled.clear()
+            return False
+        return True
+
+    def _simple_query(self, query: str, canceled: threading.Event) -> bytes:
+        # one set of results per statement, an error ends the query
+        statements = [statement for statement in query.split(';') if statement.strip()]
+        if not statements:
+            return _create_message(b'I', b'') + _create_message(b'Z', b'I')
+        results = []
+        for statement in statements:
+            result, error = self._statement_results(statement, canceled)
+            results.append(result)
+            if error:
+                break
+        return b''.join(results) + _create_message(b'Z', b'I')
+
+    def _statement_results(self, query: str, canceled: threading.Event) -> Tuple[bytes, bool]:
+        # The messages for one statement of a simple query, and whether it failed
+        if query.lstrip().lower().startswith('error'):
+            return create_error_response(f"syntax error at or near \"{query.split()[0]}\""), True
+        if not self._sleep(query, canceled):
+            return create_error_response("canceling statement due to user request", '57014'), True
+        setting = _SET_QUERY.match(query)
+        if setting is not None:
+            return (
+                _create_message(b'S', f"{setting.group(1)}\x00{setting.group(2)}\x00".encode('utf-8'))
+                + _create_message(b'C', b'SET\x00')
+            ), False
+        notice = _NOTICE_SETTING.search(query)
+        shape = parse_shape(query, self.shape)
+        if query.lstrip().lower().startswith('insert'):
+            # no rows, the tag has the row count
+            return _create_message(b'C', f"INSERT 0 {shape.rows}\x00".encode('utf-8')), False
+        rows = create_data_rows(shape)
+        return (
+            (create_notice_response(notice.group(1)) if notice is not None else b'')
+            + create_row_description(shape)
+            + b''.join(rows)
+            + _create_message(b'C', f"SELECT {len(rows)}\x00".encode('utf-8'))
+        ), False
+
+    def _message_loop(self, connection: socket.socket, file: BinaryIO, canceled: threading.Event) -> None:
+        statements: Dict[str, str] = {}
+        portals: Dict[str, _Portal] = {}
+        # after an error in the extended protocol, messages are skipped until Sync
+        skip = False
+        while True:
+            tag = _read_exactly(file, 1)
+            length = int.from_bytes(_read_exactly(file, 4), 'big')
+            body = _read_exactly(file, length - 4)
+
+            if tag == b'X': # Terminate
+                return
+            if tag == b'S': # Sync
+                skip = False
+                connection.sendall(_create_message(b'Z', b'I'))
+                continue
+            if skip:
+                continue
+
+            # a cancel that arrives between queries doesn't affect the next one
+            canceled.clear()
+            if tag == b'Q':
+                query, _ = _read_string(body, 0)
+                connection.sendall(self._simple_query(query, canceled))
+
+            elif tag == b'P': # Parse
+                name, idx = _read_string(body, 0)
+                query, idx = _read_string(body, idx)
+                statements[name] = query
+                connection.sendall(_create_message(b'1', b''))
+
+            elif tag == b'B': # Bind
+                portal_name, idx = _read_string(body, 0)
+                statement_name, idx = _read_string(body, idx)
+                if statement_name not in statements:
+                    connection.sendall(create_error_response(f"prepared statement \"{statement_name}\" does not exist", '26000'))
+                    skip = True
+                    continue
+                # parameter format codes, then the parameter values
+                num_formats = int.from_bytes(body[idx:idx+2], 'big')
+                idx += 2 + 2 * num_formats
+                num_parameters = int.from_bytes(body[idx:idx+2], 'big')
+                idx += 2
+                for _ in range(num_parameters):
+                    value_length = int.from_bytes(body[idx:idx+4], 'big', signed=True)
+                    idx += 4 + max(value_length, 0)
+                # result format codes
+                num_formats = int.from_bytes(body[idx:idx+2], 'big')
+                formats = struct.unpack(f"!{num_formats}h", body[idx+2:idx+2+2*num_formats])
+                query = statements[statement_name]
+                portals[portal_name] = _Portal(query, parse_shape(query, self.shape), formats)
+                connection.sendall(_create_message(b'2', b''))
+
+            elif tag == b'D': # Describe
+                kind = chr(body[0])
+                name, _ = _read_string(body, 1)
+                if kind == 'S':
+                    query = statements.get(name, '')
+                    connection.sendall(
+                        _create_message(b't', b'\x00\x00')
+                        + create_row_description(parse_shape(query, self.shape))
+                    )
+                    continue
+                portal = portals.get(name)
+                if portal is None or portal.error:
+                    connection.sendall(create_error_response(f"syntax error in portal \"{name}\""))
+                    skip = True
+                    continue
+                connection.sendall(create_row_description(portal.shape, portal.formats))
+
+            elif tag == b'E': # Execute
+                name, idx = _read_string(body, 0)
+                max_rows = int.from_bytes(body[idx:idx+4], 'big')
+                portal = portals.get(name)
+                if portal is None or portal.error:
+                    connection.sendall(create_error_response(f"syntax error in portal \"{name}\""))
+                    skip = True
+                    continue
+                if not self._sleep(portal.query, canceled):
+                    connection.sendall(create_error_response("canceling statement due to user request", '57014'))
+                    skip = True
+                    continue
+                rows = create_data_rows(portal.shape, portal.formats)
+                end = len(rows) if max_rows == 0 else min(portal.sent + max_rows, len(rows))
+                chunk = b''.join(rows[portal.sent:end])
+                portal.sent = end
+                if max_rows and end < len(rows):
+                    connection.sendall(chunk + _create_message(b's', b'')) # Portal Suspended
+                else:
+                    connection.sendall(chunk + _create_message(b'C', f"SELECT {end}\x00".encode('utf-8')))
+
+            elif tag == b'C': # Close
+                kind = chr(body[0])
+                name, _ = _read_string(body, 1)
+                (statements if kind == 'S' else portals).pop(name, None)
+                connection.sendall(_create_message(b'3', b''))
+
+            elif tag == b'H': # Flush, everything is already sent
+                pass
+
+            else:
+                connection.sendall(create_error_response(f"unsupported message type {tag!r}", '0A000'))
+                skip = True
@@ -0,0 +1,211 @@
+from array import array
+from functools import lru_cache
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from db_utils import pg_types
+import db_utils.simple_pg_protocol as pg
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+# Rows that decode their values on first access.
+# simple_pg_protocol._parse_data_row decodes every value of every row, which
+# is most of the work for wide results where only a few columns are used.
+# A LazyRow keeps the raw Data Row and decodes (and converts) a value the
+# first time it is accessed, by position, by column name or as an attribute.
+#
+# cursor = conn.cursor(lazy_rows=True)
+# cursor.execute("select * from wide_table;")
+# for row in cursor:
+#     row[0], row['name'], row.name
+#
+# LazyRows compare equal to the tuple of their values. Column names that start
+# with an underscore or clash with a method (ex: count) can only be accessed by
+# index or row['name'].
+
+
+def _text_decoder(converter: Callable[[str], Any]) -> Callable[[memoryview], Any]:
+    return lambda data: converter(str(data, 'utf-8'))
+
+
+class RowLayout:
+    # What the rows of one result have in common: the column names
+    # and how to decode each column. Shared by all of the rows.
+    __slots__ = ('names', 'index', 'decoders')
+
+    def __init__(self, names: Tuple[str, ...], decoders: Optional[List[Callable[[memoryview], Any]]]) -> None:
+        self.names = names
+        # first column with each name, like a dict built from the row
+        self.index = {}
+        for position, name in enumerate(names):
+            self.index.setdefault(name, position)
+        # None for rows that were created already decoded (see _rebuild)
+        self.decoders = decoders
+
+    @classmethod
+    def from_description(
+            cls,
+            columns: List[pg.ColumnDescription],
+            convert_types: bool = True,
+            type_catalog: Optional[pg_types.TypeCatalog] = None
+    ) -> "RowLayout":
+        decoders = pg_types.row_decoders(columns, type_catalog) or [pg_types.decode_text] * len(columns)
+        if convert_types:
+            converters = pg_types.row_converters(columns, type_catalog)
+            if converters is not None:
+                decoders = [
+                    _text_decoder(converter) if converter is not None else decoder
+                    for decoder, converter in zip(decoders, converters)
+                ]
+        return cls(tuple(column.name for column in columns), decoders)
+
+
+@lru_cache(maxsize=256)
+def _decoded_layout(names: Tuple[str, ...]) -> RowLayout:
+    return RowLayout(names, None)
+
+
+def _rebuild(names: Tuple[str, ...], values: tuple) -> "LazyRow":
+    # unpickles a LazyRow (ex: from the result cache) with all of its values decoded
+    row = LazyRow.__new__(LazyRow)
+    row._layout = _decoded_layout(names)
+    row._data = None
+    row._offsets = None
+    row._values = dict(enumerate(values))
+    return row
+
+
+class LazyRow:
+    # A tuple like row over the raw Data Row message
+    __slots__ = ('_layout', '_data', '_offsets', '_values')
+
+    def __init__(self, layout: RowLayout, data: bytes) -> None:
+        self._layout = layout
+        # the Data Row contents, after the length
+        self._data = data
+        # (start, length) of the values up to the last one accessed, length is -1 for NULL.
+        # Reading the first few columns of a wide row only scans those columns.
+        self._offsets: Optional[array] = None
+        # the values decoded so far, by position
+        self._values: Optional[dict] = None
+
+    def _scan_to(self, index: int) -> array:
+        # Extend the offset table up to the value at index
+        # Int16 - The number of column values that follow
+        # Then for each column:
+        # Int32 - The length of the column value, -1 for NULL
+        # Byten - The value of the column
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._offsets = array('i')
+            idx = 2
+        else:
+            idx = offsets[-2] + max(offsets[-1], 0)
+        data = self._data
+        for _ in range(index + 1 - len(offsets) // 2):
+            field_length = int.from_bytes(data[idx:idx+4], 'big', signed=True)
+            idx += 4
+            offsets.append(idx)
+            offsets.append(field_length)
+            if field_length > 0:
+                idx += field_length
+        return offsets
+
+    def _value(self, index: int) -> Any:
+        values = self._values
+        if values is None:
+            values = self._values = {}
+        elif index in values:
+            return values[index]
+
+        offsets = self._offsets
+        if offsets is None or len(offsets) <= 2 * index:
+            offsets = self._scan_to(index)
+        start = offsets[2 * index]
+        field_length = offsets[2 * index + 1]
+        if field_length == -1:
+            value = None
+        else:
+            value = self._layout.decoders[index](memoryview(self._data)[start:start + field_length])
+        values[index] = value
+        return value
+
+    def __len__(self) -> int:
+        return len(self._layout.names)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._value(self._layout.index[key])
+        if isinstance(key, slice):
+            return tuple(self._value(index) for index in range(*key.indices(len(self))))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("row index out of range")
+        return self._value(key)
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for names that aren't slots or methods
+        if name.startswith('_'):
+            raise AttributeError(name)
+        index = self._layout.index.get(name)
+        if index is None:
+            raise AttributeError(f"row has no column {name!r}")
+        return self._value(index)
+
+    def __iter__(self) -> Iterator[Any]:
+        for index in range(len(self)):
+            yield self._value(index)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (LazyRow, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(tuple(self))
+
+    def __repr__(self) -> str:
+        return f"LazyRow({', '.join(f'{name}={value!r}' for name, value in zip(self._layout.names, self))})"
+
+    def __reduce__(self) -> tuple:
+        return _rebuild, (self._layout.names, tuple(self))
+
+    @property
+    def _fields(self) -> Tuple[str, ...]:
+        return self._layout.names
+
+    def _asdict(self) -> dict:
+        return dict(zip(self._layout.names, self))
+
+    def count(self, value: Any) -> int:
+        return sum(1 for item in self if item == value)
+
+    def index(self, value: Any) -> int:
+        for position, item in enumerate(self):
+            if item == value:
+                return position
+        raise ValueError(f"{value!r} is not in row")
+
+
+def get_rows(
+        handle: pg.ConnectionHandle,
+        size: int,
+        description: list,
+        convert_types: bool = True
+) -> Tuple[list, List[LazyRow], str]:
+    # LazyRow version of simple_pg_protocol.get_many.
+    # Reads up to size rows (all of them if size is negative), the only
+    # work done per row is copying the Data Row out of the read buffer.
+    # Returns the column names (if a Row Description was read), the rows and
+    # where the results were left ('D', 's' or 'C')
+    rows = []
+    layout = RowLayout.from_description(description, convert_types, handle.type_catalog) if description else None
+
+    def describe(columns: List[pg.ColumnDescription]) -> None:
+        nonlocal layout
+        layout = RowLayout.from_description(columns, convert_types, handle.type_catalog)
+
+    reader = pg.ResultReader(lambda event: rows.append(LazyRow(layout, bytes(event.body))), describe, size, description)
+    status = pg.read_result(handle, reader)
+    return reader.columns, rows, status
@@ -1,15 +1,42 @@
-from dataclasses import dataclass
+from array import array
+from dataclasses import dataclass, field
+from itertools import count
+import re
 import socket
-from typing import Generator, Tuple, List, Union
+from typing import Callable, Dict, Generator, Tuple, List, MutableSequence, Optional, Union
 
+from db_utils import pg_types
 from db_utils.simple_pg_protocol import (
+    ColumnDescription,
     ConnectionHandle,
+    DatabaseError,
+    StatementTimeout,
+    set_deadline,
     startup,
     execute,
-    fetch_message,
+    execute_pipeline,
+    drain,
+    create_bind_message,
+    create_close_message,
+    create_execute_message,
+    create_parse_message,
+    create_prepared_messages,
+    create_flush_message,
+    create_sync_message,
+    fetch_events,
+    send,
+    sync,
     get_data,
+    next_result,
+    skip_result,
     disconnect,
+    CommandComplete,
+    DataRow,
+    ResultReader,
+    read_command_complete,
+    read_result,
 )
+from db_utils.query_stats import timed_events
 
 from logging import getLogger
 _logger = getLogger(__name__)
@@ -31,17 +58,247 @@ parameters = {
 @dataclass
 class ReturnCode:
     code_name: str
+    # SQLSTATE, ex: '01004' string data right truncated
     value: str = None
 
     def __post_init__(self):
+        if self.value is not None:
+            return
         if self.code_name == "SQL_SUCCESS":
             self.value = '00000'
+        elif self.code_name == "SQL_SUCCESS_WITH_INFO":
+            self.value = '01000'
+        elif self.code_name == "SQL_NO_DATA":
+            self.value = '02000'
         elif self.code_name == "SQL_ERROR":
             self.value = 'HY000'
 
+
+# Handle types (SQLAllocHandle)
+SQL_HANDLE_ENV = 1
+SQL_HANDLE_DBC = 2
+SQL_HANDLE_STMT = 3
+
+# Connection attributes (SQLSetConnectAttr)
+# https://learn.microsoft.com/en-us/sql/odbc/reference/syntax/sqlsetconnectattr-function
+SQL_ATTR_LOGIN_TIMEOUT = 103
+SQL_ATTR_PACKET_SIZE = 112
+
+# Statement attributes (SQLSetStmtAttr)
+# https://learn.microsoft.com/en-us/sql/odbc/reference/syntax/sqlsetstmtattr-function
+SQL_ATTR_QUERY_TIMEOUT = 0
+SQL_ATTR_ROW_BIND_TYPE = 5
+SQL_ATTR_PARAM_BIND_TYPE = 18
+SQL_ATTR_PARAM_STATUS_PTR = 20
+SQL_ATTR_PARAMS_PROCESSED_PTR = 21
+SQL_ATTR_PARAMSET_SIZE = 22
+SQL_ATTR_ROW_STATUS_PTR = 25
+SQL_ATTR_ROWS_FETCHED_PTR = 26
+SQL_ATTR_ROW_ARRAY_SIZE = 27
+SQL_BIND_BY_COLUMN = 0
+SQL_PARAM_BIND_BY_COLUMN = 0
+
+# C data types for SQLBindCol
+SQL_C_CHAR = 1
+SQL_C_LONG = 4
+SQL_C_SHORT = 5
+SQL_C_FLOAT = 7
+SQL_C_DOUBLE = 8
+SQL_C_BINARY = -2
+SQL_C_BIT = -7
+SQL_C_SSHORT = -15
+SQL_C_SLONG = -16
+SQL_C_SBIGINT = -25
+# python str, stored in a list instead of a buffer of wide characters
+SQL_C_WCHAR = -8
+# any python object, stored in a list (not part of ODBC)
+SQL_C_DEFAULT = 99
+
+# Length / indicator value for NULL
+SQL_NULL_DATA = -1
+# Length / indicator value for a null terminated string
+SQL_NTS = -3
+
+# SQLBindParameter input / output type, only input parameters are supported
+SQL_PARAM_INPUT = 1
+
+# Parameter status array values
+SQL_PARAM_SUCCESS = 0
+SQL_PARAM_ERROR = 5
+SQL_PARAM_UNUSED = 7
+
+# Row status array values
+SQL_ROW_SUCCESS = 0
+SQL_ROW_NOROW = 3
+SQL_ROW_ERROR = 5
+SQL_ROW_SUCCESS_WITH_INFO = 6
+
+# SQLFetchScroll orientations, only SQL_FETCH_NEXT is supported by our forward only cursor
+SQL_FETCH_NEXT = 1
+SQL_FETCH_FIRST = 2
+SQL_FETCH_LAST = 3
+SQL_FETCH_PRIOR = 4
+SQL_FETCH_ABSOLUTE = 5
+SQL_FETCH_RELATIVE = 6
+
+_NUMERIC_C_TYPES = {
+    SQL_C_LONG: int,
+    SQL_C_SLONG: int,
+    SQL_C_SHORT: int,
+    SQL_C_SSHORT: int,
+    SQL_C_SBIGINT: int,
+    SQL_C_FLOAT: float,
+    SQL_C_DOUBLE: float,
+}
+
+
+@dataclass
+class BoundColumn:
+    # A column bound with SQLBindCol, values are written straight into
+    # target, one element per row of the rowset (column-wise binding).
+    # SQL_C_CHAR and SQL_C_BINARY targets are a bytearray of
+    # buffer_length bytes per row.
+    target_type: int
+    target: MutableSequence
+    buffer_length: int = 0
+    # length of each value (before truncation) or SQL_NULL_DATA
+    indicators: Optional[MutableSequence[int]] = None
+    # value parser for the column's type and format, set once the Row Description is read
+    parse: Optional[Callable[[memoryview], object]] = None
+
+
+@dataclass
+class BoundParameter:
+    # A parameter bound with SQLBindParameter, column-wise: value holds
+    # one element per parameter set (SQL_ATTR_PARAMSET_SIZE).
+    # SQL_C_CHAR and SQL_C_BINARY values are a bytes-like buffer of
+    # buffer_length bytes per parameter set.
+    value_type: int
+    value: MutableSequence
+    buffer_length: int = 0
+    # length of each value, SQL_NTS or SQL_NULL_DATA
+    indicators: Optional[MutableSequence[int]] = None
+
+
+@dataclass
+class StatementState:
+    # SQL_ATTR_ROW_ARRAY_SIZE, rows per rowset
+    row_array_size: int = 1
+    # SQL_ATTR_ROW_STATUS_PTR, one SQL_ROW_* value per row of the rowset
+    row_status: Optional[MutableSequence[int]] = None
+    # SQL_ATTR_ROWS_FETCHED_PTR, [0] is set to the rows in the rowset
+    rows_fetched: Optional[MutableSequence[int]] = None
+    bound_columns: Dict[int, BoundColumn] = field(default_factory=dict)
+    column_descriptions: list = field(default_factory=list)
+    # False once all rows of the current results have been read
+    has_results: bool = False
+    # protocol.completed_results when the current set of results started,
+    # the set has been read to its end once the count has moved on (see _results_done)
+    results_start: int = 0
+    # SQL_ATTR_PARAMSET_SIZE, parameter sets per SQLExecute
+    paramset_size: int = 1
+    # SQL_ATTR_PARAM_STATUS_PTR, one SQL_PARAM_* value per parameter set
+    param_status: Optional[MutableSequence[int]] = None
+    # SQL_ATTR_PARAMS_PROCESSED_PTR, [0] is set to the parameter sets processed
+    params_processed: Optional[MutableSequence[int]] = None
+    bound_parameters: Dict[int, BoundParameter] = field(default_factory=dict)
+    # rows affected by the last SQLExecute / SQLExecDirect (SQLRowCount)
+    row_count: int = -1
+    # SQL_ATTR_QUERY_TIMEOUT, seconds until a statement is canceled, 0 waits forever
+    query_timeout: int = 0
+
+
+# names of the server side prepared statements made by SQLPrepare
+_statement_names = count(1)
+
+
+@dataclass
+class StatementHandle:
+    # Statement handle from SQLAllocHandle(SQL_HANDLE_STMT, connection).
+    # Statements on the same connection share its socket, executing one
+    # closes the results of any other statement on the connection.
+    connection: ConnectionHandle
+    state: StatementState = field(default_factory=StatementState)
+    # set by SQLPrepare
+    query: Optional[str] = None
+    statement_name: Optional[str] = None
+    parameter_count: int = 0
+
+
+def _connection(sqlhstmt: Union[StatementHandle, ConnectionHandle]) -> ConnectionHandle:
+    # the connection handle can also be used as a statement handle
+    if isinstance(sqlhstmt, StatementHandle):
+        return sqlhstmt.connection
+    return sqlhstmt
+
+
+def _statement_state(sqlhstmt: Union[StatementHandle, ConnectionHandle]) -> StatementState:
+    if isinstance(sqlhstmt, StatementHandle):
+        return sqlhstmt.state
+    if sqlhstmt.odbc_statement is None:
+        sqlhstmt.odbc_statement = StatementState()
+    return sqlhstmt.odbc_statement
+
+
+def _start_results(sqlhstmt: Union[StatementHandle, ConnectionHandle], query: str) -> StatementState:
+    # Executing closes the cursor from the last statement on the connection
+    connection = _connection(sqlhstmt)
+    drain(connection)
+    if connection.odbc_results is not None:
+        connection.odbc_results.has_results = False
+    state = _statement_state(sqlhstmt)
+    state.column_descriptions = []
+    state.has_results = True
+    state.row_count = -1
+    state.results_start = connection.protocol.completed_results
+    connection.odbc_results = state
+    if connection.stats is not None:
+        connection.query_timer = connection.stats.start(query, connection.read_buffer)
+    set_deadline(connection, state.query_timeout or None)
+    return state
+
+
+def _results_done(state: StatementState, connection: ConnectionHandle) -> bool:
+    # True once the current set of results has been read up to its end,
+    # whether that was by SQLFetch into bound columns or by SQLGetData
+    return (
+        connection.odbc_results is not state
+        or connection.protocol.completed_results > state.results_start
+        or connection.pending_results == 0
+    )
+
+
+_PLACEHOLDER = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|\?")
+
+
+def _convert_placeholders(query: str) -> Tuple[str, int]:
+    # ODBC parameter markers are '?', postgres uses $1, $2, ...
+    # Markers inside string literals, quoted identifiers and comments are left alone
+    parameter_count = 0
+
+    def replace(match: re.Match) -> str:
+        nonlocal parameter_count
+        if match.group(0) != '?':
+            return match.group(0)
+        parameter_count += 1
+        return f"${parameter_count}"
+
+    return _PLACEHOLDER.sub(replace, query), parameter_count
+
+
+def _parse_server_name(server_name: str) -> Tuple[str, int]:
+    # 'localhost', 'localhost:5433', '/var/run/postgresql' (the directory
+    # of a Unix domain socket), '/var/run/postgresql:5433' or '[::1]:5433'
+    host, separator, port = server_name.rpartition(':')
+    if not separator or not port.isdigit() or (':' in host and not host.startswith('[')):
+        # no port, or a bare IPv6 address
+        return server_name, 5432
+    return host.strip('[]'), int(port)
+
+
 def SQLConnect(
         sqlhdbc: ConnectionHandle,
-        server_name: str, # ex: 'localhost'
+        server_name: str, # ex: 'localhost', 'localhost:5433' or '/var/run/postgresql'
         server_name_length: int, # ex: 9
         user_name: str, # ex: 'postgres'
         user_name_length: int, # ex: 8
@@ -50,9 +307,11 @@ def SQLConnect(
 ) -> ReturnCode:
     _logger.debug("Running SQLConnect ODBC Function")
     try:
+        host, port = _parse_server_name(server_name)
+        # the socket options come from sqlhdbc.socket_options (see SQLSetConnectAttr)
         parameters = {
-            'host': server_name,
-            'port': 5432,
+            'host': host,
+            'port': port,
             'user': user_name,
             'database': 'postgres',
         }
@@ -66,14 +325,41 @@ def SQLConnect(
     return return_code
 
 
+def SQLSetConnectAttr(
+        sqlhdbc: ConnectionHandle,
+        attribute: int, # ex: SQL_ATTR_LOGIN_TIMEOUT
+        value: int,
+        string_length: int = 0
+) -> ReturnCode:
+    # Set before SQLConnect.
+    # SQL_ATTR_LOGIN_TIMEOUT - seconds to wait for the connection, 0 waits forever
+    # SQL_ATTR_PACKET_SIZE - the socket's receive and send buffer sizes in bytes
+    # The other socket options can be set on sqlhdbc.socket_options
+    _logger.debug("Running SQLSetConnectAttr ODBC Function")
+    options = sqlhdbc.socket_options
+    if attribute == SQL_ATTR_LOGIN_TIMEOUT:
+        if value < 0:
+            return ReturnCode("SQL_ERROR", 'HY024') # invalid attribute value
+        options.connect_timeout = value or None
+    elif attribute == SQL_ATTR_PACKET_SIZE:
+        if value < 1:
+            return ReturnCode("SQL_ERROR", 'HY024') # invalid attribute value
+        options.receive_buffer_size = value
+        options.send_buffer_size = value
+    else:
+        return ReturnCode("SQL_ERROR", 'HY092') # invalid attribute identifier
+    return ReturnCode("SQL_SUCCESS")
+
+
 def SQLExecDirect(
-        sqlhstmt: ConnectionHandle,
+        sqlhstmt: Union[StatementHandle, ConnectionHandle],
         statement: str,
         statement_length: int
 ) -> ReturnCode:
     _logger.debug("Running SQLExecDirect ODBC Function")
     try:
-        execute(sqlhstmt, statement)
+        _start_results(sqlhstmt, statement)
+        execute(_connection(sqlhstmt), statement)
         return_code = ReturnCode("SQL_SUCCESS")
     except Exception as e:
         _logger.error(e)
@@ -83,11 +369,24 @@ def SQLExecDirect(
 
 
 def SQLFetch(
-    sqlhstmt: ConnectionHandle,
-) -> Union[Generator[bytes, None, None], ReturnCode]:
+    sqlhstmt: Union[StatementHandle, ConnectionHandle],
+) -> Union[Generator[object, None, None], ReturnCode]:
     _logger.debug("Running SQLFetch ODBC Function")
+    if _statement_state(sqlhstmt).bound_columns:
+        # with bound columns, fetch the next rowset into the bound buffers
+        return _fetch_rowset(sqlhstmt)
+
+    # without bound columns this returns a generator of events for SQLGetData
     try:
-        cursor = fetch_message(sqlhstmt)
+        connection = _connection(sqlhstmt)
+        if _results_done(_statement_state(sqlhstmt), connection):
+            # reading on would block on the results of a query that hasn't been sent
+            return ReturnCode("SQL_NO_DATA")
+        cursor = fetch_events(connection)
+        if connection.query_timer is not None:
+            # counts the rows and finishes the timer at the end of the results
+            cursor = timed_events(cursor, connection.query_timer)
+            connection.query_timer = None
         return_code = ReturnCode("SQL_SUCCESS")
     except Exception as e:
         _logger.error(e)
@@ -99,12 +398,16 @@ def SQLFetch(
 
 def SQLGetData(
         # this should technically take in a ConnectionHandle 
-        cursor: Generator[bytes, None, None]
+        cursor: Generator[object, None, None]
 ) -> Union[Tuple[list, List[tuple]], ReturnCode]:
     _logger.debug("Running SQLGetData ODBC Function")
     try:
         columns, rows = get_data(cursor)
         return_code = ReturnCode("SQL_SUCCESS")
+    except DatabaseError as e:
+        # the server's SQLSTATE (or HYT00 for a timeout), like SQLExecute
+        _logger.error(e)
+        return ReturnCode("SQL_ERROR", _sqlstate(e))
     except Exception as e:
         _logger.error(e)
         return_code = ReturnCode("SQL_ERROR")
@@ -113,6 +416,664 @@ def SQLGetData(
     return columns, rows
 
 
+def SQLBindCol(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle],
+        column_number: int, # 1 based
+        target_type: int, # ex: SQL_C_SLONG
+        target_value: Optional[MutableSequence], # ex: array('i', [0] * row_array_size), None unbinds
+        buffer_length: int = 0, # bytes per row for SQL_C_CHAR / SQL_C_BINARY
+        str_len_or_ind: Optional[MutableSequence[int]] = None # ex: array('q', [0] * row_array_size)
+) -> ReturnCode:
+    _logger.debug("Running SQLBindCol ODBC Function")
+    state = _statement_state(sqlhstmt)
+    if column_number < 1:
+        return ReturnCode("SQL_ERROR", '07009') # invalid descriptor index
+    if target_value is None:
+        state.bound_columns.pop(column_number, None)
+        return ReturnCode("SQL_SUCCESS")
+    if target_type in (SQL_C_CHAR, SQL_C_BINARY) and buffer_length <= 0:
+        return ReturnCode("SQL_ERROR", 'HY090') # invalid buffer length
+    if target_type not in _NUMERIC_C_TYPES and target_type not in (SQL_C_CHAR, SQL_C_BINARY, SQL_C_BIT, SQL_C_WCHAR, SQL_C_DEFAULT):
+        return ReturnCode("SQL_ERROR", 'HY003') # invalid application buffer type
+
+    column = BoundColumn(target_type, target_value, buffer_length, str_len_or_ind)
+    if column_number <= len(state.column_descriptions):
+        column.parse = _column_parser(
+            column, state.column_descriptions[column_number - 1], _connection(sqlhstmt).type_catalog
+        )
+    state.bound_columns[column_number] = column
+    return ReturnCode("SQL_SUCCESS")
+
+
+def SQLSetStmtAttr(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle],
+        attribute: int, # ex: SQL_ATTR_ROW_ARRAY_SIZE
+        value: Union[int, MutableSequence[int]],
+        string_length: int = 0
+) -> ReturnCode:
+    _logger.debug("Running SQLSetStmtAttr ODBC Function")
+    state = _statement_state(sqlhstmt)
+    if attribute == SQL_ATTR_QUERY_TIMEOUT:
+        if value < 0:
+            return ReturnCode("SQL_ERROR", 'HY024') # invalid attribute value
+        state.query_timeout = value
+    elif attribute == SQL_ATTR_ROW_ARRAY_SIZE:
+        if value < 1:
+            return ReturnCode("SQL_ERROR", 'HY024') # invalid attribute value
+        state.row_array_size = value
+    elif attribute == SQL_ATTR_ROW_STATUS_PTR:
+        state.row_status = value
+    elif attribute == SQL_ATTR_ROWS_FETCHED_PTR:
+        state.rows_fetched = value
+    elif attribute == SQL_ATTR_ROW_BIND_TYPE:
+        if value != SQL_BIND_BY_COLUMN:
+            # row-wise binding needs C structs, only column-wise binding is supported
+            return ReturnCode("SQL_ERROR", 'HYC00') # optional feature not implemented
+    elif attribute == SQL_ATTR_PARAMSET_SIZE:
+        if value < 1:
+            return ReturnCode("SQL_ERROR", 'HY024') # invalid attribute value
+        state.paramset_size = value
+    elif attribute == SQL_ATTR_PARAM_STATUS_PTR:
+        state.param_status = value
+    elif attribute == SQL_ATTR_PARAMS_PROCESSED_PTR:
+        state.params_processed = value
+    elif attribute == SQL_ATTR_PARAM_BIND_TYPE:
+        if value != SQL_PARAM_BIND_BY_COLUMN:
+            return ReturnCode("SQL_ERROR", 'HYC00') # optional feature not implemented
+    else:
+        return ReturnCode("SQL_ERROR", 'HY092') # invalid attribute identifier
+    return ReturnCode("SQL_SUCCESS")
+
+
+def SQLFetchScroll(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle],
+        fetch_orientation: int,
+        fetch_offset: int = 0
+) -> ReturnCode:
+    _logger.debug("Running SQLFetchScroll ODBC Function")
+    # Results are streamed from the server, so the cursor is forward only
+    if fetch_orientation != SQL_FETCH_NEXT:
+        return ReturnCode("SQL_ERROR", 'HY106') # fetch type out of range
+    return _fetch_rowset(sqlhstmt)
+
+
+def _column_parser(
+        column: BoundColumn,
+        description,
+        type_catalog: Optional[pg_types.TypeCatalog] = None
+) -> Callable[[memoryview], object]:
+    # how to turn a raw value into what is stored in the bound buffer
+    binary = description.format_code == pg_types.BINARY_FORMAT
+    if binary:
+        if type_catalog is None:
+            decoder = pg_types.get_binary_decoder(description.type_oid)
+        else:
+            decoder = type_catalog.binary_decoder(description.type_oid)
+    if column.target_type in (SQL_C_CHAR, SQL_C_BINARY):
+        if binary:
+            return lambda data: str(decoder(data)).encode('utf-8')
+        return bytes
+    if column.target_type == SQL_C_WCHAR:
+        if binary:
+            return lambda data: str(decoder(data))
+        return pg_types.decode_text
+    if binary:
+        return decoder
+    if column.target_type == SQL_C_BIT:
+        return lambda data: data[0] in (116, 49) # 't' or '1'
+    if column.target_type in _NUMERIC_C_TYPES:
+        # int() and float() parse the raw text without decoding it first
+        return _NUMERIC_C_TYPES[column.target_type]
+    if type_catalog is None:
+        converter = pg_types.TEXT_CONVERTERS.get(description.type_oid)
+    else:
+        converter = type_catalog.text_converter(description.type_oid)
+    if converter is None:
+        return pg_types.decode_text
+    return lambda data: converter(str(data, 'utf-8'))
+
+
+def _store_value(column: BoundColumn, row: int, data: Optional[memoryview]) -> int:
+    # Write one value into the bound buffers, returns the row status:
+    # SQL_ROW_SUCCESS_WITH_INFO if a value was truncated,
+    # SQL_ROW_ERROR for a NULL without an indicator array to report it
+    if data is None:
+        if column.indicators is None:
+            return SQL_ROW_ERROR
+        column.indicators[row] = SQL_NULL_DATA
+        return SQL_ROW_SUCCESS
+
+    value = column.parse(data)
+    if column.target_type in (SQL_C_CHAR, SQL_C_BINARY):
+        # character data is null terminated, binary data isn't
+        size = column.buffer_length - 1 if column.target_type == SQL_C_CHAR else column.buffer_length
+        stored = min(len(value), size)
+        start = row * column.buffer_length
+        column.target[start:start + stored] = value[:stored]
+        if column.target_type == SQL_C_CHAR:
+            column.target[start + stored] = 0
+        if column.indicators is not None:
+            column.indicators[row] = len(value)
+        return SQL_ROW_SUCCESS if stored == len(value) else SQL_ROW_SUCCESS_WITH_INFO
+
+    column.target[row] = value
+    if column.indicators is not None:
+        if column.target_type == SQL_C_WCHAR:
+            column.indicators[row] = len(value)
+        else:
+            column.indicators[row] = column.target.itemsize if isinstance(column.target, array) else 0
+    return SQL_ROW_SUCCESS
+
+
+def _set_columns(
+        state: StatementState,
+        column_descriptions: list,
+        type_catalog: Optional[pg_types.TypeCatalog] = None
+) -> Optional[ReturnCode]:
+    # Row Description read, pick the value parser for each bound column
+    state.column_descriptions = column_descriptions
+    for column_number, column in state.bound_columns.items():
+        if column_number > len(column_descriptions):
+            return ReturnCode("SQL_ERROR", '07009') # invalid descriptor index
+        column.parse = _column_parser(column, column_descriptions[column_number - 1], type_catalog)
+    return None
+
+
+def SQLNumResultCols(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle]
+) -> Union[int, ReturnCode]:
+    # Number of columns in the results, 0 for a statement without results.
+    # Reads up to the Row Description if it hasn't been read yet, so columns
+    # can be bound before the first SQLFetch
+    _logger.debug("Running SQLNumResultCols ODBC Function")
+    state = _statement_state(sqlhstmt)
+    connection = _connection(sqlhstmt)
+    if connection.odbc_results is not state:
+        state.has_results = False
+    try:
+        if state.has_results and not state.column_descriptions:
+            error = _read_description(state, connection)
+            if error is not None:
+                return error
+    except DatabaseError as e:
+        _logger.error(e)
+        state.has_results = False
+        _finish_timer(connection, 0, error=True)
+        return ReturnCode("SQL_ERROR", _sqlstate(e))
+    except Exception as e:
+        _logger.error(e)
+        state.has_results = False
+        _finish_timer(connection, 0, error=True)
+        return ReturnCode("SQL_ERROR")
+    if not state.has_results:
+        _finish_timer(connection, 0)
+    return len(state.column_descriptions)
+
+
+def _read_description(state: StatementState, connection: ConnectionHandle) -> Optional[ReturnCode]:
+    # Read up to the Row Description of the current results, or to their end
+    # for a statement without rows. Returns the error from _set_columns, if any
+    reader = ResultReader(size=0)
+    read_result(connection, reader)
+    if reader.status == "D":
+        error = _set_columns(state, reader.end.columns, connection.type_catalog)
+        if error is not None:
+            state.has_results = False
+        return error
+    state.has_results = False
+    if type(reader.end) is CommandComplete:
+        state.row_count = reader.end.rowcount
+    return None
+
+
+def SQLDescribeCol(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle],
+        column_number: int # 1 based
+) -> Union[ColumnDescription, ReturnCode]:
+    # Returns the Row Description field (name, type_oid, ...) instead of
+    # writing the name, SQL type, size and nullability to output pointers
+    _logger.debug("Running SQLDescribeCol ODBC Function")
+    column_count = SQLNumResultCols(sqlhstmt)
+    if isinstance(column_count, ReturnCode):
+        return column_count
+    if not 1 <= column_number <= column_count:
+        return ReturnCode("SQL_ERROR", '07009') # invalid descriptor index
+    return _statement_state(sqlhstmt).column_descriptions[column_number - 1]
+
+
+def _fetch_rowset(sqlhstmt: Union[StatementHandle, ConnectionHandle]) -> ReturnCode:
+    # Read up to row_array_size rows into the bound columns.
+    # Only one rowset of Data Rows is read from the socket at a time,
+    # so memory use doesn't depend on the size of the results.
+    state = _statement_state(sqlhstmt)
+    connection = _connection(sqlhstmt)
+    if connection.odbc_results is not state:
+        # another statement was executed on the connection since
+        state.has_results = False
+    bound_columns = state.bound_columns
+    row_status = state.row_status
+    rows = 0
+    # SQL_ROW_ERROR if any row had an error, otherwise SQL_ROW_SUCCESS_WITH_INFO if any row was truncated
+    rowset_status = SQL_ROW_SUCCESS
+
+    def store_row(event: DataRow) -> None:
+        nonlocal rows, rowset_status
+        message_body = event.body
+        # Int16 column count, then Int32 length (-1 for NULL) | Byten value per column
+        idx = 2
+        status = SQL_ROW_SUCCESS
+        for column_number in range(1, int.from_bytes(message_body[0:2], 'big') + 1):
+            field_length = int.from_bytes(message_body[idx:idx+4], 'big', signed=True)
+            idx += 4
+            column = bound_columns.get(column_number)
+            if column is not None:
+                data = None if field_length == -1 else message_body[idx:idx+field_length]
+                stored = _store_value(column, rows, data)
+                if stored != SQL_ROW_SUCCESS and status != SQL_ROW_ERROR:
+                    status = stored
+            idx += max(field_length, 0)
+
+        if row_status is not None:
+            row_status[rows] = status
+        if status != SQL_ROW_SUCCESS and rowset_status != SQL_ROW_ERROR:
+            rowset_status = status
+        rows += 1
+
+    try:
+        if state.has_results and not state.column_descriptions:
+            error = _read_description(state, connection)
+            if error is not None:
+                return error
+        if state.has_results:
+            reader = ResultReader(store_row, size=state.row_array_size)
+            if read_result(connection, reader) == "C":
+                state.has_results = False
+                if type(reader.end) is CommandComplete:
+                    state.row_count = reader.end.rowcount
+
+    except DatabaseError as e:
+        _logger.error(e)
+        state.has_results = False
+        _finish_timer(connection, rows, error=True)
+        return ReturnCode("SQL_ERROR", _sqlstate(e))
+    except Exception as e:
+        _logger.error(e)
+        state.has_results = False
+        _finish_timer(connection, rows, error=True)
+        return ReturnCode("SQL_ERROR")
+    finally:
+        if state.rows_fetched is not None:
+            state.rows_fetched[0] = rows
+        if row_status is not None:
+            for row in range(rows, min(state.row_array_size, len(row_status))):
+                row_status[row] = SQL_ROW_NOROW
+
+    if connection.query_timer is not None:
+        connection.query_timer.add_rows(rows, 0.0)
+        if not state.has_results:
+            _finish_timer(connection, 0)
+
+    if rows == 0:
+        return ReturnCode("SQL_NO_DATA")
+    if rowset_status == SQL_ROW_ERROR:
+        return ReturnCode("SQL_SUCCESS_WITH_INFO", '01S01') # error in row
+    if rowset_status == SQL_ROW_SUCCESS_WITH_INFO:
+        return ReturnCode("SQL_SUCCESS_WITH_INFO", '01004') # string data, right truncated
+    return ReturnCode("SQL_SUCCESS")
+
+
+def _sqlstate(error: DatabaseError) -> str:
+    if isinstance(error, StatementTimeout):
+        return 'HYT00' # timeout expired (SQL_ATTR_QUERY_TIMEOUT)
+    return error.sqlstate or 'HY000'
+
+
+def _finish_timer(connection: ConnectionHandle, rows: int, error: bool = False) -> None:
+    timer = connection.query_timer
+    if timer is not None:
+        connection.query_timer = None
+        timer.add_rows(rows, 0.0)
+        timer.finish(error)
+
+
+def SQLAllocHandle(
+        handle_type: int, # SQL_HANDLE_DBC or SQL_HANDLE_STMT
+        input_handle: Optional[ConnectionHandle] = None # the connection for SQL_HANDLE_STMT
+) -> Union[ConnectionHandle, StatementHandle, ReturnCode]:
+    # Returns the new handle instead of writing it to an output pointer
+    _logger.debug("Running SQLAllocHandle ODBC Function")
+    if handle_type == SQL_HANDLE_DBC:
+        return ConnectionHandle()
+    if handle_type == SQL_HANDLE_STMT:
+        if not isinstance(input_handle, ConnectionHandle):
+            return ReturnCode("SQL_ERROR", 'HY009') # invalid use of null pointer
+        return StatementHandle(input_handle)
+    # there are no environment attributes to keep, so there is no environment handle
+    return ReturnCode("SQL_ERROR", 'HY092') # invalid attribute identifier
+
+
+def SQLFreeHandle(
+        handle_type: int,
+        handle: Union[ConnectionHandle, StatementHandle]
+) -> ReturnCode:
+    _logger.debug("Running SQLFreeHandle ODBC Function")
+    try:
+        if handle_type == SQL_HANDLE_STMT and isinstance(handle, StatementHandle):
+            connection = handle.connection
+            if connection.odbc_results is handle.state:
+                drain(connection)
+                connection.odbc_results = None
+            if handle.statement_name is not None:
+                _close_statement(handle)
+        return ReturnCode("SQL_SUCCESS")
+    except Exception as e:
+        _logger.error(e)
+        return ReturnCode("SQL_ERROR")
+
+
+def _close_statement(sqlhstmt: StatementHandle) -> None:
+    # close the server side prepared statement
+    connection = sqlhstmt.connection
+    drain(connection)
+    execute_pipeline(connection, [create_close_message('S', sqlhstmt.statement_name) + create_sync_message()])
+    drain(connection)
+    sqlhstmt.statement_name = None
+
+
+def SQLPrepare(
+        sqlhstmt: StatementHandle,
+        statement_text: str, # parameter markers are '?'
+        text_length: int
+) -> ReturnCode:
+    _logger.debug("Running SQLPrepare ODBC Function")
+    if not isinstance(sqlhstmt, StatementHandle):
+        return ReturnCode("SQL_ERROR", 'HY010') # function sequence error, needs SQLAllocHandle
+    try:
+        if sqlhstmt.statement_name is not None:
+            _close_statement(sqlhstmt)
+        query, sqlhstmt.parameter_count = _convert_placeholders(statement_text)
+
+        # Parse now so errors in the statement are returned here
+        # Parse Complete ('1') then Ready for Query
+        connection = sqlhstmt.connection
+        drain(connection)
+        statement_name = f"odbc_{next(_statement_names)}"
+        execute_pipeline(connection, [create_parse_message(query, statement_name) + create_sync_message()])
+        read_result(connection, ResultReader())
+
+        sqlhstmt.query = query
+        sqlhstmt.statement_name = statement_name
+        return ReturnCode("SQL_SUCCESS")
+    except DatabaseError as e:
+        _logger.error(e)
+        return ReturnCode("SQL_ERROR", e.sqlstate or 'HY000')
+    except Exception as e:
+        _logger.error(e)
+        return ReturnCode("SQL_ERROR")
+
+
+def SQLBindParameter(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle],
+        parameter_number: int, # 1 based
+        input_output_type: int, # SQL_PARAM_INPUT
+        value_type: int, # C type, ex: SQL_C_SLONG
+        parameter_type: int, # SQL type, the server infers it from the statement so it isn't used
+        column_size: int,
+        decimal_digits: int,
+        parameter_value: Optional[MutableSequence], # one value per parameter set, None unbinds
+        buffer_length: int = 0, # bytes per parameter set for SQL_C_CHAR / SQL_C_BINARY
+        str_len_or_ind: Optional[MutableSequence[int]] = None
+) -> ReturnCode:
+    _logger.debug("Running SQLBindParameter ODBC Function")
+    state = _statement_state(sqlhstmt)
+    if parameter_number < 1:
+        return ReturnCode("SQL_ERROR", '07009') # invalid descriptor index
+    if parameter_value is None:
+        state.bound_parameters.pop(parameter_number, None)
+        return ReturnCode("SQL_SUCCESS")
+    if input_output_type != SQL_PARAM_INPUT:
+        return ReturnCode("SQL_ERROR", 'HYC00') # optional feature not implemented
+    if value_type in (SQL_C_CHAR, SQL_C_BINARY) and buffer_length <= 0:
+        return ReturnCode("SQL_ERROR", 'HY090') # invalid buffer length
+    if value_type not in _NUMERIC_C_TYPES and value_type not in (SQL_C_CHAR, SQL_C_BINARY, SQL_C_BIT, SQL_C_WCHAR, SQL_C_DEFAULT):
+        return ReturnCode("SQL_ERROR", 'HY003') # invalid application buffer type
+    state.bound_parameters[parameter_number] = BoundParameter(value_type, parameter_value, buffer_length, str_len_or_ind)
+    return ReturnCode("SQL_SUCCESS")
+
+
+def _parameter_value(parameter: BoundParameter, row: int) -> object:
+    # The value of a bound parameter for one parameter set, as a python
+    # object for pg_types.encode_parameter
+    indicator = parameter.indicators[row] if parameter.indicators is not None else SQL_NTS
+    if indicator == SQL_NULL_DATA:
+        return None
+    if parameter.value_type in (SQL_C_CHAR, SQL_C_BINARY):
+        start = row * parameter.buffer_length
+        end = start + parameter.buffer_length
+        if indicator >= 0:
+            end = start + indicator
+        elif parameter.value_type == SQL_C_CHAR:
+            # SQL_NTS, the value ends at the null terminator
+            terminator = bytes(parameter.value[start:end]).find(b'\x00')
+            if terminator != -1:
+                end = start + terminator
+        data = bytes(parameter.value[start:end])
+        # char values are sent as text, binary values as bytea
+        return data.decode('utf-8') if parameter.value_type == SQL_C_CHAR else data
+    return parameter.value[row]
+
+
+def _parameter_set(state: StatementState, parameter_count: int, row: int) -> list:
+    return [_parameter_value(state.bound_parameters[number], row) for number in range(1, parameter_count + 1)]
+
+
+# size of the Bind / Execute messages SQLExecute sends per round trip
+PARAMSET_BATCH_BYTES = 65536
+
+
+def SQLExecute(
+        sqlhstmt: StatementHandle
+) -> ReturnCode:
+    # Run the prepared statement once per parameter set.
+    # With SQL_ATTR_PARAMSET_SIZE > 1 the parameter sets are sent as
+    # Bind / Execute pairs in batches of about PARAMSET_BATCH_BYTES, each batch
+    # ending in a Flush, so thousands of rows take a few round trips.
+    # The whole array runs as one implicit transaction: if a row fails
+    # nothing is applied and later batches aren't sent (see _execute_paramsets).
+    _logger.debug("Running SQLExecute ODBC Function")
+    if not isinstance(sqlhstmt, StatementHandle) or sqlhstmt.statement_name is None:
+        return ReturnCode("SQL_ERROR", 'HY010') # function sequence error, needs SQLPrepare
+    state = sqlhstmt.state
+    for number in range(1, sqlhstmt.parameter_count + 1):
+        if number not in state.bound_parameters:
+            return ReturnCode("SQL_ERROR", '07002') # COUNT field incorrect
+
+    connection = sqlhstmt.connection
+    try:
+        _start_results(sqlhstmt, sqlhstmt.query)
+        if state.paramset_size == 1:
+            return _execute_single(sqlhstmt)
+        return _execute_paramsets(sqlhstmt)
+    except Exception as e:
+        _logger.error(e)
+        state.has_results = False
+        _finish_timer(connection, 0, error=True)
+        return ReturnCode("SQL_ERROR")
+
+
+def _execute_single(sqlhstmt: StatementHandle) -> ReturnCode:
+    # One parameter set, the results can be read with SQLFetch.
+    # Reads up to the Row Description so errors are returned here.
+    state = sqlhstmt.state
+    connection = sqlhstmt.connection
+    execute_pipeline(connection, [create_prepared_messages(
+        sqlhstmt.query,
+        statement_name=sqlhstmt.statement_name,
+        parameters=_parameter_set(state, sqlhstmt.parameter_count, 0),
+        parse=False,
+    )])
+    try:
+        error = _read_description(state, connection)
+    except DatabaseError as e:
+        _logger.error(e)
+        state.has_results = False
+        _set_param_status(state, 1, SQL_PARAM_ERROR)
+        _finish_timer(connection, 0, error=True)
+        return ReturnCode("SQL_ERROR", _sqlstate(e))
+    _set_param_status(state, 1, SQL_PARAM_SUCCESS)
+    if not state.has_results:
+        # statement without results (No Data then Command Complete)
+        _finish_timer(connection, 0)
+    return error or ReturnCode("SQL_SUCCESS")
+
+
+def _set_param_status(state: StatementState, processed: int, status: int, start: int = 0) -> None:
+    if state.param_status is not None:
+        for row in range(start, processed):
+            state.param_status[row] = status
+    if state.params_processed is not None:
+        state.params_processed[0] = processed
+
+
+def _execute_paramsets(sqlhstmt: StatementHandle) -> ReturnCode:
+    # All the parameter sets run in one implicit transaction, so the array is atomic.
+    # The batches end in a Flush instead of a Sync so their results are read as
+    # they go (the server would block once its send buffer fills), only the end
+    # of the array is Synced. If a row fails the server skips everything up to
+    # that Sync and every row is rolled back.
+    state = sqlhstmt.state
+    connection = sqlhstmt.connection
+    state.has_results = False
+    if state.params_processed is not None:
+        state.params_processed[0] = 0
+    if state.param_status is not None:
+        for row in range(state.paramset_size):
+            state.param_status[row] = SQL_PARAM_UNUSED
+
+    execute_message = create_execute_message()
+    row_count = 0
+    row = 0
+    # the parameter set that failed, None if the Sync failed (ex: a deferred constraint)
+    failed = None
+    error = None
+    while row < state.paramset_size:
+        batch = []
+        batch_bytes = 0
+        batch_start = row
+        while row < state.paramset_size and batch_bytes < PARAMSET_BATCH_BYTES:
+            bind_message = create_bind_message(
+                statement_name=sqlhstmt.statement_name,
+                parameters=_parameter_set(state, sqlhstmt.parameter_count, row),
+            )
+            batch.append(bind_message)
+            batch.append(execute_message)
+            batch_bytes += len(bind_message) + len(execute_message)
+            row += 1
+        batch.append(create_flush_message())
+
+        completed, affected, error = _execute_batch(connection, b''.join(batch), row - batch_start)
+        if error is not None:
+            failed = batch_start + completed
+            break
+        row_count += affected
+
+    if error is None:
+        # commits the array
+        sync(connection)
+        try:
+            read_command_complete(connection)
+        except DatabaseError as e:
+            error = e
+
+    if error is not None:
+        _logger.error(error)
+        # Nothing was applied. The failed parameter set is SQL_PARAM_ERROR and
+        # the others SQL_PARAM_UNUSED, an error at the Sync fails all of them
+        if state.param_status is not None:
+            for row in range(state.paramset_size):
+                state.param_status[row] = SQL_PARAM_ERROR if failed in (None, row) else SQL_PARAM_UNUSED
+        if state.params_processed is not None:
+            state.params_processed[0] = state.paramset_size if failed is None else failed + 1
+        state.row_count = 0
+        _finish_timer(connection, 0, error=True)
+        return ReturnCode("SQL_ERROR", _sqlstate(error))
+
+    _set_param_status(state, state.paramset_size, SQL_PARAM_SUCCESS)
+    state.row_count = row_count
+    _finish_timer(connection, row_count)
+    return ReturnCode("SQL_SUCCESS")
+
+
+def _execute_batch(connection: ConnectionHandle, messages: bytes, count: int) -> Tuple[int, int, Optional[DatabaseError]]:
+    # Send one batch of Bind / Execute pairs ending in a Flush and read the results of its
+    # count parameter sets, Bind Complete ('2') then Command Complete each, or an Error Response
+    # for the failed one. Returns the parameter sets completed, the rows affected and the error.
+    # The Sync is owed until the end of the array (like an open portal, see sync),
+    # after an error it is sent when the error is read (see fetch_events)
+    send(connection, [messages])
+    connection.portal_open = True
+    affected = 0
+    for completed in range(count):
+        try:
+            read_result(connection, ResultReader())
+        except DatabaseError as e:
+            return completed, affected, e
+        affected += max(connection.rowcount, 0)
+    return count, affected, None
+
+
+def SQLMoreResults(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle]
+) -> ReturnCode:
+    # Move to the next set of results of a statement with several queries
+    # (ex: "select ...; select ..."), the rows left in the current set are skipped.
+    # SQL_NO_DATA once all of them have been read, up to the Ready for Query.
+    # The columns of the next set are described by SQLNumResultCols / SQLDescribeCol,
+    # a set from a statement without rows (ex: an INSERT) has none and sets SQLRowCount.
+    _logger.debug("Running SQLMoreResults ODBC Function")
+    state = _statement_state(sqlhstmt)
+    connection = _connection(sqlhstmt)
+    if connection.odbc_results is not state:
+        return ReturnCode("SQL_NO_DATA")
+    try:
+        if not _results_done(state, connection):
+            skip_result(connection)
+        _finish_timer(connection, 0)
+        state.has_results = False
+        state.column_descriptions = []
+        state.row_count = -1
+        state.results_start = connection.protocol.completed_results
+        event = next_result(connection)
+    except DatabaseError as e:
+        _logger.error(e)
+        _finish_timer(connection, 0, error=True)
+        return ReturnCode("SQL_ERROR", _sqlstate(e))
+    except Exception as e:
+        _logger.error(e)
+        return ReturnCode("SQL_ERROR")
+
+    if event is None:
+        return ReturnCode("SQL_NO_DATA")
+    if type(event) is CommandComplete:
+        state.row_count = event.rowcount
+        return ReturnCode("SQL_SUCCESS")
+    state.has_results = True
+    error = _set_columns(state, event.columns, connection.type_catalog)
+    if error is not None:
+        state.has_results = False
+        return error
+    return ReturnCode("SQL_SUCCESS")
+
+
+def SQLRowCount(
+        sqlhstmt: Union[StatementHandle, ConnectionHandle]
+) -> int:
+    # Rows affected by the last SQLExecute / SQLExecDirect, summed over
+    # the parameter sets, or the rows read so far for a SELECT. -1 if unknown
+    _logger.debug("Running SQLRowCount ODBC Function")
+    return _statement_state(sqlhstmt).row_count
+
+
 def SQLDisconnect(
         sqlhstmt: ConnectionHandle
 ) -> ReturnCode:
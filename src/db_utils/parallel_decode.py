@@ -0,0 +1,253 @@
+import os
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, NamedTuple, Optional, Tuple
+
+from db_utils import pg_types
+import db_utils.columnar as columnar
+import db_utils.simple_pg_protocol as pg
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+# Decode large results on several cores.
+# Parsing Data Rows is pure python, so one big extract keeps one core busy
+# while reading from the socket takes a fraction of that.
+# Here the reading thread only copies the raw Data Row messages into batches
+# of about batch_bytes, each batch is put in shared memory and decoded into
+# columns (see columnar) by a process pool. The columns come back in order.
+#
+# with ParallelDecoder(workers=8) as decoder:
+#     cursor.execute("select * from big_table;")
+#     columns = cursor.fetch_columns(decoder=decoder)
+#
+# The fixed size numeric columns come back through shared memory too, so the
+# only values that are pickled between processes are the ones that have to be
+# python objects anyway (ex: text). Results smaller than one batch are
+# decoded in this process, without the round trip to the pool.
+
+
+class _DecodedColumn(NamedTuple):
+    # one column of a decoded batch
+    # (shared memory offset, byte length) of the values for array columns, otherwise None
+    location: Optional[Tuple[int, int]]
+    # the values for list columns, otherwise None
+    values: Optional[list]
+    null_indices: List[int]
+
+
+class _DecodedBatch(NamedTuple):
+    row_count: int
+    # shared memory holding the array columns, created by the worker
+    # and unlinked by the reading process once it has copied them out
+    shared_memory_name: Optional[str]
+    columns: List[_DecodedColumn]
+
+
+def _parse_data_rows(data: memoryview, builders: List[columnar.ColumnBuilder]) -> int:
+    # data is a run of complete Data Row messages:
+    # char tag | int32 len | payload
+    # Returns the number of rows
+    parse_data_row = columnar._parse_data_row_columns
+    position = 0
+    row_count = 0
+    end = len(data)
+    while position < end:
+        message_end = position + 1 + int.from_bytes(data[position + 1:position + 5], 'big')
+        parse_data_row(data[position + 5:message_end], builders)
+        position = message_end
+        row_count += 1
+    return row_count
+
+
+def _decode_batch(
+        input_name: str,
+        size: int,
+        descriptions: List[pg.ColumnDescription],
+        convert_types: bool,
+        type_catalog: Optional[dict]
+) -> _DecodedBatch:
+    # Runs in a pool process.
+    # The type catalog is sent as TypeCatalog.to_dict, its cached decoders don't pickle
+    catalog = pg_types.TypeCatalog.from_dict(type_catalog) if type_catalog is not None else None
+    builders = columnar.column_builders(descriptions, convert_types, catalog)
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    try:
+        data = input_memory.buf[:size]
+        try:
+            row_count = _parse_data_rows(data, builders)
+        finally:
+            data.release()
+    finally:
+        input_memory.close()
+
+    array_bytes = sum(
+        len(builder.values) * builder.values.itemsize for builder in builders if isinstance(builder.values, array)
+    )
+    output_memory = shared_memory.SharedMemory(create=True, size=array_bytes) if array_bytes else None
+    columns = []
+    offset = 0
+    try:
+        for builder in builders:
+            if isinstance(builder.values, array):
+                length = len(builder.values) * builder.values.itemsize
+                output_memory.buf[offset:offset + length] = memoryview(builder.values).cast('B')
+                columns.append(_DecodedColumn((offset, length), None, builder.null_indices))
+                offset += length
+            else:
+                columns.append(_DecodedColumn(None, builder.values, builder.null_indices))
+    finally:
+        if output_memory is not None:
+            output_memory.close()
+    return _DecodedBatch(row_count, output_memory.name if output_memory is not None else None, columns)
+
+
+def _release(memory: shared_memory.SharedMemory) -> None:
+    memory.close()
+    memory.unlink()
+
+
+def _release_output(decoded: _DecodedBatch) -> None:
+    if decoded.shared_memory_name is not None:
+        _release(shared_memory.SharedMemory(name=decoded.shared_memory_name))
+
+
+class ParallelDecoder:
+    def __init__(
+            self,
+            workers: Optional[int] = None, # processes, os.cpu_count() by default
+            batch_bytes: int = 4 * 1024 * 1024, # raw Data Row bytes per batch
+            mp_context=None # multiprocessing context, ex: multiprocessing.get_context('spawn')
+    ) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_bytes = batch_bytes
+        self._executor = ProcessPoolExecutor(self.workers, mp_context)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self) -> "ParallelDecoder":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _submit(
+            self,
+            batch: bytearray,
+            descriptions: List[pg.ColumnDescription],
+            convert_types: bool,
+            type_catalog: Optional[dict]
+    ) -> Future:
+        input_memory = shared_memory.SharedMemory(create=True, size=len(batch))
+        input_memory.buf[:len(batch)] = batch
+        future = self._executor.submit(
+            _decode_batch, input_memory.name, len(batch), descriptions, convert_types, type_catalog
+        )
+        # the batch isn't needed once it has been decoded
+        future.add_done_callback(lambda _: _release(input_memory))
+        return future
+
+    def read_columns(
+            self,
+            handle: pg.ConnectionHandle,
+            description: list,
+            batches: list,
+            convert_types: bool = True
+    ) -> Tuple[list, int, str]:
+        # Parallel version of columnar.get_columns, reads the rest of the
+        # current results (or up to the next Portal Suspended).
+        # Each full batch is submitted to the pool and appended to batches,
+        # the partial batch at the end is appended as a bytearray, see gather.
+        # Returns the column names (if a Row Description was read), the number
+        # of rows read and where the results were left ('s' or 'C')
+        try:
+            return self._read_columns(handle, description, batches, convert_types)
+        except BaseException:
+            self.discard(batches)
+            raise
+
+    def _read_columns(
+            self,
+            handle: pg.ConnectionHandle,
+            description: list,
+            batches: list,
+            convert_types: bool
+    ) -> Tuple[list, int, str]:
+        batch = bytearray()
+        catalog = None
+
+        def add_row(event: pg.DataRow) -> None:
+            nonlocal batch, catalog
+            batch += event.message
+            if len(batch) >= self.batch_bytes:
+                if catalog is None and handle.type_catalog is not None:
+                    catalog = handle.type_catalog.to_dict()
+                batches.append(self._submit(batch, list(description), convert_types, catalog))
+                batch = bytearray()
+                self._wait_for_backlog(batches)
+
+        reader = pg.ResultReader(add_row, description=description)
+        status = pg.read_result(handle, reader)
+        if batch:
+            batches.append(batch)
+        return reader.columns, reader.count, status
+
+    def _wait_for_backlog(self, batches: list) -> None:
+        # Keep at most two batches per worker waiting, so a slow pool
+        # holds back the reading instead of piling batches up in memory
+        pending = [batch for batch in batches if isinstance(batch, Future) and not batch.done()]
+        if len(pending) > 2 * self.workers:
+            pending[0].result()
+
+    def gather(
+            self,
+            batches: list,
+            builders: List[columnar.ColumnBuilder],
+            use_numpy: bool = False
+    ) -> List[columnar.ColumnData]:
+        # Append the decoded batches to builders (see columnar.column_builders), in order,
+        # and return one ColumnData per column
+        try:
+            for index, batch in enumerate(batches):
+                if isinstance(batch, bytearray):
+                    # partial batch, decode it here
+                    _parse_data_rows(memoryview(batch), builders)
+                    continue
+                decoded: _DecodedBatch = batch.result()
+                # once result() has returned, the batch is ours to release
+                batches[index] = None
+                self._append_batch(decoded, builders)
+        except BaseException:
+            self.discard(batches)
+            raise
+        return [builder.finish(use_numpy) for builder in builders]
+
+    def _append_batch(self, decoded: _DecodedBatch, builders: List[columnar.ColumnBuilder]) -> None:
+        output_memory = None
+        if decoded.shared_memory_name is not None:
+            output_memory = shared_memory.SharedMemory(name=decoded.shared_memory_name)
+        try:
+            for builder, column in zip(builders, decoded.columns):
+                start = len(builder.values)
+                if column.location is not None:
+                    offset, length = column.location
+                    builder.values.frombytes(output_memory.buf[offset:offset + length])
+                else:
+                    builder.values.extend(column.values)
+                builder.null_indices.extend(index + start for index in column.null_indices)
+        finally:
+            if output_memory is not None:
+                _release(output_memory)
+
+    def discard(self, batches: list) -> None:
+        # Free the shared memory of batches that won't be gathered (ex: after an error)
+        for index, batch in enumerate(batches):
+            batches[index] = None
+            if not isinstance(batch, Future) or batch.cancel():
+                continue
+            try:
+                _release_output(batch.result())
+            except Exception as e:
+                _logger.debug(f"Error discarding a decoded batch: {e}")
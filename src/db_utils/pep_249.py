@@ -1,54 +1,852 @@
 import db_utils.simple_pg_protocol as pg
-from typing import List
+import db_utils.pg_types as pg_types
+import db_utils.columnar as columnar
+from db_utils.simple_pg_protocol import DatabaseError
+from db_utils.query_stats import StatsCollector
+from db_utils.result_cache import ResultCache, is_cacheable, query_tables
+from db_utils.sql_text import is_single_statement
+from db_utils.parallel_decode import ParallelDecoder
+from db_utils.columnar_file import ColumnarWriter, export_builders
+from db_utils.lazy_rows import get_rows as get_lazy_rows
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Iterable, IO, Iterator, List, Optional, Sequence, Tuple, Union
+import io
+import time
+
+def connect(
+        params:dict,
+        statement_cache_size: int = 100,
+        stats: Optional[StatsCollector] = None,
+        type_catalog: bool = False,
+        type_catalog_path: Optional[str] = None,
+        result_cache: Optional[ResultCache] = None
+):
+    return Connection(params, statement_cache_size, stats, type_catalog, type_catalog_path, result_cache)
+
+def _describe_column(column: pg.ColumnDescription) -> tuple:
+    # PEP 249 description:
+    # (name, type_code, display_size, internal_size, precision, scale, null_ok)
+    display_size = None
+    precision = None
+    scale = None
+    if column.type_modifier >= 4:
+        # the type modifier is offset by 4 (the varlena header size)
+        modifier = column.type_modifier - 4
+        if column.type_oid == pg_types.NUMERIC_OID:
+            precision = modifier >> 16
+            scale = modifier & 0xFFFF
+        elif column.type_oid in (pg_types.VARCHAR_OID, pg_types.BPCHAR_OID):
+            display_size = modifier
+
+    internal_size = column.type_size if column.type_size >= 0 else None
+    return (column.name, column.type_oid, display_size, internal_size, precision, scale, None)
+
+
+class StatementCache:
+    # LRU cache of the server side prepared statements on a connection.
+    # Maps query text to the statement name, when the cache is full the least
+    # recently used statement is evicted and closed on the next round trip.
+    def __init__(self, max_size: int = 100) -> None:
+        self.max_size = max_size
+        self._statements = OrderedDict()
+        # queries without parameters that have been run once, see repeated
+        self._seen = OrderedDict()
+        self._to_close = []
+        self._counter = 0
+
+    def __len__(self) -> int:
+        return len(self._statements)
+
+    def __contains__(self, query: str) -> bool:
+        return query in self._statements
+
+    def get(self, query: str) -> Tuple[str, bool]:
+        # returns (statement name, needs to be parsed)
+        name = self._statements.get(query)
+        if name is not None:
+            self._statements.move_to_end(query)
+            return name, False
+
+        self._counter += 1
+        name = f"db_utils_{self._counter}"
+        self._statements[query] = name
+        if len(self._statements) > self.max_size:
+            _, evicted = self._statements.popitem(last=False)
+            self._to_close.append(evicted)
+        return name, True
+
+    def repeated(self, query: str) -> bool:
+        # Queries without parameters are only prepared the second time they are run,
+        # so one-off queries (DDL, SET, ...) don't evict the statements that get reused
+        if query in self._statements:
+            return True
+        if query in self._seen:
+            del self._seen[query]
+            return True
+        self._seen[query] = None
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def discard(self, query: str) -> None:
+        name = self._statements.pop(query, None)
+        if name is not None:
+            self._to_close.append(name)
+
+    def pop_evicted(self) -> List[str]:
+        # statements that should be closed on the server
+        evicted = self._to_close
+        self._to_close = []
+        return evicted
+
+
+def _create_query(
+        query: str,
+        parameters: Optional[Sequence],
+        binary: bool,
+        statement_cache: Optional[StatementCache],
+        portal_rows: Optional[int] = None
+) -> Tuple[bytes, Optional[str]]:
+    # Pick the protocol messages for a query.
+    # Returns the messages and the query text if it was parsed into a new
+    # cached statement (so it can be dropped from the cache if it fails)
+    # With portal_rows the query runs in a portal that returns that many rows at a time
+    # Queries without parameters use the statement cache once they repeat, unless they
+    # have several statements, those need the simple query protocol.
+    cached = statement_cache is not None and statement_cache.max_size > 0 and (
+        parameters is not None
+        or (is_single_statement(query) and statement_cache.repeated(query))
+    )
+    if not cached and parameters is None and not portal_rows:
+        if binary:
+            return pg.create_prepared_messages(query, binary=True), None
+        return pg.create_query_message(query), None
+
+    portal_name = _PORTAL_NAME if portal_rows else ''
+    if not cached:
+        # unnamed statement, parsed every time
+        message = pg.create_prepared_messages(
+            query,
+            parameters=parameters or (),
+            binary=binary,
+            portal_name=portal_name,
+            max_rows=portal_rows or 0,
+        )
+        return message, None
+
+    statement_name, parse = statement_cache.get(query)
+    message = pg.create_prepared_messages(
+        query,
+        statement_name=statement_name,
+        parameters=parameters or (),
+        parse=parse,
+        binary=binary,
+        close_statements=statement_cache.pop_evicted(),
+        portal_name=portal_name,
+        max_rows=portal_rows or 0,
+    )
+    return message, query if parse else None
+
+
+# name of the portal used by cursors with portal_rows set
+_PORTAL_NAME = "db_utils_portal"
+
+# Errors from a cached statement the server can't run any more, it is dropped
+# from the cache and the query is prepared again (see Cursor._retry_stale_statement):
+# 0A000 cached plan must not change result type (ex: ALTER TABLE under a select *),
+# 26000 the prepared statement doesn't exist (ex: after DISCARD ALL)
+_STALE_STATEMENT = {'0A000', '26000'}
 
-def connect(params:dict):
-    return Connection(params)
 
 class Cursor:
-    def __init__(self, handle: pg.ConnectionHandle) -> None:
-        self.rowcount = None
-        self.description = None
+    def __init__(
+            self,
+            handle: pg.ConnectionHandle,
+            binary: bool = False,
+            statement_cache: Optional[StatementCache] = None,
+            portal_rows: Optional[int] = None,
+            result_cache: Optional[ResultCache] = None,
+            lazy_rows: bool = False
+    ) -> None:
+        # Rows affected or returned by the current set of results, from its
+        # Command Complete, -1 until the set has been read to its end
+        # (ex: by fetchall, or nextset for a statement without rows)
+        self.rowcount = -1
         self.handle = handle
         self.columns = []
-        
+        # default number of rows for fetchmany
+        self.arraysize = 1
+        # rows decoded at a time by fetchone and iteration
+        self.itersize = 2000
+        # binary=True requests binary results, which are decoded
+        # straight into python types instead of parsing text
+        self.binary = binary
+        # text results are converted to python types based on the column type oid,
+        # set to False to get the raw strings back
+        self.convert_types = True
+        # With lazy_rows the rows are lazy_rows.LazyRow, which only decode (and convert)
+        # the values that are accessed, for wide results where few columns are used
+        self.lazy_rows = lazy_rows
+        # With portal_rows set queries run through a named portal and the server
+        # only sends portal_rows rows at a time, waiting until we ask for more.
+        # Client memory stays flat no matter how large the results are.
+        self.portal_rows = portal_rows
+        # Client side statement timeout in seconds, None waits forever.
+        # A query whose results haven't all arrived by then is canceled and
+        # StatementTimeout is raised, the connection stays usable.
+        self.timeout: Optional[float] = None
+        # ColumnDescription for each column of the current results
+        self._column_descriptions = []
+        # queries with parameters are run as named prepared statements from this cache
+        self.statement_cache = statement_cache
+        # query that was prepared by the last execute, dropped from the cache if it fails
+        self._parsed_query = None
+        # the arguments of the last execute if it reused a cached statement,
+        # until its first rows arrive (see _retry_stale_statement)
+        self._retry = None
+        # rows decoded but not returned yet
+        self._rows = []
+        self._row_index = 0
+        # where the results were left, see simple_pg_protocol.get_many
+        self._status = "C"
+        # read only queries are served from this cache when they can be, see result_cache
+        self.result_cache = result_cache
+        # rows of the current results collected for the cache, None if they won't be cached
+        self._cache_rows = None
+        self._cache_key = None
+        self._cache_tags = ()
+        self._cache_generation = 0
+
+    @property
+    def description(self) -> Optional[List[tuple]]:
+        if not self._column_descriptions:
+            return None
+        return [_describe_column(column) for column in self._column_descriptions]
+
     def close(self) -> None:
         pg.disconnect(self.handle)
         return
     
-    def execute(self, query:str) -> None:
-        pg.execute(self.handle, query)
-        self.results_generator = pg.fetch_message(self.handle)
+    def execute(
+            self,
+            query:str,
+            parameters: Optional[Sequence] = None,
+            cache_tags: Optional[Iterable[str]] = None,
+            timeout: Optional[float] = None
+    ) -> None:
+        # Parameters use the postgres placeholders: $1, $2, ...
+        # and are sent to the server separately from the query
+        # cache_tags replaces the table names as the result cache tags of the query
+        # timeout overrides self.timeout for this query
+        self._column_descriptions = []
+        self._rows = []
+        self._row_index = 0
+        self._cache_rows = None
+        self.rowcount = -1
+        self._retry = None
+        # throw away anything left from the last query
+        self._finish_timer()
+        pg.drain(self.handle)
+
+        if self.result_cache is not None and self._use_cache(query, parameters, cache_tags):
+            return
+
+        message, self._parsed_query = _create_query(
+            query, parameters, self.binary, self.statement_cache, self.portal_rows
+        )
+        if self._parsed_query is None and self.statement_cache is not None and query in self.statement_cache:
+            self._retry = (query, parameters, cache_tags, timeout)
+        self._start_timer(query)
+        pg.set_deadline(self.handle, timeout if timeout is not None else self.timeout)
+        if self.portal_rows:
+            pg.execute_portal(self.handle, message)
+        else:
+            pg.execute_pipeline(self.handle, [message])
+        self._status = "D"
         return
-    
-    def fetchone(self) -> tuple:
-        columns, row = pg.get_row(self.results_generator)
+
+    def _use_cache(self, query: str, parameters: Optional[Sequence], cache_tags: Optional[Iterable[str]]) -> bool:
+        # Returns True if the results were found in the cache, otherwise
+        # sets up collecting them as they are read to cache them.
+        # Inside a transaction block the results could depend on uncommitted changes
+        if self.handle.transaction_status != 'I' or not is_cacheable(query):
+            return False
+        key = ResultCache.key(query, parameters, self.binary, self.convert_types, self.lazy_rows)
+        if key is None:
+            return False
+
+        cached = self.result_cache.get(key)
+        if cached is None:
+            self._cache_key = key
+            self._cache_tags = tuple(cache_tags) if cache_tags is not None else tuple(query_tables(query))
+            self._cache_generation = self.result_cache.generation
+            self._cache_rows = []
+            return False
+
+        self._column_descriptions = list(cached.column_descriptions)
+        self.columns = list(cached.columns)
+        self._rows = cached.rows()
+        self.rowcount = len(self._rows)
+        self._status = "C"
+        return True
+
+    def _cache_results(self, rows: List[tuple]) -> None:
+        self._cache_rows.extend(rows)
+        if len(self._cache_rows) > self.result_cache.max_entry_rows:
+            # too large, stop collecting
+            self._cache_rows = None
+        elif self._status == "C":
+            self.result_cache.put(
+                self._cache_key,
+                self.columns,
+                self._column_descriptions,
+                self._cache_rows,
+                self._cache_tags,
+                self._cache_generation,
+            )
+            self._cache_rows = None
+
+    def _discard_statement(self) -> None:
+        # the statement may not exist on the server if the query failed
+        if self._parsed_query is not None and self.statement_cache is not None:
+            self.statement_cache.discard(self._parsed_query)
+            self._parsed_query = None
+
+    def _retry_stale_statement(self, error: DatabaseError) -> bool:
+        # A statement cached by an earlier execute can go stale on the server.
+        # It is dropped and the query runs again, prepared afresh, at most once
+        # and only before any rows were returned. True if it was run again
+        retry = self._retry
+        self._retry = None
+        if retry is None or error.sqlstate not in _STALE_STATEMENT:
+            return False
+        query, parameters, cache_tags, timeout = retry
+        self.statement_cache.discard(query)
+        self.execute(query, parameters, cache_tags, timeout)
+        return True
+
+    def _start_timer(self, query: str) -> None:
+        if self.handle.stats is not None:
+            self.handle.query_timer = self.handle.stats.start(query, self.handle.read_buffer)
+
+    def _finish_timer(self, error: bool = False) -> None:
+        timer = self.handle.query_timer
+        if timer is not None:
+            self.handle.query_timer = None
+            timer.finish(error)
+
+    def _read_rows(self, size: int) -> List[tuple]:
+        # Decode the next batch of up to size rows (all of them if size is negative).
+        # Returns fewer rows than size only once the results are finished
+        # or the portal is suspended.
+        if self._status == "C":
+            return []
+        if self._status == "s":
+            pg.fetch_portal(self.handle, _PORTAL_NAME, self.portal_rows)
+
+        timer = self.handle.query_timer
+        if timer is not None:
+            started = time.perf_counter()
+            receive_time = self.handle.read_buffer.receive_time
+        try:
+            if self.lazy_rows:
+                columns, rows, self._status = get_lazy_rows(
+                    self.handle, size, self._column_descriptions, self.convert_types
+                )
+            else:
+                columns, rows, self._status = pg.get_many(self.handle, size, self._column_descriptions)
+        except DatabaseError as error:
+            self._status = "C"
+            self._cache_rows = None
+            self._discard_statement()
+            self._finish_timer(error=True)
+            if self._retry_stale_statement(error):
+                return self._read_rows(size)
+            raise
+        self._retry = None
         if columns != []:
             self.columns = columns
+        if self.convert_types and not self.lazy_rows:
+            rows = pg_types.convert_rows(rows, self._column_descriptions, self.handle.type_catalog)
+        if self._cache_rows is not None:
+            self._cache_results(rows)
+        if timer is not None:
+            # decode time is the time spent here, less the time waiting on the socket
+            waiting = self.handle.read_buffer.receive_time - receive_time
+            timer.add_rows(len(rows), time.perf_counter() - started - waiting)
+        if self._status == "C":
+            self.rowcount = self.handle.rowcount
+            # close the portal (if there is one) without waiting for the reply
+            pg.sync(self.handle)
+            # all of the results arrived in time
+            pg.set_deadline(self.handle, None)
+            self._finish_timer()
+        return rows
+
+    def _take_rows(self, size: int) -> List[tuple]:
+        # up to size rows, from the already decoded rows first
+        rows = self._rows[self._row_index:self._row_index + size]
+        self._row_index += len(rows)
+        while len(rows) < size and self._status != "C":
+            rows.extend(self._read_rows(size - len(rows)))
+        return rows
+    
+    def fetchone(self) -> Optional[tuple]:
+        while self._row_index >= len(self._rows):
+            if self._status == "C":
+                return None
+            self._rows = self._read_rows(self.itersize)
+            self._row_index = 0
+        row = self._rows[self._row_index]
+        self._row_index += 1
         return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[tuple]:
+        return self._take_rows(self.arraysize if size is None else size)
     
     def fetchall(self) -> List[tuple]:
-        columns, rows = pg.get_data(self.results_generator)
+        rows = self._rows[self._row_index:]
+        self._rows = []
+        self._row_index = 0
+        while self._status != "C":
+            rows.extend(self._read_rows(-1))
+        return rows
+
+    def nextset(self) -> Optional[bool]:
+        # Move to the next set of results of a query with several statements
+        # (ex: "select ...; select ..."), the rows left in the current set are skipped.
+        # Returns True if there is another set, None once all of them have been read,
+        # up to the query's Ready for Query.
+        # A set from a statement without rows (ex: an INSERT) has no description
+        # and its rowcount is known straight away.
+        self._rows = []
+        self._row_index = 0
+        self._cache_rows = None
+        try:
+            if self._status == "D":
+                self._status = pg.skip_result(self.handle)
+            # a portal runs a single statement, this closes it
+            pg.sync(self.handle)
+            self._finish_timer()
+            self._column_descriptions = []
+            result = pg.next_result(self.handle, self._column_descriptions)
+        except DatabaseError as error:
+            self._status = "C"
+            self._discard_statement()
+            self._finish_timer(error=True)
+            if self._retry_stale_statement(error):
+                return self.nextset()
+            raise
+
+        self._retry = None
+        self._status = "C"
+        self.columns = []
+        if result is None:
+            return None
+        if type(result) is pg.CommandComplete:
+            self.rowcount = result.rowcount
+        else:
+            self.columns = [column.name for column in result.columns]
+            self.rowcount = -1
+            self._status = "D"
+        return True
+
+    def _read_columns(
+            self,
+            size: int,
+            builders: List[columnar.ColumnBuilder],
+            make_builders: Optional[Callable[[List[pg.ColumnDescription]], List[columnar.ColumnBuilder]]] = None
+    ) -> int:
+        # Same as _read_rows, but the values are appended to builders
+        # (created by make_builders from the Row Description, see columnar.get_columns).
+        # Returns the number of rows read.
+        # Results read this way aren't cached
+        self._cache_rows = None
+        if self._status == "C":
+            return 0
+        if self._status == "s":
+            pg.fetch_portal(self.handle, _PORTAL_NAME, self.portal_rows)
+
+        timer = self.handle.query_timer
+        if timer is not None:
+            started = time.perf_counter()
+            receive_time = self.handle.read_buffer.receive_time
+        try:
+            columns, count, self._status = columnar.get_columns(
+                self.handle, size, self._column_descriptions, builders, self.convert_types, make_builders
+            )
+        except DatabaseError as error:
+            self._status = "C"
+            self._discard_statement()
+            self._finish_timer(error=True)
+            if self._retry_stale_statement(error):
+                return self._read_columns(size, builders, make_builders)
+            raise
+        self._retry = None
         if columns != []:
             self.columns = columns
-        return rows
+        if timer is not None:
+            waiting = self.handle.read_buffer.receive_time - receive_time
+            timer.add_rows(count, time.perf_counter() - started - waiting)
+        if self._status == "C":
+            self.rowcount = self.handle.rowcount
+            pg.sync(self.handle)
+            pg.set_deadline(self.handle, None)
+            self._finish_timer()
+        return count
+
+    def _fetch_columns(self, size: int, numpy: bool) -> Tuple[int, List[columnar.ColumnData]]:
+        if numpy:
+            columnar.check_numpy()
+        builders = columnar.column_builders(self._column_descriptions, self.convert_types, self.handle.type_catalog)
+
+        # rows already decoded by fetchone go first
+        end = len(self._rows) if size < 0 else min(self._row_index + size, len(self._rows))
+        for row in self._rows[self._row_index:end]:
+            for builder, value in zip(builders, row):
+                builder.append_value(value)
+        count = end - self._row_index
+        self._row_index = end
+
+        while count != size and self._status != "C":
+            count += self._read_columns(-1 if size < 0 else size - count, builders)
+        return count, [builder.finish(numpy) for builder in builders]
+
+    def fetch_columns(self, numpy: bool = False, decoder: Optional[ParallelDecoder] = None) -> List[columnar.ColumnData]:
+        # Fetch the rest of the results as one ColumnData per column.
+        # Numeric columns are array.array (numpy arrays with numpy=True)
+        # so no python objects are created per row.
+        # With a decoder the rows are decoded on its process pool, see parallel_decode
+        if decoder is not None:
+            return self._fetch_columns_parallel(numpy, decoder)
+        _, columns = self._fetch_columns(-1, numpy)
+        return columns
+
+    def _fetch_columns_parallel(self, numpy: bool, decoder: ParallelDecoder) -> List[columnar.ColumnData]:
+        # Same as _fetch_columns(-1, numpy) with _read_columns done by the decoder
+        if numpy:
+            columnar.check_numpy()
+        self._cache_rows = None
+        timer = self.handle.query_timer
+        if timer is not None:
+            started = time.perf_counter()
+            receive_time = self.handle.read_buffer.receive_time
+
+        batches = []
+        count = 0
+        try:
+            while self._status != "C":
+                if self._status == "s":
+                    pg.fetch_portal(self.handle, _PORTAL_NAME, self.portal_rows)
+                columns, batch_count, self._status = decoder.read_columns(
+                    self.handle, self._column_descriptions, batches, self.convert_types
+                )
+                count += batch_count
+                if columns != []:
+                    self.columns = columns
+        except DatabaseError as error:
+            self._status = "C"
+            self._discard_statement()
+            self._finish_timer(error=True)
+            if not batches and self._retry_stale_statement(error):
+                return self._fetch_columns_parallel(numpy, decoder)
+            raise
+        self._retry = None
+
+        builders = columnar.column_builders(self._column_descriptions, self.convert_types, self.handle.type_catalog)
+        # rows already decoded by fetchone go first
+        for row in self._rows[self._row_index:]:
+            for builder, value in zip(builders, row):
+                builder.append_value(value)
+        self._row_index = len(self._rows)
+        columns = decoder.gather(batches, builders, numpy)
+
+        if timer is not None:
+            waiting = self.handle.read_buffer.receive_time - receive_time
+            timer.add_rows(count, time.perf_counter() - started - waiting)
+        pg.sync(self.handle)
+        pg.set_deadline(self.handle, None)
+        self._finish_timer()
+        return columns
+
+    def fetch_column_batches(self, size: Optional[int] = None, numpy: bool = False) -> Iterator[List[columnar.ColumnData]]:
+        # fetch_columns in batches of up to size rows (itersize by default)
+        size = self.itersize if size is None else size
+        while True:
+            count, columns = self._fetch_columns(size, numpy)
+            if count == 0:
+                return
+            yield columns
+
+    def export_columnar(self, path: str, batch_rows: int = 65536) -> int:
+        # Write the rest of the results to a columnar file, reloaded with
+        # columnar_file.ColumnarFile instead of running the query again.
+        # The rows are read batch_rows at a time, so memory use doesn't grow with the results.
+        # Returns the number of rows written
+        make_builders = lambda columns: export_builders(columns, self.handle.type_catalog)
+        builders = make_builders(self._column_descriptions)
+        writer = None
+        try:
+            # rows already decoded by fetchone (or served from the result cache) go first
+            for row in self._rows[self._row_index:]:
+                for builder, value in zip(builders, row):
+                    builder.append_value(value)
+            self._row_index = len(self._rows)
+
+            while True:
+                if self._status != "C":
+                    self._read_columns(batch_rows, builders, make_builders)
+                if writer is None:
+                    writer = ColumnarWriter(path, builders)
+                writer.append(builders)
+                if self._status == "C":
+                    break
+                builders = make_builders(self._column_descriptions)
+            writer.close()
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        return writer.row_count
+
+    def __iter__(self) -> Iterator[tuple]:
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def copy_from(
+            self,
+            source: Union[IO, Iterable[Sequence]],
+            table: str,
+            columns: Optional[Sequence[str]] = None,
+            csv: bool = False,
+            chunk_size: int = 65536
+    ) -> int:
+        # Bulk load with COPY table FROM STDIN.
+        # source is either a file like object (already in the COPY text/csv format),
+        # or an iterable of rows that get encoded here, a batch of rows at a time.
+        # Only one chunk is held in memory at a time.
+        self._finish_timer()
+        pg.drain(self.handle)
+        query = f"COPY {table}{_copy_columns(columns)} FROM STDIN{' WITH (FORMAT csv)' if csv else ''}"
+        self._start_timer(query)
+        try:
+            pg.copy_in(self.handle, query, _copy_chunks(source, csv, chunk_size))
+        except DatabaseError:
+            self._finish_timer(error=True)
+            raise
+        self.rowcount = self.handle.rowcount
+        self._finish_copy_timer()
+        return self.rowcount
+
+    def copy_to(
+            self,
+            destination: Union[IO, Callable[[bytes], object]],
+            table: str,
+            columns: Optional[Sequence[str]] = None,
+            csv: bool = False,
+            chunk_size: int = 65536
+    ) -> int:
+        # Bulk export with COPY table TO STDOUT, table can also be a query in brackets.
+        # destination is a file like object or a callback, it gets chunks of
+        # about chunk_size bytes in the COPY text/csv format.
+        self._finish_timer()
+        pg.drain(self.handle)
+        query = f"COPY {table}{_copy_columns(columns)} TO STDOUT{' WITH (FORMAT csv)' if csv else ''}"
+        if isinstance(destination, io.TextIOBase):
+            write = lambda chunk: destination.write(chunk.decode('utf-8'))
+        elif hasattr(destination, 'write'):
+            write = destination.write
+        else:
+            write = destination
+        self._start_timer(query)
+        try:
+            pg.copy_out(self.handle, query, write, chunk_size)
+        except DatabaseError:
+            self._finish_timer(error=True)
+            raise
+        self.rowcount = self.handle.rowcount
+        self._finish_copy_timer()
+        return self.rowcount
+
+    def _finish_copy_timer(self) -> None:
+        if self.handle.query_timer is not None:
+            self.handle.query_timer.add_rows(max(self.rowcount, 0), 0.0)
+            self._finish_timer()
+
+
+# rows encoded per CopyData message when copying from an iterable
+_COPY_BATCH_ROWS = 1000
+
+
+def _copy_columns(columns: Optional[Sequence[str]]) -> str:
+    if not columns:
+        return ''
+    return f" ({', '.join(columns)})"
+
+
+def _copy_chunks(source: Union[IO, Iterable[Sequence]], csv: bool, chunk_size: int) -> Iterator[bytes]:
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+    rows = iter(source)
+    while True:
+        batch = list(islice(rows, _COPY_BATCH_ROWS))
+        if not batch:
+            return
+        yield pg_types.encode_copy_rows(batch, csv)
+
+
+class Pipeline:
+    # Queue up queries and send them together, so N queries take one
+    # network round trip instead of N.
+    # Every query ends with its own Ready for Query, so an error in
+    # one query doesn't affect the others.
+    #
+    # pipeline = conn.pipeline()
+    # pipeline.execute("select $1::int4;", (1,))
+    # pipeline.execute("select 2;")
+    # results = pipeline.sync() # [[(1,)], [(2,)]]
+    def __init__(
+            self,
+            handle: pg.ConnectionHandle,
+            binary: bool = False,
+            statement_cache: Optional[StatementCache] = None,
+            max_batch_bytes: int = 65536
+    ) -> None:
+        self.handle = handle
+        self.binary = binary
+        self.statement_cache = statement_cache
+        self.convert_types = True
+        # Queries are written in batches of about this size, then their results
+        # are read before writing more. Writing everything at once could deadlock
+        # with the server blocked on sending results we aren't reading yet.
+        self.max_batch_bytes = max_batch_bytes
+        self._queue = []
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def execute(self, query: str, parameters: Optional[Sequence] = None) -> None:
+        self._queue.append((query, parameters))
+
+    def sync(self) -> List[Union[List[tuple], DatabaseError]]:
+        # Send the queued queries and read all of the results.
+        # Returns the rows for each query, in order, or the DatabaseError it raised.
+        queue = self._queue
+        self._queue = []
+        pg.drain(self.handle)
+
+        results = []
+        batch = []
+        parsed_queries = []
+        batch_bytes = 0
+        for query, parameters in queue:
+            message, parsed_query = _create_query(query, parameters, self.binary, self.statement_cache)
+            batch.append(message)
+            parsed_queries.append((query, parsed_query))
+            batch_bytes += len(message)
+            if batch_bytes >= self.max_batch_bytes:
+                results.extend(self._run_batch(batch, parsed_queries))
+                batch = []
+                parsed_queries = []
+                batch_bytes = 0
+
+        if batch:
+            results.extend(self._run_batch(batch, parsed_queries))
+        return results
+
+    def _run_batch(self, batch: List[bytes], parsed_queries: List[Tuple[str, Optional[str]]]) -> list:
+        pg.execute_pipeline(self.handle, batch)
+        results_generator = pg.fetch_events(self.handle)
+
+        results = []
+        for query, parsed_query in parsed_queries:
+            column_descriptions = []
+            pending_results = self.handle.pending_results
+            try:
+                _, rows = pg.get_data(results_generator, column_descriptions, self.handle.type_catalog)
+                if self.handle.pending_results == pending_results:
+                    # a query with several statements, only its first set of results is kept
+                    while pg.next_result(self.handle) is not None:
+                        pg.skip_result(self.handle)
+            except DatabaseError as error:
+                # a statement prepared here may not exist, a stale one is prepared again next time
+                if self.statement_cache is not None and (parsed_query is not None or error.sqlstate in _STALE_STATEMENT):
+                    self.statement_cache.discard(query)
+                results.append(error)
+                continue
+            if self.convert_types:
+                rows = pg_types.convert_rows(rows, column_descriptions, self.handle.type_catalog)
+            results.append(rows)
+        return results
 
 
 class Connection:
-    def __init__(self, params:dict):
+    def __init__(
+            self,
+            params:dict,
+            statement_cache_size: int = 100,
+            stats: Optional[StatsCollector] = None,
+            type_catalog: bool = False,
+            type_catalog_path: Optional[str] = None,
+            result_cache: Optional[ResultCache] = None
+    ):
         self.params = params
         self.handle = pg.startup(params, pg.ConnectionHandle())
+        # set statement_cache_size to 0 to disable named prepared statements
+        self.statement_cache = StatementCache(statement_cache_size)
+        # client side query statistics, see query_stats.StatsCollector
+        self.handle.stats = stats
+        # Decode arrays, composite types, enums and domains with the server's pg_type,
+        # loaded once per server and shared with the other connections in the process.
+        # With type_catalog_path it is also saved to that file, so new processes start with it.
+        if type_catalog or type_catalog_path is not None:
+            pg.load_type_catalog(self.handle, params, type_catalog_path)
+        # client side cache for the results of read only queries, see result_cache.ResultCache
+        self.result_cache = result_cache
+
+    @property
+    def stats(self) -> Optional[StatsCollector]:
+        return self.handle.stats
 
     def close(self) -> None:
         pg.disconnect(self.handle)
         return
     
-    def commit() -> None:
-        # we won't be using this method
-        # assume "autocommit"
+    def commit(self) -> None:
+        # queries run in autocommit mode unless a transaction
+        # was started with BEGIN, only then there is something to commit
+        self._end_transaction("COMMIT")
         return
+
+    def rollback(self) -> None:
+        self._end_transaction("ROLLBACK")
+        return
+
+    def cancel(self) -> None:
+        # Cancel the running query, can be called from another thread.
+        # The query raises a DatabaseError (57014 query_canceled)
+        pg.cancel(self.handle)
+
+    def _end_transaction(self, query: str) -> None:
+        pg.drain(self.handle)
+        if self.handle.transaction_status != 'I':
+            pg.execute(self.handle, query)
+            pg.drain(self.handle)
     
-    def cursor(self) -> Cursor:
-        return Cursor(self.handle)
+    def cursor(self, binary: bool = False, portal_rows: Optional[int] = None, lazy_rows: bool = False) -> Cursor:
+        return Cursor(self.handle, binary, self.statement_cache, portal_rows, self.result_cache, lazy_rows)
+
+    def pipeline(self, binary: bool = False) -> Pipeline:
+        return Pipeline(self.handle, binary, self.statement_cache)
     
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
 import db_utils.odbc_driver as odbc
-from typing import List
+from db_utils.simple_pg_protocol import set_socket_options
+from db_utils.query_stats import StatsCollector
+from typing import List, Optional
 
-def connect(params:dict):
-    return Connection(params)
+def connect(params:dict, stats: Optional[StatsCollector] = None):
+    return Connection(params, stats)
 
 class Cursor:
     def __init__(self, handle: odbc.ConnectionHandle) -> None:
@@ -10,37 +12,158 @@ class Cursor:
         self.description = None
         self.handle = handle
         self.columns = []
-        
+        # rows per SQLFetch for fetchone / fetchmany / iteration
+        self.arraysize = 100
+        self.statement = odbc.SQLAllocHandle(odbc.SQL_HANDLE_STMT, handle)
+        # values of the bound columns, one list per column
+        self._values: List[list] = []
+        self._nulls: list = []
+        self._rows_fetched = [0]
+        # rows of the last rowset that haven't been returned yet
+        self._rowset: List[tuple] = []
+        self._rowset_index = 0
+        self._executed = False
+
     def close(self) -> None:
         odbc.SQLDisconnect(self.handle)
         return
-    
+
     def execute(self, query:str) -> None:
-        odbc.SQLExecDirect(self.handle, query, len(query))
-        self.results_generator = odbc.SQLFetch(self.handle)
+        self._unbind()
+        return_code = odbc.SQLExecDirect(self.statement, query, len(query))
+        if return_code.code_name == "SQL_ERROR":
+            raise odbc.DatabaseError({'C': return_code.value, 'M': "error executing the query"})
+        self._executed = True
         return
-    
-    def fetchone(self) -> tuple:
-        # Not implemented
-        pass
-    
+
+    def _unbind(self) -> None:
+        for column_number in range(1, len(self._values) + 1):
+            odbc.SQLBindCol(self.statement, column_number, odbc.SQL_C_WCHAR, None)
+        self._values = []
+        self._rowset = []
+        self._rowset_index = 0
+
+    def _bind(self, size: int) -> None:
+        # Bind every column to a list of size values, the rows are then read
+        # size at a time with SQLFetch instead of all at once, so memory use
+        # doesn't depend on the size of the results
+        column_count = odbc.SQLNumResultCols(self.statement)
+        if isinstance(column_count, odbc.ReturnCode):
+            raise odbc.DatabaseError({'C': column_count.value, 'M': "error executing the query"})
+        self.columns = [
+            odbc.SQLDescribeCol(self.statement, column_number).name
+            for column_number in range(1, column_count + 1)
+        ]
+        odbc.SQLSetStmtAttr(self.statement, odbc.SQL_ATTR_ROW_ARRAY_SIZE, size)
+        odbc.SQLSetStmtAttr(self.statement, odbc.SQL_ATTR_ROWS_FETCHED_PTR, self._rows_fetched)
+        self._nulls = [None] * size
+        self._values = [[None] * size for _ in range(column_count)]
+        for column_number, values in enumerate(self._values, start=1):
+            # an indicator array is needed for NULLs, they are left as None in values
+            odbc.SQLBindCol(self.statement, column_number, odbc.SQL_C_WCHAR, values, 0, [0] * size)
+
+    def _fetch_rowset(self) -> bool:
+        # Read the next rowset, False at the end of the results
+        if self._executed:
+            self._executed = False
+            self._bind(self.arraysize)
+        if not self._values:
+            return False
+        for values in self._values:
+            # NULLs aren't written to the bound lists
+            values[:] = self._nulls
+        return_code = odbc.SQLFetch(self.statement)
+        if return_code.code_name == "SQL_ERROR":
+            raise odbc.DatabaseError({'C': return_code.value, 'M': "error fetching the results"})
+        self._rowset = list(zip(*self._values))[:self._rows_fetched[0]]
+        self._rowset_index = 0
+        return len(self._rowset) > 0
+
+    def fetchone(self) -> Optional[tuple]:
+        if self._rowset_index == len(self._rowset) and not self._fetch_rowset():
+            return None
+        row = self._rowset[self._rowset_index]
+        self._rowset_index += 1
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[tuple]:
+        size = self.arraysize if size is None else size
+        rows = []
+        while len(rows) < size:
+            if self._rowset_index == len(self._rowset) and not self._fetch_rowset():
+                break
+            end = min(len(self._rowset), self._rowset_index + size - len(rows))
+            rows.extend(self._rowset[self._rowset_index:end])
+            self._rowset_index = end
+        return rows
+
     def fetchall(self) -> List[tuple]:
-        columns, rows = odbc.SQLGetData(self.results_generator)
-        if columns != []:
-            self.columns = columns
+        if self._executed and not self._values:
+            # nothing has been fetched yet, read all of the results in one go
+            self._executed = False
+            columns, rows = odbc.SQLGetData(odbc.SQLFetch(self.statement))
+            if columns != []:
+                self.columns = columns
+            return rows
+        rows = self._rowset[self._rowset_index:]
+        self._rowset_index = len(self._rowset)
+        while self._fetch_rowset():
+            rows.extend(self._rowset)
+            self._rowset_index = len(self._rowset)
         return rows
 
+    def nextset(self) -> Optional[bool]:
+        # Move to the next set of results of a query with several statements,
+        # see odbc.SQLMoreResults. Returns None once all of them have been read
+        self._unbind()
+        self._executed = False
+        return_code = odbc.SQLMoreResults(self.statement)
+        if return_code.code_name == "SQL_NO_DATA":
+            return None
+        if return_code.code_name == "SQL_ERROR":
+            raise odbc.DatabaseError({'C': return_code.value, 'M': "error reading the next results"})
+        rowcount = odbc.SQLRowCount(self.statement)
+        if isinstance(rowcount, odbc.ReturnCode):
+            raise odbc.DatabaseError({'C': rowcount.value, 'M': "error reading the next results"})
+        self.rowcount = rowcount
+        # a statement without rows (ex: an INSERT) has no columns to fetch
+        column_count = odbc.SQLNumResultCols(self.statement)
+        if isinstance(column_count, odbc.ReturnCode):
+            raise odbc.DatabaseError({'C': column_count.value, 'M': "error reading the next results"})
+        self.columns = [
+            odbc.SQLDescribeCol(self.statement, column_number).name
+            for column_number in range(1, column_count + 1)
+        ]
+        self._executed = column_count > 0
+        return True
+
+    def __iter__(self) -> "Cursor":
+        return self
+
+    def __next__(self) -> tuple:
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
 
 class Connection:
-    def __init__(self, params:dict):
+    def __init__(self, params:dict, stats: Optional[StatsCollector] = None):
         self.params = params
         self.host = params['host']
         self.handle = odbc.ConnectionHandle()
+        # client side query statistics, see query_stats.StatsCollector
+        self.handle.stats = stats
+        # socket options (see simple_pg_protocol.SOCKET_PARAMETERS)
+        set_socket_options(self.handle.socket_options, params)
 
+        # host can be the directory of a Unix domain socket
+        host = f"[{params['host']}]" if ':' in params['host'] else params['host']
+        server_name = f"{host}:{params.get('port', 5432)}"
         odbc.SQLConnect(
             self.handle, 
-            params['host'],
-            len(params['host']),
+            server_name,
+            len(server_name),
             params['user'],
             len(params['user']),
             'none',
@@ -0,0 +1,605 @@
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from db_utils import pg_types
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+# Sans-IO state machine for the messages the server sends.
+# It doesn't read or write anything: frames (or raw bytes) go in and typed
+# events come out, so the sync socket path (simple_pg_protocol), asyncio
+# (async_pg_protocol), the ODBC layer and the tests all share the same
+# protocol logic, and the transports can change without touching it.
+#
+# machine = ProtocolMachine()
+# machine.receive_data(data) # bytes from any transport
+# for event in machine.events():
+#     if type(event) is DataRow:
+#         ...
+#
+# simple_pg_protocol frames the messages in its own ReadBuffer and passes
+# them to handle_message, see fetch_events.
+#
+# Each message is parsed once, by the handler for its tag byte in
+# MESSAGE_HANDLERS. Session state that arrives with the results
+# (Ready for Query, Parameter Status, Backend Key Data, notices and
+# notifications) is kept on the machine, whoever is reading the results.
+# Parse Complete, Bind Complete, Close Complete, No Data and Parameter
+# Description don't produce events.
+#
+# Where one set of results starts and ends (Row Description, Portal Suspended,
+# Command Complete, an error and the Ready for Query after it) is worked out
+# by ResultReader, every way of reading rows only supplies what it does with them.
+
+
+class DatabaseError(Exception):
+    # Raised when the server sends an ErrorResponse ('E')
+    def __init__(self, fields: dict) -> None:
+        self.fields = fields
+        self.severity = fields.get('S')
+        self.sqlstate = fields.get('C')
+        super().__init__(fields.get('M', 'Unknown error'))
+
+
+def _parse_error_response(message: memoryview) -> dict:
+    # https://www.postgresql.org/docs/current/protocol-error-fields.html
+    # Byte1('E') - Identifies the message as an error.
+    # Int32 - Length of message contents in bytes, including self.
+    # The message body consists of one or more identified fields, followed by a zero byte as a terminator.
+    # Each field is:
+    # Byte1 - A code identifying the field type (ex: 'S' severity, 'C' SQLSTATE code, 'M' message)
+    # String - The field value.
+    fields = {}
+    for part in bytes(message).split(b'\x00'):
+        if part:
+            fields[chr(part[0])] = part[1:].decode('utf-8', errors='replace')
+    return fields
+
+
+class ColumnDescription(NamedTuple):
+    # One field of a RowDescription message
+    name: str
+    table_oid: int
+    column_number: int
+    type_oid: int
+    type_size: int
+    type_modifier: int
+    format_code: int
+
+
+def _parse_column_descriptions(message: memoryview) -> List[ColumnDescription]:
+    # https://www.postgresql.org/docs/current/protocol-message-formats.html
+    # Byte1('T') - Identifies the message as a row description.
+    # Int32 - Length of message contents in bytes, including self.
+    # Int16 - Specifies the number of fields in a row (can be zero).
+
+    # Then, for each field, there is the following:
+    # String - The field name.
+    # Int32 - If the field can be identified as a column of a specific table, the object ID of the table; otherwise zero.
+    # Int16 - If the field can be identified as a column of a specific table, the attribute number of the column; otherwise zero.
+    # Int32 - The object ID of the field's data type.
+    # Int16 -The data type size (see pg_type.typlen). Note that negative values denote variable-width types.
+    # Int32 - The type modifier (see pg_attribute.atttypmod). The meaning of the modifier is type-specific.
+    # Int16 - The format code being used for the field. Currently will be zero (text) or one (binary). In a RowDescription returned from the statement variant of Describe, the format code is not yet known and will always be zero.
+    message = bytes(message) # small message, copy once so we can use find
+    _logger.debug("Row Description Raw: %r", message)
+    idx = 2
+    num_fields = int.from_bytes(message[0:idx], 'big')
+    # each field takes at least 19 bytes (an empty name and the fixed size part),
+    # just to catch some simple parsing errors, postgres allows up to 1664 columns
+    if idx + num_fields * 19 > len(message):
+        raise ValueError("Number of fields is past the end of the row description")
+
+    columns = []
+    for field in range(num_fields):
+        # Field name (null-terminated string)
+        field_name_end = message.find(b'\x00', idx)
+        field_name = message[idx:field_name_end].decode('utf-8')
+
+        idx = field_name_end + 1
+        # table OID (4 bytes),
+        # column attribute number (2 bytes)
+        # field data type OID (4 bytes)
+        # data type size (2 bytes)
+        # type modifier (4 bytes)
+        # format code (2 bytes)
+        columns.append(ColumnDescription(
+            field_name,
+            int.from_bytes(message[idx:idx+4], 'big'),
+            int.from_bytes(message[idx+4:idx+6], 'big'),
+            int.from_bytes(message[idx+6:idx+10], 'big'),
+            int.from_bytes(message[idx+10:idx+12], 'big', signed=True),
+            int.from_bytes(message[idx+12:idx+16], 'big', signed=True),
+            int.from_bytes(message[idx+16:idx+18], 'big'),
+        ))
+        idx += 4 + 2 + 4 + 2 + 4 + 2
+
+    return columns
+
+
+def _parse_row_description(message: memoryview) -> list:
+    return [column.name for column in _parse_column_descriptions(message)]
+
+def _parse_data_row(message: memoryview, decoders: Optional[List[pg_types.Decoder]] = None) -> tuple:
+    # https://www.postgresql.org/docs/current/protocol-message-formats.html
+    # Byte1('D') - Identifies the message as a data row.
+    # Int32 - Length of message contents in bytes, including self..
+    # Int16 - The number of column values that follow (possibly zero).
+    
+    # Then, for each column, there is the following:
+    # Int32 - The length of the column value, in bytes (this count does not include itself). Can be zero. As a special case, -1 indicates a NULL column value. No value bytes follow in the NULL case.
+    # Byten - The value of the column, in the format indicated by the associated format code. n is the above length.
+
+    # no logging here, this runs for every row
+    idx = 2
+    num_col_values = int.from_bytes(message[0:idx], 'big')
+
+    row = []
+    for row_num in range(num_col_values):
+        # Field length (4 bytes)
+        # signed, NULL is sent as -1
+        field_length = int.from_bytes(message[idx:idx+4], 'big', signed=True)
+        idx += 4
+        if idx + field_length > len(message):
+            # just to catch some simple parsing errors, values can be any size
+            raise ValueError("Field length is past the end of the row")
+        
+        if field_length == -1:
+            row.append(None)
+            continue
+        
+        if decoders is None:
+            value = str(message[idx:idx+field_length], 'utf-8')
+        else:
+            # binary results are decoded based on the column type
+            value = decoders[row_num](message[idx:idx+field_length])
+        row.append(value)
+        idx += field_length
+
+    return tuple(row)
+
+def parse_message(message: memoryview) -> Tuple[str, int, memoryview]:
+
+    message_type = chr(message[0])
+    message_length = int.from_bytes(message[1:5], 'big')
+    message_body = message[5:]
+
+    _logger.debug("Message Type: %s Length: %d", message_type, message_length)
+
+    return message_type, message_length, message_body
+
+# Events, one per message type
+
+class Authentication(NamedTuple):
+    # 0 for Authentication Ok
+    auth_type: int
+    data: bytes
+
+
+class ParameterStatus(NamedTuple):
+    name: str
+    value: str
+
+
+class BackendKeyData(NamedTuple):
+    backend_pid: int
+    secret_key: bytes
+
+
+class RowDescription(NamedTuple):
+    columns: List[ColumnDescription]
+
+
+class DataRow(NamedTuple):
+    # The whole message (tag and length included), a view into the reader's
+    # buffer that is only valid until the next message is read
+    message: memoryview
+
+    @property
+    def body(self) -> memoryview:
+        return self.message[5:]
+
+
+class CommandComplete(NamedTuple):
+    # the command tag, ex: 'SELECT 5', 'INSERT 0 10'
+    tag: str
+
+    @property
+    def rowcount(self) -> int:
+        # tags end with the row count, -1 for commands without one (ex: 'CREATE TABLE')
+        count = self.tag.rsplit(' ', 1)[-1]
+        return int(count) if count.isdigit() else -1
+
+
+class EmptyQueryResponse(NamedTuple):
+    pass
+
+
+class PortalSuspended(NamedTuple):
+    pass
+
+
+class ReadyForQuery(NamedTuple):
+    # 'I' idle, 'T' in a transaction block, 'E' in a failed transaction block
+    transaction_status: str
+
+
+class ErrorResponse(NamedTuple):
+    error: DatabaseError
+
+
+class NoticeResponse(NamedTuple):
+    # same fields as an error, ex: {'S': 'WARNING', 'C': '01000', 'M': ...}
+    fields: dict
+
+
+class NotificationResponse(NamedTuple):
+    # from LISTEN / NOTIFY
+    backend_pid: int
+    channel: str
+    payload: str
+
+
+class CopyInResponse(NamedTuple):
+    # 0 for text, 1 for binary
+    format_code: int
+
+
+class CopyOutResponse(NamedTuple):
+    format_code: int
+
+
+class CopyData(NamedTuple):
+    # a view into the reader's buffer, like DataRow
+    data: memoryview
+
+
+class CopyDone(NamedTuple):
+    pass
+
+
+# the events without fields are the same object every time
+_EMPTY_QUERY = EmptyQueryResponse()
+_PORTAL_SUSPENDED = PortalSuspended()
+_COPY_DONE = CopyDone()
+
+
+def _split_strings(body: memoryview) -> List[str]:
+    return [part.decode('utf-8') for part in bytes(body).split(b'\x00')]
+
+
+# Handlers, they update the machine's state and return the event (or None)
+
+def _authentication(machine: "ProtocolMachine", message: memoryview) -> Authentication:
+    # Int32 - the authentication type, then type specific data
+    return Authentication(int.from_bytes(message[5:9], 'big'), bytes(message[9:]))
+
+
+def _parameter_status(machine: "ProtocolMachine", message: memoryview) -> ParameterStatus:
+    # String name | String value
+    # Sent at startup and whenever a reported setting changes (ex: SET application_name)
+    name, value, _ = _split_strings(message[5:])
+    machine.server_parameters[name] = value
+    return ParameterStatus(name, value)
+
+
+def _backend_key_data(machine: "ProtocolMachine", message: memoryview) -> BackendKeyData:
+    # Int32 - The process ID of this backend.
+    # Byten - The secret key of this backend (Int32 before protocol 3.2)
+    machine.backend_pid = int.from_bytes(message[5:9], 'big')
+    machine.secret_key = bytes(message[9:])
+    return BackendKeyData(machine.backend_pid, machine.secret_key)
+
+
+def _row_description(machine: "ProtocolMachine", message: memoryview) -> RowDescription:
+    machine.rowcount = -1
+    return RowDescription(_parse_column_descriptions(message[5:]))
+
+
+def _data_row(machine: "ProtocolMachine", message: memoryview) -> DataRow:
+    # decoded by the reader, which knows how it wants the values (tuples, columns, ...)
+    return DataRow(message)
+
+
+def _command_complete(machine: "ProtocolMachine", message: memoryview) -> CommandComplete:
+    # String - the command tag
+    machine.completed_results += 1
+    event = CommandComplete(str(message[5:-1], 'utf-8'))
+    machine.rowcount = event.rowcount
+    return event
+
+
+def _empty_query_response(machine: "ProtocolMachine", message: memoryview) -> EmptyQueryResponse:
+    machine.completed_results += 1
+    machine.rowcount = -1
+    return _EMPTY_QUERY
+
+
+def _portal_suspended(machine: "ProtocolMachine", message: memoryview) -> PortalSuspended:
+    return _PORTAL_SUSPENDED
+
+
+def _ready_for_query(machine: "ProtocolMachine", message: memoryview) -> ReadyForQuery:
+    # Byte1 - the transaction status
+    machine.pending_results = max(machine.pending_results - 1, 0)
+    machine.transaction_status = chr(message[5])
+    return ReadyForQuery(machine.transaction_status)
+
+
+def _error_response(machine: "ProtocolMachine", message: memoryview) -> ErrorResponse:
+    # ends the current set of results, and the rest of the query
+    machine.completed_results += 1
+    machine.rowcount = -1
+    return ErrorResponse(DatabaseError(_parse_error_response(message[5:])))
+
+
+def _notice_response(machine: "ProtocolMachine", message: memoryview) -> NoticeResponse:
+    # same format as an Error Response
+    fields = _parse_error_response(message[5:])
+    _logger.info("Notice Response: %s %s", fields.get('S'), fields.get('M'))
+    machine.notices.append(fields)
+    return NoticeResponse(fields)
+
+
+def _notification_response(machine: "ProtocolMachine", message: memoryview) -> NotificationResponse:
+    # Int32 - The process ID of the notifying backend process.
+    # String - The name of the channel.
+    # String - The payload string.
+    channel, payload, _ = _split_strings(message[9:])
+    event = NotificationResponse(int.from_bytes(message[5:9], 'big'), channel, payload)
+    machine.notifications.append(event)
+    return event
+
+
+def _copy_in_response(machine: "ProtocolMachine", message: memoryview) -> CopyInResponse:
+    # Int8 - overall format, then the column formats
+    return CopyInResponse(message[5])
+
+
+def _copy_out_response(machine: "ProtocolMachine", message: memoryview) -> CopyOutResponse:
+    return CopyOutResponse(message[5])
+
+
+def _copy_data(machine: "ProtocolMachine", message: memoryview) -> CopyData:
+    return CopyData(message[5:])
+
+
+def _copy_done(machine: "ProtocolMachine", message: memoryview) -> CopyDone:
+    return _COPY_DONE
+
+
+def _no_event(machine: "ProtocolMachine", message: memoryview) -> None:
+    return None
+
+
+# tag byte: handler
+MESSAGE_HANDLERS: Dict[int, Callable[["ProtocolMachine", memoryview], object]] = {
+    ord('R'): _authentication,
+    ord('S'): _parameter_status,
+    ord('K'): _backend_key_data,
+    ord('T'): _row_description,
+    ord('D'): _data_row,
+    ord('C'): _command_complete,
+    ord('I'): _empty_query_response,
+    ord('s'): _portal_suspended,
+    ord('Z'): _ready_for_query,
+    ord('E'): _error_response,
+    ord('N'): _notice_response,
+    ord('A'): _notification_response,
+    ord('G'): _copy_in_response,
+    ord('H'): _copy_out_response,
+    ord('d'): _copy_data,
+    ord('c'): _copy_done,
+    ord('1'): _no_event, # Parse Complete
+    ord('2'): _no_event, # Bind Complete
+    ord('3'): _no_event, # Close Complete
+    ord('n'): _no_event, # No Data
+    ord('t'): _no_event, # Parameter Description
+    ord('v'): _no_event, # Negotiate Protocol Version
+}
+
+
+class ProtocolMachine:
+    # The state of one connection, as far as the messages from the server go
+    # keep at most this many notices
+    MAX_NOTICES = 50
+
+    def __init__(self) -> None:
+        # Number of Ready for Query ('Z') messages the server still owes us,
+        # one for every simple query or Sync that was sent (see queries_sent)
+        self.pending_results = 0
+        # Transaction status from the last Ready for Query:
+        # 'I' idle, 'T' in a transaction block, 'E' in a failed transaction block
+        self.transaction_status = 'I'
+        # Sets of results that have ended (Command Complete, Empty Query Response
+        # or Error Response), a query with several statements has one set each.
+        # Readers compare it with the count when their set started to tell
+        # whether it has been read to the end.
+        self.completed_results = 0
+        # Row count from the Command Complete of the last set of results that ended,
+        # -1 while a set with rows is being read or if the command has none
+        self.rowcount = -1
+        # ParameterStatus values sent by the server, ex: {'server_version': '16.2', ...}
+        self.server_parameters: Dict[str, str] = {}
+        # Backend Key Data, needed to cancel a query
+        self.backend_pid: Optional[int] = None
+        self.secret_key: Optional[bytes] = None
+        # the fields of the last notices (ex: warnings), oldest first
+        self.notices: Deque[dict] = deque(maxlen=self.MAX_NOTICES)
+        # LISTEN / NOTIFY notifications that haven't been taken yet
+        self.notifications: List[NotificationResponse] = []
+        # bytes from receive_data that haven't been turned into events yet
+        self._buffer = bytearray()
+        self._start = 0
+
+    def queries_sent(self, count: int = 1) -> None:
+        # count simple queries or Syncs were sent, each one ends with a Ready for Query
+        self.pending_results += count
+
+    def handle_message(self, message: memoryview) -> Optional[object]:
+        # One complete message (tag | int32 len | payload) in, its event out,
+        # None for messages that don't produce one
+        handler = MESSAGE_HANDLERS.get(message[0])
+        if handler is None:
+            _logger.warning(f"Unexpected message type {chr(message[0])!r}")
+            return None
+        return handler(self, message)
+
+    def receive_data(self, data: bytes) -> None:
+        # Bytes in, as they arrive. They don't have to line up with messages
+        if self._start:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+    def next_event(self) -> Optional[object]:
+        # The next event from the received bytes, None if more bytes are needed
+        buffer = self._buffer
+        while len(buffer) - self._start >= 5:
+            start = self._start
+            # length includes itself (4 bytes) but not the tag
+            end = start + 1 + int.from_bytes(buffer[start + 1:start + 5], 'big')
+            if len(buffer) < end:
+                return None
+            self._start = end
+            # copied, so the event stays valid when more bytes are received
+            event = self.handle_message(memoryview(bytes(buffer[start:end])))
+            if event is not None:
+                return event
+        return None
+
+    def events(self) -> Iterator[object]:
+        # all of the events that can be made from the bytes received so far
+        while True:
+            event = self.next_event()
+            if event is None:
+                return
+            yield event
+
+
+class ResultReader:
+    # One set of results read from the events of a ProtocolMachine, whatever the
+    # transport: feed it events until feed returns True (see
+    # simple_pg_protocol.read_result and async_pg_protocol.read_result).
+    # Readers only supply what they do with the rows: add_row(event) is called
+    # for each Data Row (or Copy Data) and describe(columns) for the Row Description.
+    #
+    # reader = ResultReader(rows.add_row, rows.describe, size=100)
+    # for event in events:
+    #     if reader.feed(event):
+    #         break
+    #
+    # Once done, status is the tag of the message the reader stopped at:
+    # 'D' - size rows were read, there may be more
+    #       (size=0 stops at the Row Description, before any rows)
+    # 's' - the portal is suspended
+    # 'C' - the set has ended (Command Complete, Empty Query Response or Ready for Query)
+    # 'G' - Copy In Response, the server waits for Copy Data
+    # 'H' - Copy Out Response, the Copy Data follows
+    # 'c' - Copy Done
+    # and end is that event.
+    # An Error Response ends the whole query. It is raised by feed once the
+    # Ready for Query after it arrives, so the connection can be reused
+    # (the transport sends the Sync the server waits for, if one is owed).
+    def __init__(
+            self,
+            add_row: Optional[Callable[[object], None]] = None,
+            describe: Optional[Callable[[List[ColumnDescription]], None]] = None,
+            size: int = -1,
+            description: Optional[list] = None,
+            skip_ready: bool = False
+    ) -> None:
+        self.add_row = add_row
+        self.describe = describe
+        # rows to read, all of them if negative
+        self.size = size
+        # filled with the ColumnDescription of each column, if given
+        self.description = description
+        # a Ready for Query before anything else is left from the
+        # last query and skipped, instead of ending the results
+        self.skip_ready = skip_ready
+        # column names, once a Row Description has been read
+        self.columns: List[str] = []
+        self.count = 0
+        self.status: Optional[str] = None
+        self.end: Optional[object] = None
+        self.error: Optional[DatabaseError] = None
+        self._started = False
+
+    def feed(self, event: object) -> bool:
+        # True once the reader is done with the results
+        kind = type(event)
+        if self.error is not None:
+            # the server skips the rest of the query after an error
+            if kind is ReadyForQuery:
+                self._finish("C", event)
+                raise self.error
+            return False
+
+        if kind is DataRow or kind is CopyData:
+            if self.add_row is not None:
+                self.add_row(event)
+            self.count += 1
+            if self.count == self.size:
+                self._finish("D", event)
+
+        elif kind is RowDescription:
+            self.columns = [column.name for column in event.columns]
+            if self.description is not None:
+                self.description[:] = event.columns
+            if self.describe is not None:
+                self.describe(event.columns)
+            if self.size == 0:
+                self._finish("D", event)
+
+        elif kind is PortalSuspended:
+            self._finish("s", event)
+
+        elif kind is CommandComplete or kind is EmptyQueryResponse:
+            self._finish("C", event)
+
+        elif kind is ReadyForQuery:
+            if self._started or not self.skip_ready:
+                self._finish("C", event)
+
+        elif kind is ErrorResponse:
+            _logger.error(f"Error Response: {event.error.fields}")
+            self.error = event.error
+
+        elif kind is CopyInResponse:
+            self._finish("G", event)
+
+        elif kind is CopyOutResponse:
+            self._finish("H", event)
+
+        elif kind is CopyDone:
+            self._finish("c", event)
+
+        # anything else (ex: notices) comes between the results
+        self._started = self._started or kind is not ReadyForQuery
+        return self.status is not None
+
+    def _finish(self, status: str, event: object) -> None:
+        self.status = status
+        self.end = event
+
+
+class DecodedRows:
+    # The row sink of get_data, get_many and get_row (sync and async):
+    # each Data Row decoded to a tuple, see pg_types.row_decoders.
+    # description is the one of the current results if it was already read
+    def __init__(
+            self,
+            description: Optional[List[ColumnDescription]] = None,
+            type_catalog: Optional[pg_types.TypeCatalog] = None
+    ) -> None:
+        self.rows: List[tuple] = []
+        self.type_catalog = type_catalog
+        self.decoders = pg_types.row_decoders(description, type_catalog) if description else None
+
+    def describe(self, columns: List[ColumnDescription]) -> None:
+        self.decoders = pg_types.row_decoders(columns, self.type_catalog)
+
+    def add_row(self, event: DataRow) -> None:
+        self.rows.append(_parse_data_row(event.body, self.decoders))
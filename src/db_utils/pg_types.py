@@ -0,0 +1,611 @@
+import struct
+from uuid import UUID
+from decimal import Decimal
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# Type OIDs from pg_type (these are fixed for the built in types)
+# https://github.com/postgres/postgres/blob/master/src/include/catalog/pg_type.dat
+BOOL_OID = 16
+BYTEA_OID = 17
+CHAR_OID = 18
+NAME_OID = 19
+INT8_OID = 20
+INT2_OID = 21
+INT4_OID = 23
+TEXT_OID = 25
+OID_OID = 26
+JSON_OID = 114
+FLOAT4_OID = 700
+FLOAT8_OID = 701
+BPCHAR_OID = 1042
+VARCHAR_OID = 1043
+DATE_OID = 1082
+TIMESTAMP_OID = 1114
+TIMESTAMPTZ_OID = 1184
+NUMERIC_OID = 1700
+UUID_OID = 2950
+JSONB_OID = 3802
+
+# Format codes used in Bind and RowDescription messages
+TEXT_FORMAT = 0
+BINARY_FORMAT = 1
+
+Decoder = Callable[[memoryview], object]
+Converter = Callable[[str], object]
+
+# Binary dates and timestamps are relative to 2000-01-01
+_PG_EPOCH_DATE = date(2000, 1, 1)
+_PG_EPOCH_DATETIME = datetime(2000, 1, 1)
+_PG_EPOCH_DATETIME_UTC = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# 'infinity' and '-infinity' are sent as the max/min values of the int
+_DATE_INFINITY = 0x7FFFFFFF
+_DATE_NEG_INFINITY = -0x80000000
+_TIMESTAMP_INFINITY = 0x7FFFFFFFFFFFFFFF
+_TIMESTAMP_NEG_INFINITY = -0x8000000000000000
+
+# numeric sign flags
+_NUMERIC_NEG = 0x4000
+_NUMERIC_NAN = 0xC000
+_NUMERIC_PINF = 0xD000
+_NUMERIC_NINF = 0xF000
+
+_unpack_float4 = struct.Struct('!f').unpack
+_unpack_float8 = struct.Struct('!d').unpack
+_unpack_numeric_header = struct.Struct('!hhHH').unpack_from
+
+
+def decode_text(data: memoryview) -> str:
+    return str(data, 'utf-8')
+
+
+def decode_bytes(data: memoryview) -> bytes:
+    return bytes(data)
+
+
+def decode_int(data: memoryview) -> int:
+    # int2, int4 and int8 only differ in their width
+    return int.from_bytes(data, 'big', signed=True)
+
+
+def decode_oid(data: memoryview) -> int:
+    return int.from_bytes(data, 'big')
+
+
+def decode_float4(data: memoryview) -> float:
+    return _unpack_float4(data)[0]
+
+
+def decode_float8(data: memoryview) -> float:
+    return _unpack_float8(data)[0]
+
+
+def decode_bool(data: memoryview) -> bool:
+    return data[0] != 0
+
+
+def decode_uuid(data: memoryview) -> UUID:
+    return UUID(bytes=bytes(data))
+
+
+def decode_jsonb(data: memoryview) -> str:
+    # first byte is the jsonb format version (currently always 1)
+    return str(data[1:], 'utf-8')
+
+
+def decode_date(data: memoryview) -> date:
+    # Int32 - days since 2000-01-01
+    days = int.from_bytes(data, 'big', signed=True)
+    if days == _DATE_INFINITY:
+        return date.max
+    if days == _DATE_NEG_INFINITY:
+        return date.min
+    return _PG_EPOCH_DATE + timedelta(days=days)
+
+
+def decode_timestamp(data: memoryview) -> datetime:
+    # Int64 - microseconds since 2000-01-01 00:00:00
+    micros = int.from_bytes(data, 'big', signed=True)
+    if micros == _TIMESTAMP_INFINITY:
+        return datetime.max
+    if micros == _TIMESTAMP_NEG_INFINITY:
+        return datetime.min
+    return _PG_EPOCH_DATETIME + timedelta(microseconds=micros)
+
+
+def decode_timestamptz(data: memoryview) -> datetime:
+    # Same as timestamp, but the value is always in UTC
+    micros = int.from_bytes(data, 'big', signed=True)
+    if micros == _TIMESTAMP_INFINITY:
+        return datetime.max.replace(tzinfo=timezone.utc)
+    if micros == _TIMESTAMP_NEG_INFINITY:
+        return datetime.min.replace(tzinfo=timezone.utc)
+    return _PG_EPOCH_DATETIME_UTC + timedelta(microseconds=micros)
+
+
+def decode_numeric(data: memoryview) -> Decimal:
+    # Int16 - number of base 10000 digits
+    # Int16 - weight of the first digit (power of 10000)
+    # Int16 - sign (0x0000 positive, 0x4000 negative, 0xC000 NaN, 0xD000/0xF000 +/-infinity)
+    # Int16 - display scale (number of decimal digits after the point)
+    # Int16[] - the base 10000 digits
+    num_digits, weight, sign, scale = _unpack_numeric_header(data)
+    if sign == _NUMERIC_NAN:
+        return Decimal('NaN')
+    if sign == _NUMERIC_PINF:
+        return Decimal('Infinity')
+    if sign == _NUMERIC_NINF:
+        return Decimal('-Infinity')
+
+    digits = ''.join(['%04d' % digit for digit in struct.unpack_from(f'!{num_digits}H', data, 8)])
+
+    # digits currently represent an integer with this power of 10
+    exponent = (weight - num_digits + 1) * 4
+    # pad or trim the digits so the exponent matches the display scale
+    shift = exponent + scale
+    if shift >= 0:
+        digits += '0' * shift
+    else:
+        digits = digits[:shift]
+
+    return Decimal((1 if sign == _NUMERIC_NEG else 0, tuple(map(int, digits or '0')), -scale))
+
+
+BINARY_DECODERS = {
+    BOOL_OID: decode_bool,
+    BYTEA_OID: decode_bytes,
+    CHAR_OID: decode_text,
+    NAME_OID: decode_text,
+    INT8_OID: decode_int,
+    INT2_OID: decode_int,
+    INT4_OID: decode_int,
+    TEXT_OID: decode_text,
+    OID_OID: decode_oid,
+    JSON_OID: decode_text,
+    FLOAT4_OID: decode_float4,
+    FLOAT8_OID: decode_float8,
+    BPCHAR_OID: decode_text,
+    VARCHAR_OID: decode_text,
+    DATE_OID: decode_date,
+    TIMESTAMP_OID: decode_timestamp,
+    TIMESTAMPTZ_OID: decode_timestamptz,
+    NUMERIC_OID: decode_numeric,
+    UUID_OID: decode_uuid,
+    JSONB_OID: decode_jsonb,
+}
+
+
+def get_binary_decoder(type_oid: int) -> Decoder:
+    # Types we don't know how to decode are returned as raw bytes
+    return BINARY_DECODERS.get(type_oid, decode_bytes)
+
+
+def row_decoders(columns: list, catalog: Optional["TypeCatalog"] = None) -> Optional[List[Decoder]]:
+    # Pick one decoder per column from the row description.
+    # Returns None if every column is in the text format,
+    # so the plain text path can be used.
+    # With a catalog, arrays, composites, enums and domains are decoded too.
+    if all(column.format_code == TEXT_FORMAT for column in columns):
+        return None
+
+    get_decoder = get_binary_decoder if catalog is None else catalog.binary_decoder
+    return [
+        get_decoder(column.type_oid) if column.format_code == BINARY_FORMAT else decode_text
+        for column in columns
+    ]
+
+
+# Text format converters
+# Rows read with the text format come back as str (None for NULL),
+# these turn the text representation of a type into a python object.
+
+def convert_bool(value: str) -> bool:
+    return value == 't'
+
+
+def convert_bytea(value: str) -> bytes:
+    # hex format: \x followed by two hex digits per byte
+    return bytes.fromhex(value[2:])
+
+
+def _convert_timezone(offset: str) -> timezone:
+    # +HH, +HH:MM or +HH:MM:SS
+    sign = -1 if offset[0] == '-' else 1
+    parts = offset[1:].split(':')
+    seconds = int(parts[0]) * 3600
+    if len(parts) > 1:
+        seconds += int(parts[1]) * 60
+    if len(parts) > 2:
+        seconds += int(parts[2])
+    return timezone(timedelta(seconds=sign * seconds))
+
+
+def convert_date(value: str) -> date:
+    # YYYY-MM-DD
+    if value == 'infinity':
+        return date.max
+    if value == '-infinity':
+        return date.min
+    return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+
+def convert_timestamp(value: str) -> datetime:
+    # YYYY-MM-DD HH:MM:SS[.ffffff][+HH[:MM[:SS]]]
+    # datetime.fromisoformat can't be used, before python 3.11 it doesn't
+    # accept postgres' variable length fractions and short utc offsets
+    if value == 'infinity':
+        return datetime.max
+    if value == '-infinity':
+        return datetime.min
+
+    tzinfo = None
+    time_part = value[11:]
+    offset_start = max(time_part.rfind('+'), time_part.rfind('-'))
+    if offset_start != -1:
+        tzinfo = _convert_timezone(time_part[offset_start:])
+        time_part = time_part[:offset_start]
+
+    microsecond = 0
+    if len(time_part) > 8:
+        # fraction is 1 to 6 digits after the '.'
+        microsecond = int(time_part[9:].ljust(6, '0'))
+
+    return datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(time_part[0:2]), int(time_part[3:5]), int(time_part[6:8]),
+        microsecond, tzinfo
+    )
+
+
+def convert_timestamptz(value: str) -> datetime:
+    if value == 'infinity':
+        return datetime.max.replace(tzinfo=timezone.utc)
+    if value == '-infinity':
+        return datetime.min.replace(tzinfo=timezone.utc)
+    return convert_timestamp(value)
+
+
+TEXT_CONVERTERS: Dict[int, Converter] = {
+    BOOL_OID: convert_bool,
+    BYTEA_OID: convert_bytea,
+    INT8_OID: int,
+    INT2_OID: int,
+    INT4_OID: int,
+    OID_OID: int,
+    FLOAT4_OID: float,
+    FLOAT8_OID: float,
+    DATE_OID: convert_date,
+    TIMESTAMP_OID: convert_timestamp,
+    TIMESTAMPTZ_OID: convert_timestamptz,
+    NUMERIC_OID: Decimal,
+    UUID_OID: UUID,
+}
+
+
+def register_converter(type_oid: int, converter: Converter) -> None:
+    # Add or replace the text converter used for a type
+    TEXT_CONVERTERS[type_oid] = converter
+
+
+def row_converters(columns: list, catalog: Optional["TypeCatalog"] = None) -> Optional[List[Optional[Converter]]]:
+    # One converter per text format column, None for columns that are
+    # already decoded (binary) or have no converter (text types).
+    # Returns None if there is nothing to convert.
+    get_converter = TEXT_CONVERTERS.get if catalog is None else catalog.text_converter
+    converters = [
+        get_converter(column.type_oid) if column.format_code == TEXT_FORMAT else None
+        for column in columns
+    ]
+    if not any(converters):
+        return None
+    return converters
+
+
+def convert_rows(rows: List[tuple], columns: list, catalog: Optional["TypeCatalog"] = None) -> List[tuple]:
+    # Convert a whole batch of text rows into python types.
+    # Works column by column so each converter is looked up once and
+    # applied with map instead of dispatching on the type for every cell.
+    converters = row_converters(columns, catalog)
+    if converters is None or not rows:
+        return rows
+
+    converted_columns = []
+    for converter, values in zip(converters, zip(*rows)):
+        if converter is None:
+            converted_columns.append(values)
+        elif None in values:
+            converted_columns.append([None if value is None else converter(value) for value in values])
+        else:
+            converted_columns.append(list(map(converter, values)))
+
+    return list(zip(*converted_columns))
+
+
+# Server type catalog
+# The built in types above have fixed OIDs, everything else (arrays, composite
+# types, enums, domains, extension types) is looked up in pg_type.
+# simple_pg_protocol.load_type_catalog loads it once per server.
+
+# pg_type.typtype
+TYPE_BASE = 'b'
+TYPE_COMPOSITE = 'c'
+TYPE_DOMAIN = 'd'
+TYPE_ENUM = 'e'
+# pg_type.typcategory
+CATEGORY_ARRAY = 'A'
+
+
+class TypeInfo(NamedTuple):
+    # One row of pg_type
+    oid: int
+    name: str # typname
+    kind: str # typtype, TYPE_*
+    category: str # typcategory, CATEGORY_ARRAY for arrays
+    element_oid: int # typelem, the element type of an array
+    delimiter: str # typdelim, separates array elements of this type in the text format
+    base_oid: int # typbasetype, the underlying type of a domain
+    field_oids: Tuple[int, ...] # attribute types of a composite type
+
+
+class TypeCatalog:
+    # Decoders and converters for the types of one server.
+    # They are built the first time a type is seen and kept.
+    def __init__(self, types: Iterable[TypeInfo] = (), server_version: str = '') -> None:
+        self.server_version = server_version
+        self.types: Dict[int, TypeInfo] = {info.oid: info for info in types}
+        self._decoders: Dict[int, Decoder] = {}
+        self._converters: Dict[int, Optional[Converter]] = {}
+
+    def binary_decoder(self, type_oid: int) -> Decoder:
+        decoder = BINARY_DECODERS.get(type_oid) or self._decoders.get(type_oid)
+        if decoder is None:
+            decoder = self._decoders[type_oid] = self._binary_decoder(type_oid)
+        return decoder
+
+    def _binary_decoder(self, type_oid: int) -> Decoder:
+        info = self.types.get(type_oid)
+        if info is None:
+            return decode_bytes
+        if info.category == CATEGORY_ARRAY:
+            return self._decode_binary_array
+        if info.kind == TYPE_COMPOSITE:
+            return self._decode_binary_composite
+        if info.kind == TYPE_DOMAIN:
+            return self.binary_decoder(info.base_oid)
+        if info.kind == TYPE_ENUM:
+            return decode_text
+        return decode_bytes
+
+    def text_converter(self, type_oid: int) -> Optional[Converter]:
+        if type_oid in TEXT_CONVERTERS:
+            return TEXT_CONVERTERS[type_oid]
+        if type_oid not in self._converters:
+            self._converters[type_oid] = self._text_converter(type_oid)
+        return self._converters[type_oid]
+
+    def _text_converter(self, type_oid: int) -> Optional[Converter]:
+        # None for types that stay as str (text, enums, unknown types)
+        info = self.types.get(type_oid)
+        if info is None:
+            return None
+        if info.category == CATEGORY_ARRAY:
+            element = self.types.get(info.element_oid)
+            delimiter = element.delimiter if element is not None else ','
+            element_converter = self.text_converter(info.element_oid)
+            return lambda value: parse_text_array(value, delimiter, element_converter)
+        if info.kind == TYPE_COMPOSITE:
+            field_converters = [self.text_converter(field_oid) for field_oid in info.field_oids]
+            return lambda value: parse_text_composite(value, field_converters)
+        if info.kind == TYPE_DOMAIN:
+            return self.text_converter(info.base_oid)
+        return None
+
+    def _decode_binary_array(self, data: memoryview) -> list:
+        # Int32 - number of dimensions
+        # Int32 - flags, 1 if there are NULLs
+        # Int32 - element type OID
+        # Int32, Int32 - size and lower bound of each dimension
+        # Then for each element: Int32 length (-1 for NULL) | Byten value
+        dimensions = int.from_bytes(data[0:4], 'big')
+        if dimensions == 0:
+            return []
+        decoder = self.binary_decoder(int.from_bytes(data[8:12], 'big'))
+        sizes = [int.from_bytes(data[12 + 8 * i:16 + 8 * i], 'big') for i in range(dimensions)]
+
+        idx = 12 + 8 * dimensions
+        values = []
+        for _ in range(_product(sizes)):
+            length = int.from_bytes(data[idx:idx + 4], 'big', signed=True)
+            idx += 4
+            if length == -1:
+                values.append(None)
+            else:
+                values.append(decoder(data[idx:idx + length]))
+                idx += length
+        # nest the flat list of values, last dimension first
+        for size in reversed(sizes[1:]):
+            values = [values[i:i + size] for i in range(0, len(values), size)]
+        return values
+
+    def _decode_binary_composite(self, data: memoryview) -> tuple:
+        # Int32 - number of fields
+        # Then for each field: Int32 type OID | Int32 length (-1 for NULL) | Byten value
+        values = []
+        idx = 4
+        for _ in range(int.from_bytes(data[0:4], 'big')):
+            type_oid = int.from_bytes(data[idx:idx + 4], 'big')
+            length = int.from_bytes(data[idx + 4:idx + 8], 'big', signed=True)
+            idx += 8
+            if length == -1:
+                values.append(None)
+            else:
+                values.append(self.binary_decoder(type_oid)(data[idx:idx + length]))
+                idx += length
+        return tuple(values)
+
+    def to_dict(self) -> dict:
+        # JSON serializable, see from_dict
+        return {
+            'server_version': self.server_version,
+            'types': [list(info) for info in self.types.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TypeCatalog":
+        types = (
+            TypeInfo(oid, name, kind, category, element_oid, delimiter, base_oid, tuple(field_oids))
+            for oid, name, kind, category, element_oid, delimiter, base_oid, field_oids in data['types']
+        )
+        return cls(types, data['server_version'])
+
+
+def _product(sizes: List[int]) -> int:
+    total = 1
+    for size in sizes:
+        total *= size
+    return total
+
+
+def _read_text_element(value: str, idx: int, end_chars: str) -> Tuple[Optional[str], int]:
+    # Read one element of a text array or composite starting at idx.
+    # Quoted elements can contain anything, with \ escapes (and "" in composites).
+    # Returns the element (None if it was empty and unquoted) and the index after it
+    if idx < len(value) and value[idx] == '"':
+        chars = []
+        idx += 1
+        while True:
+            char = value[idx]
+            if char == '\\':
+                chars.append(value[idx + 1])
+                idx += 2
+            elif char == '"':
+                if value[idx + 1:idx + 2] == '"':
+                    chars.append('"')
+                    idx += 2
+                else:
+                    return ''.join(chars), idx + 1
+            else:
+                chars.append(char)
+                idx += 1
+
+    start = idx
+    chars = []
+    while idx < len(value) and value[idx] not in end_chars:
+        if value[idx] == '\\':
+            chars.append(value[start:idx])
+            idx += 1
+            start = idx
+        idx += 1
+    chars.append(value[start:idx])
+    element = ''.join(chars)
+    return (element if element or idx > start else None), idx
+
+
+def parse_text_array(value: str, delimiter: str = ',', converter: Optional[Converter] = None) -> list:
+    # Text format array, ex: '{1,2,NULL}', '{{a,"b c"},{d,e}}'
+    # or with the bounds when they don't start at 1: '[0:1]={1,2}'
+    if value[0] == '[':
+        value = value[value.index('=') + 1:]
+
+    stack = [[]]
+    idx = 1 # skip the outer '{'
+    end_chars = delimiter + '}'
+    while idx < len(value):
+        char = value[idx]
+        if char == '{':
+            stack.append([])
+            idx += 1
+        elif char == '}':
+            finished = stack.pop()
+            if not stack:
+                return finished
+            stack[-1].append(finished)
+            idx += 1
+        elif char == delimiter:
+            idx += 1
+        else:
+            quoted = char == '"'
+            element, idx = _read_text_element(value, idx, end_chars)
+            if not quoted and element.upper() == 'NULL':
+                element = None
+            elif converter is not None:
+                element = converter(element)
+            stack[-1].append(element)
+    return stack[0]
+
+
+def parse_text_composite(value: str, converters: Sequence[Optional[Converter]] = ()) -> tuple:
+    # Text format composite (row) value, ex: '(1,"a b",)'
+    # an empty unquoted field is NULL
+    fields = []
+    idx = 1 # skip the '('
+    while idx < len(value):
+        element, idx = _read_text_element(value, idx, ',)')
+        if element is not None and len(fields) < len(converters) and converters[len(fields)] is not None:
+            element = converters[len(fields)](element)
+        fields.append(element)
+        idx += 1 # skip the ',' or ')'
+    return tuple(fields)
+
+
+def encode_parameter(value: object) -> Tuple[int, Optional[bytes]]:
+    # Encode a python value as a Bind parameter, returns (format code, value).
+    # Everything is sent in the text format and the server casts it to
+    # the parameter type, except for bytes which are sent as binary bytea.
+    if value is None:
+        return TEXT_FORMAT, None
+    if isinstance(value, bool):
+        return TEXT_FORMAT, b't' if value else b'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return BINARY_FORMAT, bytes(value)
+    if isinstance(value, (date, datetime)):
+        return TEXT_FORMAT, value.isoformat().encode('utf-8')
+    return TEXT_FORMAT, str(value).encode('utf-8')
+
+
+# COPY encoding
+# https://www.postgresql.org/docs/current/sql-copy.html
+
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_CSV_SPECIAL = (',', '"', '\n', '\r')
+
+
+def _copy_value(value: object) -> str:
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    return str(value)
+
+
+def _copy_text_value(value: object) -> str:
+    # text format: NULL is \N and backslash, tab, newline and
+    # carriage return are backslash escaped
+    if value is None:
+        return '\\N'
+    return _copy_value(value).translate(_COPY_TEXT_ESCAPES)
+
+
+def _copy_csv_value(value: object) -> str:
+    # csv format: NULL is an unquoted empty value, so empty strings
+    # (and anything with special characters) have to be quoted
+    if value is None:
+        return ''
+    value = _copy_value(value)
+    if value == '' or value == '\\.' or any(char in value for char in _CSV_SPECIAL):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def encode_copy_rows(rows: Iterable[Sequence], csv: bool = False) -> bytes:
+    # Encode a batch of rows for COPY FROM STDIN with one join and one
+    # utf-8 encode for the whole batch
+    if csv:
+        lines = [','.join(map(_copy_csv_value, row)) for row in rows]
+    else:
+        lines = ['\t'.join(map(_copy_text_value, row)) for row in rows]
+    if not lines:
+        return b''
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
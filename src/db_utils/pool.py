@@ -0,0 +1,305 @@
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from db_utils.pep_249 import Connection, connect
+from db_utils.query_stats import StatsCollector
+from db_utils.result_cache import ResultCache
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    # No connection became available within the timeout
+    pass
+
+
+class TooManyRequests(Exception):
+    # The wait queue is full
+    pass
+
+
+class PoolClosed(Exception):
+    pass
+
+
+@dataclass
+class _PooledConnection:
+    connection: Connection
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+def _is_alive(connection: Connection) -> bool:
+    # Check the socket without a round trip to the server.
+    # An idle connection should have nothing to read, if the socket is
+    # readable the server either closed it or sent an error (ex: it was terminated)
+    sock = connection.handle.sock
+    try:
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.settimeout(timeout)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class ConnectionPool:
+    # Thread safe pool of pep_249 connections.
+    #
+    # pool = ConnectionPool(params, min_size=2, max_size=10)
+    # with pool.connection() as conn:
+    #     cursor = conn.cursor()
+    #     cursor.execute(query)
+    #     rows = cursor.fetchall()
+    def __init__(
+            self,
+            params: dict,
+            min_size: int = 1,
+            max_size: int = 10,
+            timeout: float = 30.0, # seconds to wait for a connection
+            max_waiting: int = 0, # threads allowed to wait for a connection, 0 is unlimited
+            max_idle: float = 600.0, # seconds before idle connections above min_size are closed
+            max_lifetime: float = 3600.0, # seconds before a connection is replaced
+            check_query: Optional[str] = None, # optional query to run on checkout, ex: 'select 1'
+            reset_query: Optional[str] = 'RESET ALL', # run on checkin to reset the session
+            statement_cache_size: int = 100,
+            stats: Optional[StatsCollector] = None, # shared by all of the pool's connections
+            type_catalog: bool = False, # see pep_249.Connection
+            type_catalog_path: Optional[str] = None,
+            result_cache: Optional[ResultCache] = None # shared by all of the pool's connections
+    ) -> None:
+        if min_size > max_size:
+            raise ValueError("min_size can't be larger than max_size")
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_query = check_query
+        self.reset_query = reset_query
+        self.statement_cache_size = statement_cache_size
+        self.stats = stats
+        self.type_catalog = type_catalog
+        self.type_catalog_path = type_catalog_path
+        self.result_cache = result_cache
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle: List[_PooledConnection] = []
+        self._in_use: Dict[int, _PooledConnection] = {}
+        self._size = 0 # open connections + connections being opened
+        self._waiting = 0
+        self._closed = False
+
+        # metrics
+        self._checkouts = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._connections_opened = 0
+        self._connections_closed = 0
+        self._failed_checks = 0
+
+        self._prewarm()
+
+    def _prewarm(self) -> None:
+        with self._lock:
+            self._size += self.min_size
+        for _ in range(self.min_size):
+            try:
+                pooled = self._open()
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                raise
+            with self._lock:
+                self._idle.append(pooled)
+
+    def _open(self) -> _PooledConnection:
+        connection = connect(
+            self.params, self.statement_cache_size, self.stats, self.type_catalog, self.type_catalog_path,
+            self.result_cache
+        )
+        with self._lock:
+            self._connections_opened += 1
+        return _PooledConnection(connection)
+
+    def _close(self, pooled: _PooledConnection) -> None:
+        try:
+            pooled.connection.close()
+        except Exception as e:
+            _logger.debug(f"Error closing pooled connection: {e}")
+        with self._lock:
+            self._connections_closed += 1
+
+    def _expired(self, pooled: _PooledConnection, now: float) -> bool:
+        return now - pooled.created_at > self.max_lifetime
+
+    def _check(self, pooled: _PooledConnection) -> bool:
+        if self._expired(pooled, time.monotonic()):
+            return False
+        if not _is_alive(pooled.connection):
+            return False
+        if self.check_query:
+            try:
+                cursor = pooled.connection.cursor()
+                cursor.execute(self.check_query)
+                cursor.fetchall()
+            except Exception as e:
+                _logger.debug(f"Pooled connection failed check: {e}")
+                return False
+        return True
+
+    def _reset(self, connection: Connection) -> None:
+        # roll back anything left open and reset session settings
+        connection.rollback()
+        if self.reset_query:
+            cursor = connection.cursor()
+            cursor.execute(self.reset_query)
+            cursor.fetchall()
+
+    def _prune_idle(self, now: float) -> List[_PooledConnection]:
+        # called with the lock held, returns the connections to close
+        expired = []
+        keep = []
+        for pooled in self._idle:
+            too_old = self._expired(pooled, now)
+            too_idle = now - pooled.last_used > self.max_idle and self._size - len(expired) > self.min_size
+            if too_old or too_idle:
+                expired.append(pooled)
+            else:
+                keep.append(pooled)
+        self._idle = keep
+        self._size -= len(expired)
+        return expired
+
+    def getconn(self, timeout: Optional[float] = None) -> Connection:
+        start = time.monotonic()
+        deadline = start + (self.timeout if timeout is None else timeout)
+
+        while True:
+            pooled = None
+            with self._lock:
+                if self._closed:
+                    raise PoolClosed("Connection pool is closed")
+                to_close = self._prune_idle(time.monotonic())
+                if not self._idle and self._size >= self.max_size:
+                    if self.max_waiting and self._waiting >= self.max_waiting:
+                        raise TooManyRequests(f"{self._waiting} requests already waiting for a connection")
+                    self._waiting += 1
+                    try:
+                        while not self._idle and self._size >= self.max_size and not self._closed:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                self._timeouts += 1
+                                raise PoolTimeout(f"No connection available after {time.monotonic() - start:.3f} seconds")
+                            self._available.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                    if self._closed:
+                        raise PoolClosed("Connection pool is closed")
+
+                if self._idle:
+                    # most recently used first, it is the most likely to be healthy
+                    pooled = self._idle.pop()
+                else:
+                    self._size += 1
+
+            for expired in to_close:
+                self._close(expired)
+
+            if pooled is None:
+                try:
+                    pooled = self._open()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+            elif not self._check(pooled):
+                with self._lock:
+                    self._failed_checks += 1
+                    self._size -= 1
+                self._close(pooled)
+                continue
+
+            wait_time = time.monotonic() - start
+            with self._lock:
+                self._in_use[id(pooled.connection)] = pooled
+                self._checkouts += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+            return pooled.connection
+
+    def putconn(self, connection: Connection) -> None:
+        with self._lock:
+            pooled = self._in_use.pop(id(connection), None)
+        if pooled is None:
+            raise ValueError("Connection doesn't belong to this pool")
+
+        keep = not self._closed and not self._expired(pooled, time.monotonic())
+        if keep:
+            try:
+                self._reset(connection)
+            except Exception as e:
+                _logger.debug(f"Failed to reset pooled connection: {e}")
+                keep = False
+
+        if not keep:
+            with self._lock:
+                self._size -= 1
+                self._available.notify()
+            self._close(pooled)
+            return
+
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(pooled)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Connection]:
+        connection = self.getconn(timeout)
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._available.notify_all()
+        for pooled in idle:
+            self._close(pooled)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_avg': self._wait_time_total / self._checkouts if self._checkouts else 0.0,
+                'wait_time_max': self._wait_time_max,
+                'timeouts': self._timeouts,
+                'connections_opened': self._connections_opened,
+                'connections_closed': self._connections_closed,
+                'failed_checks': self._failed_checks,
+            }
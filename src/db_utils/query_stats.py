@@ -0,0 +1,286 @@
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Dict, Generator, List
+
+from db_utils.pg_machine import CommandComplete, DataRow, EmptyQueryResponse, ErrorResponse, ReadyForQuery
+from db_utils.sql_text import strip_literals
+
+# Client side query statistics, something like pg_stat_statements
+# but measured from the client.
+#
+# stats = StatsCollector()
+# conn = connect(params, stats=stats)
+# ...
+# stats.snapshot()
+# stats.write_prometheus("/var/lib/node_exporter/db_utils.prom")
+#
+# Queries are grouped by fingerprint, the query text with the literals
+# replaced by '?'. For each fingerprint there are counters for calls,
+# errors, rows and bytes received, plus histograms of:
+# ttfb - time from sending the query to receiving the first bytes of the results
+# latency - time from sending the query to reading the end of the results
+# decode_time - time spent parsing and converting the results (not waiting on the socket)
+
+
+# Histogram bucket upper bounds in seconds, 50us doubling up to ~100s
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(22))
+
+# fingerprints beyond this are counted under OTHER_FINGERPRINT
+MAX_FINGERPRINTS = 1000
+OTHER_FINGERPRINT = "<other>"
+
+
+_NUMBER = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+_PLACEHOLDER = re.compile(r"\$\d+")
+# IN lists and VALUES rows, other argument lists (ex: generate_series(?, ?)) are kept
+_VALUE_LIST = re.compile(r"(\b(?:in|values)\s*\(\s*|\)\s*,\s*\(\s*)\?(?:\s*,\s*\?)+(?=\s*\))", re.IGNORECASE)
+# several VALUES rows, ex: values (?), (?), (?)
+_VALUE_ROWS = re.compile(r"(\bvalues\s*\(\?\))(?:\s*,\s*\(\?\))+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(query: str) -> str:
+    # Normalize a query so the same statement with different values
+    # is counted together, ex:
+    # "select * from t where id = 1 and name in ('a', 'b');"
+    # "select * from t where id = ? and name in (?);"
+    # IN lists and VALUES rows are collapsed to one '?', so the number of
+    # values doesn't matter, function arguments are left as they are.
+    query = strip_literals(query, '?')
+    query = _PLACEHOLDER.sub('?', query)
+    query = _NUMBER.sub('?', query)
+    query = _VALUE_LIST.sub(r'\1?', query)
+    query = _VALUE_ROWS.sub(r'\1', query)
+    return _WHITESPACE.sub(' ', query).strip().rstrip(';').strip()
+
+
+class Histogram:
+    # Fixed bucket histogram, recording a value is a bisect and an increment.
+    # Percentiles are estimated by interpolating inside the bucket.
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self) -> None:
+        # one count per bucket, the last one is for values above BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / bucket_count
+                return min(estimate, self.max)
+            seen += bucket_count
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+        }
+
+
+class QueryStatistics:
+    __slots__ = ('calls', 'errors', 'rows', 'bytes_received', 'ttfb', 'latency', 'decode_time')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.bytes_received = 0
+        self.ttfb = Histogram()
+        self.latency = Histogram()
+        self.decode_time = Histogram()
+
+    def snapshot(self) -> dict:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'bytes_received': self.bytes_received,
+            'ttfb': self.ttfb.snapshot(),
+            'latency': self.latency.snapshot(),
+            'decode_time': self.decode_time.snapshot(),
+        }
+
+
+class QueryTimer:
+    # Measures one query, from just after it is sent until finish is called.
+    # The network side comes from the counters on the connection's ReadBuffer.
+    __slots__ = (
+        'collector', 'fingerprint', 'read_buffer', 'start',
+        'bytes_start', 'rows', 'decode_time', 'finished',
+    )
+
+    def __init__(self, collector: "StatsCollector", query: str, read_buffer) -> None:
+        self.collector = collector
+        self.fingerprint = fingerprint(query)
+        self.read_buffer = read_buffer
+        self.start = time.perf_counter()
+        self.bytes_start = read_buffer.bytes_received
+        read_buffer.first_receive = None
+        self.rows = 0
+        self.decode_time = 0.0
+        self.finished = False
+
+    def add_rows(self, rows: int, decode_time: float) -> None:
+        self.rows += rows
+        self.decode_time += decode_time
+
+    def finish(self, error: bool = False) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        end = time.perf_counter()
+        # results that were already buffered before the query started count as received at the end
+        first_receive = self.read_buffer.first_receive or end
+        self.collector.record(
+            self.fingerprint,
+            ttfb=max(first_receive - self.start, 0.0),
+            latency=end - self.start,
+            decode_time=self.decode_time,
+            rows=self.rows,
+            bytes_received=self.read_buffer.bytes_received - self.bytes_start,
+            error=error,
+        )
+
+
+def timed_events(
+        events: Generator[object, None, None],
+        timer: QueryTimer
+) -> Generator[object, None, None]:
+    # Wrap an event generator (simple_pg_protocol.fetch_events) to count the
+    # Data Rows of one set of results, and finish the timer at the end of them.
+    # Decode time is the time the caller spends between events.
+    rows = 0
+    client_time = 0.0
+    started = False
+    for event in events:
+        kind = type(event)
+        if kind is DataRow:
+            rows += 1
+        elif kind in (CommandComplete, ErrorResponse, EmptyQueryResponse) or (kind is ReadyForQuery and started):
+            timer.add_rows(rows, client_time)
+            timer.finish(error=kind is ErrorResponse)
+        # a Ready for Query before anything else is left from the last query
+        started = started or kind is not ReadyForQuery
+
+        yielded = time.perf_counter()
+        yield event
+        client_time += time.perf_counter() - yielded
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StatsCollector:
+    # Thread safe, one collector can be shared by several connections (ex: a pool)
+    def __init__(self, max_fingerprints: int = MAX_FINGERPRINTS) -> None:
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._queries: Dict[str, QueryStatistics] = {}
+
+    def start(self, query: str, read_buffer) -> QueryTimer:
+        return QueryTimer(self, query, read_buffer)
+
+    def record(
+            self,
+            query_fingerprint: str,
+            ttfb: float,
+            latency: float,
+            decode_time: float,
+            rows: int,
+            bytes_received: int,
+            error: bool = False
+    ) -> None:
+        with self._lock:
+            stats = self._queries.get(query_fingerprint)
+            if stats is None:
+                if len(self._queries) >= self.max_fingerprints:
+                    query_fingerprint = OTHER_FINGERPRINT
+                stats = self._queries.setdefault(query_fingerprint, QueryStatistics())
+            stats.calls += 1
+            stats.errors += error
+            stats.rows += rows
+            stats.bytes_received += bytes_received
+            stats.ttfb.record(ttfb)
+            stats.latency.record(latency)
+            stats.decode_time.record(decode_time)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._queries = {}
+
+    def snapshot(self) -> Dict[str, dict]:
+        # {fingerprint: {'calls': ..., 'latency': {'p50': ..., ...}, ...}}
+        with self._lock:
+            return {query: stats.snapshot() for query, stats in self._queries.items()}
+
+    def to_prometheus(self, prefix: str = "db_utils_query") -> str:
+        # Prometheus text exposition format
+        lines: List[str] = []
+        with self._lock:
+            queries = [(_escape_label(query), stats) for query, stats in self._queries.items()]
+
+            for name, attribute, help_text in (
+                ('calls_total', 'calls', "Queries run"),
+                ('errors_total', 'errors', "Queries that returned an error"),
+                ('rows_total', 'rows', "Rows received"),
+                ('bytes_received_total', 'bytes_received', "Bytes received"),
+            ):
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                for query, stats in queries:
+                    lines.append(f'{prefix}_{name}{{fingerprint="{query}"}} {getattr(stats, attribute)}')
+
+            for name, attribute, help_text in (
+                ('ttfb_seconds', 'ttfb', "Time to the first bytes of the results"),
+                ('latency_seconds', 'latency', "Time to the end of the results"),
+                ('decode_seconds', 'decode_time', "Time spent decoding the results"),
+            ):
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for query, stats in queries:
+                    histogram = getattr(stats, attribute)
+                    cumulative = 0
+                    for bound, bucket_count in zip(BUCKETS, histogram.counts):
+                        cumulative += bucket_count
+                        lines.append(f'{prefix}_{name}_bucket{{fingerprint="{query}",le="{bound:g}"}} {cumulative}')
+                    lines.append(f'{prefix}_{name}_bucket{{fingerprint="{query}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{prefix}_{name}_sum{{fingerprint="{query}"}} {histogram.sum}')
+                    lines.append(f'{prefix}_{name}_count{{fingerprint="{query}"}} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str, prefix: str = "db_utils_query") -> None:
+        # Write to a temporary file and rename it, so a scraper
+        # (ex: the node_exporter textfile collector) never reads a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            file.write(self.to_prometheus(prefix))
+        os.replace(temp_path, path)
@@ -0,0 +1,238 @@
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Set
+
+from db_utils.sql_text import is_single_statement, strip_literals
+
+# Client side cache of query results, for read only queries that are run
+# over and over (ex: dashboards).
+#
+# cache = ResultCache(max_bytes=64 * 1024 * 1024, ttl=60.0)
+# conn = connect(params, result_cache=cache)
+# cursor = conn.cursor()
+# cursor.execute("select * from orders where status = $1", ('open',))
+# rows = cursor.fetchall() # from the server, then from the cache for the next 60s
+# ...
+# cache.invalidate('orders') # after orders changed
+#
+# Entries are keyed on the query text and parameters (plus the cursor's
+# binary / convert_types settings) and tagged with the tables the query
+# reads from, or with the cache_tags given to execute.
+# The rows are stored pickled, which is compact and gives every
+# hit its own copy. The cache is bounded by the size of the pickled rows,
+# the least recently used entries are evicted first.
+#
+# Only SELECT / VALUES / TABLE / SHOW queries (and WITH queries that don't
+# modify data) are cached, and not inside a transaction block.
+# Queries with several statements aren't cached, an entry only holds one set of results.
+# SELECT ... INTO and queries calling the common volatile functions (nextval,
+# random, now, ...) aren't cached either. Other volatile functions (ex: your own)
+# aren't detected, run those queries on a cursor without a cache
+# (cursor.result_cache = None).
+# One cache can be shared by several connections (ex: a pool) to the same database.
+
+
+_FIRST_WORD = re.compile(r"\s*\(*\s*(\w+)")
+# keywords that make a WITH query (or SELECT ... FOR UPDATE) more than a read
+# (SELECT ... INTO creates a table)
+_WRITES = re.compile(r"\b(insert|update|delete|merge|into|for\s+(?:no\s+key\s+)?update|for\s+(?:key\s+)?share)\b", re.IGNORECASE)
+# common volatile functions, the same query gives different results (or has side effects) each time
+_VOLATILE = re.compile(
+    r"\b(nextval|setval|currval|lastval|random|gen_random_uuid|uuid_generate_v\d\w*|now|clock_timestamp|"
+    r"statement_timestamp|transaction_timestamp|timeofday|current_timestamp|current_time|localtimestamp|"
+    r"localtime|current_date|txid_current|pg_current_xact_id|pg_sleep)\b",
+    re.IGNORECASE
+)
+_READ_ONLY = {'select', 'values', 'table', 'show'}
+# table names after FROM / JOIN / TABLE, ex: orders, public.orders, "Orders"
+_TABLES = re.compile(r'\b(?:from|join|table)\s+((?:"[^"]+"|[\w$]+)(?:\s*\.\s*(?:"[^"]+"|[\w$]+))*)', re.IGNORECASE)
+
+
+def is_cacheable(query: str) -> bool:
+    if not is_single_statement(query):
+        return False
+    query = strip_literals(query)
+    match = _FIRST_WORD.match(query)
+    if match is None:
+        return False
+    first_word = match.group(1).lower()
+    if first_word not in _READ_ONLY and first_word != 'with':
+        return False
+    return _WRITES.search(query) is None and _VOLATILE.search(query) is None
+
+
+def _tag_name(name: str) -> str:
+    # quoted names keep their case, like in postgres
+    return name[1:-1] if name.startswith('"') else name.lower()
+
+
+def query_tables(query: str) -> Set[str]:
+    # The tables a query reads from, as tags.
+    # Schema qualified names are tagged with and without the schema,
+    # so invalidate('orders') also drops queries on public.orders
+    query = strip_literals(query)
+    tags = set()
+    for match in _TABLES.finditer(query):
+        parts = [_tag_name(part.strip()) for part in match.group(1).split('.')]
+        tags.add('.'.join(parts))
+        tags.add(parts[-1])
+    return tags
+
+
+class CachedResult(NamedTuple):
+    columns: List[str]
+    # simple_pg_protocol.ColumnDescription for each column
+    column_descriptions: list
+    # the pickled list of rows
+    data: bytes
+    row_count: int
+    expires: float
+    tags: frozenset
+
+    def rows(self) -> List[tuple]:
+        return pickle.loads(self.data)
+
+
+class ResultCache:
+    # Thread safe LRU cache of query results, bounded by bytes.
+    def __init__(
+            self,
+            max_bytes: int = 64 * 1024 * 1024,
+            ttl: float = 60.0, # seconds an entry is served for
+            max_entry_rows: int = 100000 # results with more rows aren't cached
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_rows = max_entry_rows
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, CachedResult]" = OrderedDict()
+        self._tags: Dict[str, Set[Hashable]] = {}
+        self._bytes = 0
+        # bumped by invalidate and clear, so results that were being read
+        # while their tables were invalidated aren't put in the cache afterwards
+        self.generation = 0
+
+        # metrics
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    @staticmethod
+    def key(query: str, parameters: Optional[Sequence], *settings: Hashable) -> Optional[Hashable]:
+        # None if the parameters can't be part of a key (ex: a list parameter)
+        key = (query, tuple(parameters) if parameters is not None else None, settings)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key: Hashable) -> Optional[CachedResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def put(
+            self,
+            key: Hashable,
+            columns: List[str],
+            column_descriptions: list,
+            rows: List[tuple],
+            tags: Iterable[str] = (),
+            generation: Optional[int] = None # self.generation from before the query was sent
+    ) -> bool:
+        # Returns False if the results weren't cached
+        if len(rows) > self.max_entry_rows:
+            return False
+        try:
+            data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return False
+        if len(data) > self.max_bytes:
+            return False
+        entry = CachedResult(
+            list(columns), list(column_descriptions), data, len(rows), time.monotonic() + self.ttl, frozenset(tags)
+        )
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(data)
+            for tag in entry.tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+        return True
+
+    def _remove(self, key: Hashable) -> None:
+        # the lock must be held
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.data)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, *tags: str) -> int:
+        # Drop the results tagged with any of tags (see query_tables),
+        # returns the number of entries dropped
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            self._invalidations += len(keys)
+            self.generation += 1
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+            self.generation += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
+
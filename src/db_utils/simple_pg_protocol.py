@@ -1,13 +1,305 @@
+import json
+import os
 import socket
-from typing import List, Tuple, Generator
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple, Generator, Optional, Sequence
 from dataclasses import dataclass, field
 
+from db_utils import pg_types
+from db_utils.pg_machine import (
+    Authentication,
+    ColumnDescription,
+    CommandComplete,
+    CopyData,
+    CopyDone,
+    CopyInResponse,
+    DatabaseError,
+    DataRow,
+    DecodedRows,
+    EmptyQueryResponse,
+    ErrorResponse,
+    PortalSuspended,
+    ProtocolMachine,
+    ReadyForQuery,
+    ResultReader,
+    RowDescription,
+    _parse_column_descriptions,
+    _parse_data_row,
+    _parse_error_response,
+    _parse_row_description,
+    parse_message,
+)
+from db_utils.query_stats import QueryTimer, StatsCollector
+
 from logging import getLogger
 _logger = getLogger(__name__)
 
+class ReadBuffer:
+    # Reusable receive buffer for backend messages.
+    # Instead of three small recv calls per message (tag, length, payload) we
+    # recv_into one large bytearray and hand out frames as memoryview slices.
+    # A frame is only valid until the next call to read_message, so callers
+    # that want to keep the data must copy it (ex: bytes(frame))
+    def __init__(self, size: int = 65536) -> None:
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # first unread byte
+        self._end = 0 # end of received data
+        # counters for query_stats
+        self.bytes_received = 0
+        self.receive_time = 0.0 # seconds spent waiting in recv
+        self.first_receive = None # perf_counter of the first recv since it was reset
+        # time.monotonic() by which the results have to arrive, see set_deadline
+        self.deadline: Optional[float] = None
+        self._timeout_set = False
+
+    def _fill(self, sock: socket.socket, num_bytes: int) -> None:
+        # make sure there are at least num_bytes unread bytes in the buffer
+        if self._end - self._start >= num_bytes:
+            return
+
+        if self._start + num_bytes > len(self._buf):
+            unread = self._end - self._start
+            if num_bytes > len(self._buf):
+                # Message larger than the buffer, allocate a bigger one.
+                # Frames handed out earlier keep a reference to the old buffer.
+                new_buf = bytearray(max(num_bytes, 2 * len(self._buf)))
+                new_buf[:unread] = self._view[self._start:self._end]
+                self._buf = new_buf
+                self._view = memoryview(new_buf)
+            else:
+                # move the unread tail to the front of the buffer
+                self._view[:unread] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = unread
+
+        deadline = self.deadline
+        if deadline is None and self._timeout_set:
+            sock.settimeout(None)
+            self._timeout_set = False
+
+        while self._end - self._start < num_bytes:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise StatementTimeout()
+                sock.settimeout(remaining)
+                self._timeout_set = True
+            waiting = time.perf_counter()
+            try:
+                received = sock.recv_into(self._view[self._end:])
+            except socket.timeout:
+                raise StatementTimeout()
+            received_at = time.perf_counter()
+            if not received:
+                raise ConnectionError("Connection Lost")
+            self._end += received
+            self.bytes_received += received
+            self.receive_time += received_at - waiting
+            if self.first_receive is None:
+                self.first_receive = received_at
+
+    def read_message(self, sock: socket.socket) -> memoryview:
+        # Message format:
+        # char tag | int32 len | payload
+        if self._start == self._end:
+            # everything consumed, start from the front again
+            self._start = self._end = 0
+
+        self._fill(sock, 5)
+        # length includes itself (4 bytes) but not the tag
+        message_length = int.from_bytes(self._view[self._start + 1:self._start + 5], 'big')
+        self._fill(sock, message_length + 1)
+
+        start = self._start
+        self._start += message_length + 1
+        return self._view[start:self._start]
+
+
+class WriteBuffer:
+    # Reusable send buffer for frontend messages.
+    # Messages are queued with write and sent together by flush, with one
+    # sendmsg call (scatter-gather) instead of one sendall per message.
+    # Small messages are copied into one bytearray that is reused between
+    # flushes, large ones (ex: CopyData chunks) are sent from the caller's
+    # buffer without copying them.
+    #
+    # Flush policy: functions that wait for a response (execute, sync, ...)
+    # flush right away, others (ex: copy_in) only flush once flush_threshold
+    # bytes are queued.
+
+    # writes of at least this many bytes are sent by reference instead of copied
+    COPY_LIMIT = 4096
+    # sendmsg accepts at most IOV_MAX (1024 on Linux) buffers per call
+    MAX_BUFFERS = 1024
+
+    def __init__(self, flush_threshold: int = 65536) -> None:
+        self.flush_threshold = flush_threshold
+        self._buf = bytearray(flush_threshold)
+        self._end = 0 # end of the queued small messages in _buf
+        # what flush sends, in order: (start, end) ranges of _buf or large buffers
+        self._parts: list = []
+        self._part_start = 0
+        self.pending = 0 # bytes queued
+        # counters
+        self.bytes_sent = 0
+        self.send_calls = 0
+
+    def write(self, data: bytes) -> None:
+        size = len(data)
+        if size >= self.COPY_LIMIT:
+            self._end_part()
+            self._parts.append(data)
+        else:
+            # grows _buf when needed, the larger buffer is kept for the next messages
+            self._buf[self._end:self._end + size] = data
+            self._end += size
+        self.pending += size
+
+    def _end_part(self) -> None:
+        if self._end > self._part_start:
+            self._parts.append((self._part_start, self._end))
+            self._part_start = self._end
+
+    def flush(self, sock: socket.socket) -> None:
+        if not self.pending:
+            return
+        self._end_part()
+        with memoryview(self._buf) as view:
+            buffers = [view[part[0]:part[1]] if isinstance(part, tuple) else part for part in self._parts]
+            try:
+                if len(buffers) == 1 or not hasattr(sock, 'sendmsg'):
+                    for buffer in buffers:
+                        sock.sendall(buffer)
+                        self.send_calls += 1
+                else:
+                    self._sendmsg_all(sock, buffers)
+            finally:
+                for buffer in buffers:
+                    if isinstance(buffer, memoryview) and buffer.obj is self._buf:
+                        buffer.release()
+                self.bytes_sent += self.pending
+                self._parts = []
+                self._part_start = self._end = 0
+                self.pending = 0
+
+    def _sendmsg_all(self, sock: socket.socket, buffers: list) -> None:
+        # sendmsg can send part of the data, like send. Retry from where it stopped.
+        first = 0
+        while first < len(buffers):
+            sent = sock.sendmsg(buffers[first:first + self.MAX_BUFFERS])
+            self.send_calls += 1
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:
+                buffers[first] = memoryview(buffers[first])[sent:]
+
+
+@dataclass
+class SocketOptions:
+    # Set on the socket when connecting, see startup.
+    # They can also be given in the connection parameters (SOCKET_PARAMETERS)
+    # Disable Nagle's algorithm. Messages are already coalesced by the
+    # write buffer, so waiting for more data only adds latency
+    tcp_nodelay: bool = True
+    # SO_RCVBUF / SO_SNDBUF in bytes, None keeps the system default
+    receive_buffer_size: Optional[int] = None
+    send_buffer_size: Optional[int] = None
+    # TCP keepalive, the idle time and interval are in seconds
+    keepalive: bool = False
+    keepalive_idle: Optional[int] = None
+    keepalive_interval: Optional[int] = None
+    keepalive_count: Optional[int] = None
+    # seconds to wait for the connection to be established, None waits forever
+    connect_timeout: Optional[float] = None
+
+
+# Connection parameters for the socket, they aren't sent to the server.
+# connect_timeout and the keepalive ones have the same names as in libpq.
+SOCKET_PARAMETERS = {
+    'tcp_nodelay': ('tcp_nodelay', bool),
+    'receive_buffer_size': ('receive_buffer_size', int),
+    'send_buffer_size': ('send_buffer_size', int),
+    'keepalives': ('keepalive', bool),
+    'keepalives_idle': ('keepalive_idle', int),
+    'keepalives_interval': ('keepalive_interval', int),
+    'keepalives_count': ('keepalive_count', int),
+    'connect_timeout': ('connect_timeout', float),
+}
+
+
+class StatementTimeout(DatabaseError):
+    # The results didn't arrive before the deadline (see set_deadline).
+    # By the time it reaches the caller the query has been canceled and the
+    # connection drained, so it can be used for the next query.
+    def __init__(self) -> None:
+        super().__init__({
+            'S': 'ERROR',
+            'C': '57014', # query_canceled
+            'M': "canceling statement due to client side statement timeout",
+        })
+
+
 @dataclass
 class ConnectionHandle:
-    sock: socket.socket = field(default_factory= lambda: socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+    # created by startup, TCP or a Unix domain socket
+    sock: Optional[socket.socket] = None
+    read_buffer: ReadBuffer = field(default_factory=ReadBuffer)
+    write_buffer: WriteBuffer = field(default_factory=WriteBuffer)
+    socket_options: SocketOptions = field(default_factory=SocketOptions)
+    # Protocol state (pending results, transaction status, server parameters,
+    # Backend Key Data), every message read on the connection goes through it
+    protocol: ProtocolMachine = field(default_factory=ProtocolMachine)
+    # True while a portal is being fetched in chunks (see execute_portal), or
+    # other extended protocol messages were sent without a Sync (ex: the ODBC
+    # parameter arrays), the server won't send Ready for Query until a Sync is sent
+    portal_open: bool = False
+    # Optional client side statistics (see query_stats), and the timer
+    # for the query whose results are being read
+    stats: Optional[StatsCollector] = None
+    query_timer: Optional[QueryTimer] = None
+    # odbc_driver.StatementState (bound columns, statement attributes)
+    # when the handle is used as an ODBC statement handle
+    odbc_statement: Optional[object] = None
+    # odbc_driver.StatementState of the statement whose results are being read,
+    # several ODBC statement handles can share the connection
+    odbc_results: Optional[object] = None
+    # types of the server, set by load_type_catalog
+    type_catalog: Optional[pg_types.TypeCatalog] = None
+    # (host, port) that startup connected to, needed to cancel a query (see cancel)
+    address: Optional[Tuple[str, int]] = None
+
+    # The protocol state, see ProtocolMachine
+
+    @property
+    def pending_results(self) -> int:
+        return self.protocol.pending_results
+
+    @pending_results.setter
+    def pending_results(self, value: int) -> None:
+        self.protocol.pending_results = value
+
+    @property
+    def transaction_status(self) -> str:
+        return self.protocol.transaction_status
+
+    @property
+    def rowcount(self) -> int:
+        return self.protocol.rowcount
+
+    @property
+    def server_parameters(self) -> Dict[str, str]:
+        return self.protocol.server_parameters
+
+    @property
+    def backend_pid(self) -> Optional[int]:
+        return self.protocol.backend_pid
+
+    @property
+    def secret_key(self) -> Optional[bytes]:
+        return self.protocol.secret_key
 
 
 def create_startup_message(conn_parameters:dict) -> bytes:
@@ -18,11 +310,11 @@ def create_startup_message(conn_parameters:dict) -> bytes:
     protocol_version = 196608
 
     # Constructing the startup message in the correct binary format
-    message = b''
-    for key, value in conn_parameters.items():
-        message += key.encode('utf-8') + b'\x00'  # key + null terminator
-        message += value.encode('utf-8') + b'\x00'  # value + null terminator
-    message += b'\x00'  # End of parameters (final null terminator)
+    # key + null terminator, value + null terminator, for each parameter
+    message = b''.join(
+        key.encode('utf-8') + b'\x00' + value.encode('utf-8') + b'\x00'
+        for key, value in conn_parameters.items()
+    ) + b'\x00'  # End of parameters (final null terminator)
 
     # The total length of the message, including itself (4 bytes) and protocol version (4 bytes)
     total_length = 4 + 4 + len(message)
@@ -33,36 +325,146 @@ def create_startup_message(conn_parameters:dict) -> bytes:
     return startup_message
 
 
-def receive_all(sock: socket.socket):
-    BUFF_SIZE = 4096 # 4 KiB
-    data = b''
-    while True:
-        part = sock.recv(BUFF_SIZE)
-        data += part
-        if len(part) < BUFF_SIZE:
-            # either 0 or end of data
-            break
-    return data
-
 def startup(conn_parameters: dict, handle: ConnectionHandle) -> socket.socket:
-    # with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    # sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock = handle.sock
-    sock.connect((conn_parameters['host'], conn_parameters['port']))
-
-    conn_parameters.pop('host', None)
-    conn_parameters.pop('port', None)
+    # host is a host name / IP address, or the directory of a Unix domain
+    # socket (ex: '/var/run/postgresql') like in libpq.
+    # Socket options come from handle.socket_options and SOCKET_PARAMETERS
+    set_socket_options(handle.socket_options, conn_parameters)
+    handle.address = (conn_parameters['host'], conn_parameters.get('port', 5432))
+    handle.sock = connect_socket(*handle.address, handle.socket_options)
+
+    # everything except host, port and the socket options is sent to the server,
+    # copy so the caller's parameters can be used to connect again
+    conn_parameters = {
+        key: value for key, value in conn_parameters.items()
+        if key not in ('host', 'port') and key not in SOCKET_PARAMETERS
+    }
     startup_message = create_startup_message(conn_parameters)
 
-    sock.sendall(startup_message)
+    send(handle, [startup_message])
 
     # Receive response (e.g., Authentication request or success/failure)
-    response = receive_all(sock)
-    _logger.debug(f"Startup Response {response}")
+    _read_startup_response(handle)
 
     return handle
 
 
+def _read_startup_response(handle: ConnectionHandle) -> None:
+    # 'R' Authentication request, Int32 0 for Authentication Ok
+    # 'S' Parameter Status and 'K' Backend Key Data are kept by handle.protocol
+    # 'N' Notice Response
+    # 'Z' Ready for Query, the connection is ready
+    for event in fetch_events(handle):
+        _logger.debug(f"Startup Response {event}")
+        kind = type(event)
+
+        if kind is Authentication and event.auth_type != 0:
+            # This assumes that there is no auth (ex: POSTGRES_HOST_AUTH_METHOD=trust)
+            raise DatabaseError({
+                'S': 'FATAL', 'C': '28000',
+                'M': f"authentication type {event.auth_type} is not supported",
+            })
+
+        elif kind is ErrorResponse:
+            raise event.error
+
+        elif kind is ReadyForQuery:
+            return
+
+
+def set_socket_options(options: SocketOptions, conn_parameters: dict) -> None:
+    # Copy the SOCKET_PARAMETERS in conn_parameters to options.
+    # Values can be strings, like in a libpq connection string
+    for key, (option, convert) in SOCKET_PARAMETERS.items():
+        value = conn_parameters.get(key)
+        if value is None:
+            continue
+        if convert is bool and isinstance(value, str):
+            value = value.lower() in ('1', 'true', 'on', 'yes')
+        setattr(options, option, convert(value))
+
+
+def unix_socket_path(directory: str, port: int) -> str:
+    # the server's socket file in the directory, ex: /var/run/postgresql/.s.PGSQL.5432
+    return os.path.join(directory, f".s.PGSQL.{port}")
+
+
+def connect_socket(host: str, port: int, options: Optional[SocketOptions] = None) -> socket.socket:
+    # Connect to the server over a Unix domain socket if host is a
+    # directory (starts with '/'), otherwise over TCP.
+    # Buffer sizes are set before connecting so the TCP window is sized for them.
+    options = options or SocketOptions()
+    port = int(port)
+    if host.startswith('/'):
+        addresses = [(socket.AF_UNIX, socket.SOCK_STREAM, 0, unix_socket_path(host, port))]
+    else:
+        addresses = [
+            (family, socket_type, protocol, address)
+            for family, socket_type, protocol, _, address in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        ]
+
+    error = None
+    for family, socket_type, protocol, address in addresses:
+        sock = socket.socket(family, socket_type, protocol)
+        try:
+            if options.receive_buffer_size is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options.receive_buffer_size)
+            if options.send_buffer_size is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, options.send_buffer_size)
+            sock.settimeout(options.connect_timeout)
+            sock.connect(address)
+            sock.settimeout(None)
+            _set_tcp_options(sock, options)
+            return sock
+        except OSError as e:
+            # try the next address (ex: IPv4 after IPv6)
+            error = e
+            sock.close()
+    raise error
+
+
+def _set_tcp_options(sock: socket.socket, options: SocketOptions) -> None:
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(options.tcp_nodelay))
+    if not options.keepalive:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the names of these vary by platform, skip the ones that aren't there
+    # (macOS calls TCP_KEEPIDLE TCP_KEEPALIVE)
+    idle_option = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+    for option, value in (
+        (idle_option, options.keepalive_idle),
+        (getattr(socket, 'TCP_KEEPINTVL', None), options.keepalive_interval),
+        (getattr(socket, 'TCP_KEEPCNT', None), options.keepalive_count),
+    ):
+        if option is not None and value is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+
+def set_nodelay(handle: ConnectionHandle, enabled: bool = True) -> None:
+    # TCP_NODELAY, only applies to TCP sockets
+    handle.socket_options.tcp_nodelay = enabled
+    if handle.sock.family in (socket.AF_INET, socket.AF_INET6):
+        handle.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+
+def send(handle: ConnectionHandle, messages: Iterable[bytes], flush: bool = True) -> None:
+    # Queue messages in the handle's write buffer. Everything queued is sent
+    # in one system call when flush is set (the caller is about to wait for
+    # a response) or once the buffer reaches its flush threshold.
+    write_buffer = handle.write_buffer
+    for message in messages:
+        write_buffer.write(message)
+    if flush or write_buffer.pending >= write_buffer.flush_threshold:
+        write_buffer.flush(handle.sock)
+
+
+def flush(handle: ConnectionHandle) -> None:
+    # send any queued messages
+    handle.write_buffer.flush(handle.sock)
+
+
 def create_query_message(query:str) -> bytes:
 
     query_encoded = query.encode('utf-8') + b'\x00' # query + null terminator
@@ -75,199 +477,538 @@ def create_query_message(query:str) -> bytes:
     return simple_query_message
 
 
-def execute(handle: ConnectionHandle, query:str) -> str:
+def _create_message(tag: bytes, body: bytes) -> bytes:
+    # tag | int32 len (including self) | body
+    return tag + (4 + len(body)).to_bytes(4, 'big') + body
+
+
+def create_parse_message(query:str, statement_name:str = '') -> bytes:
+    # https://www.postgresql.org/docs/current/protocol-message-formats.html
+    # Byte1('P') - Identifies the message as a Parse command.
+    # String - The name of the prepared statement (an empty string selects the unnamed prepared statement).
+    # String - The query string to be parsed.
+    # Int16 - The number of parameter data types specified (can be zero).
+    body = statement_name.encode('utf-8') + b'\x00' + query.encode('utf-8') + b'\x00' + b'\x00\x00'
+    return _create_message(b'P', body)
+
+
+def create_bind_message(
+        portal_name:str = '',
+        statement_name:str = '',
+        result_format:int = pg_types.TEXT_FORMAT,
+        parameters:Sequence = ()
+) -> bytes:
+    # Byte1('B') - Identifies the message as a Bind command.
+    # String - The name of the destination portal (an empty string selects the unnamed portal).
+    # String - The name of the source prepared statement (an empty string selects the unnamed prepared statement).
+    # Int16 - The number of parameter format codes that follow.
+    # Int16[C] - The parameter format codes.
+    # Int16 - The number of parameter values that follow.
+    # Then, for each parameter:
+    #   Int32 - The length of the parameter value, in bytes (this count does not include itself). -1 indicates NULL.
+    #   Byten - The value of the parameter, in the format indicated by the associated format code.
+    # Int16 - The number of result-column format codes that follow.
+    #         If this is one, the format code is applied to all result columns.
+    # Int16[C] - The result-column format codes.
+    encoded = [pg_types.encode_parameter(value) for value in parameters]
+
+    formats = b''
+    if any(format_code != pg_types.TEXT_FORMAT for format_code, _ in encoded):
+        # zero format codes means everything is text
+        formats = b''.join(format_code.to_bytes(2, 'big') for format_code, _ in encoded)
+    values = b''.join(
+        b'\xff\xff\xff\xff' if value is None else len(value).to_bytes(4, 'big') + value
+        for _, value in encoded
+    )
+
+    body = (
+        portal_name.encode('utf-8') + b'\x00'
+        + statement_name.encode('utf-8') + b'\x00'
+        + (len(formats) // 2).to_bytes(2, 'big') + formats
+        + len(encoded).to_bytes(2, 'big') + values
+        + b'\x00\x01' + result_format.to_bytes(2, 'big')
+    )
+    return _create_message(b'B', body)
+
+
+def create_describe_message(kind:str = 'P', name:str = '') -> bytes:
+    # Byte1('D') - Identifies the message as a Describe command.
+    # Byte1 - 'S' to describe a prepared statement; or 'P' to describe a portal.
+    # String - The name of the prepared statement or portal to describe.
+    return _create_message(b'D', kind.encode('utf-8') + name.encode('utf-8') + b'\x00')
+
+
+def create_execute_message(portal_name:str = '', max_rows:int = 0) -> bytes:
+    # Byte1('E') - Identifies the message as an Execute command.
+    # String - The name of the portal to execute.
+    # Int32 - Maximum number of rows to return. Zero denotes "no limit".
+    return _create_message(b'E', portal_name.encode('utf-8') + b'\x00' + max_rows.to_bytes(4, 'big'))
+
+
+def create_sync_message() -> bytes:
+    # Byte1('S') - Identifies the message as a Sync command.
+    return b'S\x00\x00\x00\x04'
+
+
+def create_terminate_message() -> bytes:
+    # Byte1('X') - Identifies the message as a termination,
+    # the server closes the session cleanly instead of logging an unexpected EOF.
+    return b'X\x00\x00\x00\x04'
+
+
+def create_close_message(kind:str = 'S', name:str = '') -> bytes:
+    # Byte1('C') - Identifies the message as a Close command.
+    # Byte1 - 'S' to close a prepared statement; or 'P' to close a portal.
+    # String - The name of the prepared statement or portal to close.
+    return _create_message(b'C', kind.encode('utf-8') + name.encode('utf-8') + b'\x00')
+
+
+def create_flush_message() -> bytes:
+    # Byte1('H') - Identifies the message as a Flush command.
+    # Asks the server to send any pending output without ending the transaction like Sync does.
+    return b'H\x00\x00\x00\x04'
+
+
+def create_prepared_messages(
+        query:str,
+        statement_name:str = '',
+        parameters:Sequence = (),
+        parse:bool = True,
+        binary:bool = False,
+        close_statements:Sequence[str] = (),
+        portal_name:str = '',
+        max_rows:int = 0
+) -> bytes:
+    # All of the extended query protocol messages to run one query, ending with a Sync.
+    # Parameters ($1, $2, ...) are sent separately from the query text in the Bind message.
+    # With parse=False the named statement must already have been prepared
+    # on this connection, so the server skips parsing and planning.
+    # close_statements are closed in the same round trip.
+    # The response is:
+    # '3' Close Complete (per closed statement), '1' Parse Complete, '2' Bind Complete,
+    # 'T' Row Description or 'n' No Data, 'D' Data Rows, 'C' Command Complete, 'Z' Ready for Query
+    #
+    # With max_rows the portal only returns that many rows then a Portal Suspended ('s'),
+    # the messages end with a Flush instead of a Sync so the portal stays open (see execute_portal)
+    messages = [create_close_message('S', name) for name in close_statements]
+    if parse:
+        messages.append(create_parse_message(query, statement_name))
+    messages.append(create_bind_message(
+        portal_name=portal_name,
+        statement_name=statement_name,
+        result_format=pg_types.BINARY_FORMAT if binary else pg_types.TEXT_FORMAT,
+        parameters=parameters,
+    ))
+    messages.append(create_describe_message('P', portal_name))
+    messages.append(create_execute_message(portal_name, max_rows))
+    messages.append(create_flush_message() if max_rows else create_sync_message())
+    return b''.join(messages)
+
+
+def execute(handle: ConnectionHandle, query:str, binary:bool = False) -> str:
     sock = handle.sock
-    query = create_query_message(query)
+    if binary:
+        # The simple query protocol always returns text,
+        # binary results need the extended query protocol.
+        query = create_prepared_messages(query, binary=True)
+    else:
+        query = create_query_message(query)
     
-    sock.sendall(query)
+    send(handle, [query])
+    handle.pending_results += 1
+
+    return sock
+
+
+def execute_prepared(
+        handle: ConnectionHandle,
+        query:str,
+        statement_name:str = '',
+        parameters:Sequence = (),
+        parse:bool = True,
+        binary:bool = False,
+        close_statements:Sequence[str] = ()
+) -> socket.socket:
+    # Run a query with the extended query protocol,
+    # see create_prepared_messages
+    sock = handle.sock
+    send(handle, [create_prepared_messages(
+        query, statement_name, parameters, parse, binary, close_statements
+    )])
+    handle.pending_results += 1
 
     return sock
 
-def recv_exact(sock: socket.socket, num_bytes:int) -> bytes:
+
+def execute_pipeline(handle: ConnectionHandle, queries:Sequence[bytes]) -> socket.socket:
+    # Send several queries in one write without waiting for their results.
+    # Each item must be a complete simple query message or a set of extended
+    # protocol messages ending in a Sync (see create_prepared_messages),
+    # so an error in one query doesn't affect the others.
+    # The results come back in the same order, each ending with Ready for Query.
+    sock = handle.sock
+    send(handle, queries)
+    handle.pending_results += len(queries)
+
+    return sock
+
+def fetch_events(handle: ConnectionHandle) -> Generator[object, None, None]:
+    # The messages from the server as pg_machine events (DataRow, CommandComplete, ...).
+    # The read buffer frames the messages and handle.protocol turns them into events.
+    # DataRow and CopyData point into the read buffer,
+    # they are only valid until the next event is fetched
+    sock = handle.sock
+    read_buffer = handle.read_buffer
+    handle_message = handle.protocol.handle_message
+    while True:
+        try:
+            message = read_buffer.read_message(sock)
+        except StatementTimeout:
+            # cancel the query and get the connection back to Ready for Query
+            _cancel_and_drain(handle)
+            raise
+        event = handle_message(message)
+        if event is None:
+            continue
+        kind = type(event)
+        if kind is ReadyForQuery and handle.pending_results == 0:
+            read_buffer.deadline = None
+        elif kind is ErrorResponse:
+            # the server skips everything up to the next Sync,
+            # send the one that is owed (see sync) so the Ready for Query follows
+            sync(handle)
+        yield event
+
+
+def fetch_message(handle: ConnectionHandle) -> Generator[bytes, None, None]:
+    # Kept for older callers, use fetch_events instead.
+    # The raw messages (char tag | int32 len | payload) as bytes, they still go
+    # through handle.protocol so the connection state stays up to date
+    read_buffer = handle.read_buffer
+    handle_message = handle.protocol.handle_message
+    while True:
+        message = read_buffer.read_message(handle.sock)
+        handle_message(message)
+        yield bytes(message)
+
+
+def receive_all(sock: socket.socket) -> bytes:
+    # Kept for older callers, use fetch_events instead.
+    # Whatever bytes are waiting on the socket, this bypasses the read buffer
+    # and the protocol state so only use it on a socket nothing else reads
+    BUFF_SIZE = 4096 # 4 KiB
     data = b''
-    while len(data) < num_bytes:
-        packet = sock.recv(num_bytes - len(data))
-        if not packet:
-            raise ConnectionError("Connection Lost")
-        data += packet
+    while True:
+        part = sock.recv(BUFF_SIZE)
+        data += part
+        if len(part) < BUFF_SIZE:
+            # either 0 or end of data
+            break
     return data
 
-def fetch_message(handle: ConnectionHandle) -> Generator[bytes, None, None]:
-    # Message format:
-    # char tag | int32 len | payload
+
+def execute_portal(handle: ConnectionHandle, query:bytes) -> socket.socket:
+    # Start a query that returns its rows in chunks, query must come from
+    # create_prepared_messages with max_rows set.
+    # After each chunk the server sends Portal Suspended ('s') and waits
+    # for fetch_portal, until the last chunk ends with Command Complete ('C').
+    # The portal stays open until sync is called.
     sock = handle.sock
-    message_length = 1
-    while message_length > 0:
-        # Get the length of the message (4 bytes)
-        char_tag = recv_exact(sock, 1)
-        _logger.debug(f"got char_tag from sock: {char_tag.decode('utf-8')}")
+    send(handle, [query])
+    handle.portal_open = True
 
-        length = recv_exact(sock, 4)
-        payload_len = int.from_bytes(length, 'big') - 4 # 4 bytes for length
-        _logger.debug(f"got length from sock: {payload_len}")
+    return sock
+
+
+def fetch_portal(handle: ConnectionHandle, portal_name:str, max_rows:int) -> socket.socket:
+    # ask for the next chunk of rows from a suspended portal
+    sock = handle.sock
+    send(handle, [create_execute_message(portal_name, max_rows), create_flush_message()])
 
-        part = recv_exact(sock, payload_len)
-        _logger.debug(f"got part from sock: {part}")
+    return sock
 
-        message_length = len(char_tag) + len(length) + len(part)
 
-        yield char_tag + length + part
+def sync(handle: ConnectionHandle) -> None:
+    # End an open portal, the server closes it and sends Ready for Query
+    if handle.portal_open:
+        send(handle, [create_sync_message()])
+        handle.pending_results += 1
+        handle.portal_open = False
 
 
+def drain(handle: ConnectionHandle) -> None:
+    # Read and throw away any results that haven't been fetched,
+    # so the next query starts from a clean connection
+    sync(handle)
+    read_buffer = handle.read_buffer
+    protocol = handle.protocol
+    while protocol.pending_results > 0:
+        try:
+            # still parsed, so notices and parameter changes aren't lost
+            protocol.handle_message(read_buffer.read_message(handle.sock))
+        except StatementTimeout:
+            # the results are being thrown away anyway
+            _cancel_and_drain(handle)
+            return
+    read_buffer.deadline = None
 
-def _parse_row_description(message: bytes) -> list:
-    # https://www.postgresql.org/docs/current/protocol-message-formats.html
-    # Byte1('T') - Identifies the message as a row description.
+
+# seconds to wait for the server to end a query after it was canceled,
+# before giving up on the connection
+CANCEL_GRACE = 5.0
+
+
+def set_deadline(handle: ConnectionHandle, timeout: Optional[float]) -> None:
+    # Client side statement timeout, set before sending a query.
+    # If its results don't all arrive within timeout seconds, reading them
+    # raises StatementTimeout after canceling the query (see cancel)
+    # and reading up to its Ready for Query.
+    # The deadline is cleared once there are no results pending.
+    handle.read_buffer.deadline = time.monotonic() + timeout if timeout is not None else None
+
+
+def create_cancel_request(backend_pid: int, secret_key: bytes) -> bytes:
     # Int32 - Length of message contents in bytes, including self.
-    # Int16 - Specifies the number of fields in a row (can be zero).
-
-    # Then, for each field, there is the following:
-    # String - The field name.
-    # Int32 - If the field can be identified as a column of a specific table, the object ID of the table; otherwise zero.
-    # Int16 - If the field can be identified as a column of a specific table, the attribute number of the column; otherwise zero.
-    # Int32 - The object ID of the field's data type.
-    # Int16 -The data type size (see pg_type.typlen). Note that negative values denote variable-width types.
-    # Int32 - The type modifier (see pg_attribute.atttypmod). The meaning of the modifier is type-specific.
-    # Int16 - The format code being used for the field. Currently will be zero (text) or one (binary). In a RowDescription returned from the statement variant of Describe, the format code is not yet known and will always be zero.
-    _logger.debug(f"Row Description Raw: {message}")
-    idx = 2
-    num_fields = int.from_bytes(message[0:idx], 'big')
-    _logger.debug(f"Number of Fields: {num_fields}")
-    if num_fields > 100:
-        # just to catch some simple parsing errors
-        raise ValueError("Number of fields is too high")
-
-
-    field_names = []
-    for field in range(num_fields):
-        # Field name (null-terminated string)
-        field_name_end = message.find(b'\x00', idx)
-        field_name = message[idx:field_name_end].decode('utf-8')
-        field_names.append(field_name)
-        _logger.debug(f"Field name: {field_name}")
-
-        idx = field_name_end + 1
-        # Skip all of the other stuff: 
-        # table OID (4 bytes),
-        # column attribute number (2 bytes)
-        # field data type OID (4 bytes)
-        # data type size (2 bytes)
-        # type modifier (4 bytes)
-        # format code (2 bytes)
-        idx += 4 + 2 + 4 + 2 + 4 + 2
-
-    return field_names
-
-def _parse_data_row(message: bytes) -> tuple:
-    # https://www.postgresql.org/docs/current/protocol-message-formats.html
-    # Byte1('D') - Identifies the message as a data row.
-    # Int32 - Length of message contents in bytes, including self..
-    # Int16 - The number of column values that follow (possibly zero).
-    
-    # Then, for each column, there is the following:
-    # Int32 - The length of the column value, in bytes (this count does not include itself). Can be zero. As a special case, -1 indicates a NULL column value. No value bytes follow in the NULL case.
-    # Byten - The value of the column, in the format indicated by the associated format code. n is the above length.
-
-    _logger.debug(f"Row Raw: {message}")
-    idx = 2
-    num_col_values = int.from_bytes(message[0:idx], 'big')
-    _logger.debug(f"Number of Column Values: {num_col_values}")
-
-    row = []
-    for row_num in range(num_col_values):
-        # Field length (4 bytes)
-        field_length = int.from_bytes(message[idx:idx+4], 'big')
-        idx += 4
-        
-        _logger.debug(f"Row Length: {field_length}")
-        if field_length > 100000:
-            # just to catch some simple parsing errors
-            raise ValueError("Field length is too high")
-        
-        if field_length == -1:
-            row.append("NULL")
-            continue
-        
-        value = message[idx:idx+field_length]
-        _logger.debug(f"Row Value: {value.decode('utf-8')}")
-        row.append(value.decode('utf-8'))
-        idx += field_length
-
-    return tuple(row)
-
-def parse_message(message: bytes) -> Tuple[str, int, bytes]:
-
-    message_type = message[0:1].decode('utf-8')
-    message_length = int.from_bytes(message[1:5], 'big')
-    message_body = message[5:]
-
-    _logger.info(f"Message Type:  {message_type}")
-    _logger.info(f"Message Length: {message_length}")
-
-    return message_type, message_length, message_body
-
-
-def get_data(cursor: Generator[bytes, None, None]) -> Tuple[list, List[tuple]]:
-    # option to use a "cursor" to get data
-    message_length = 1
-    columns = []
-    rows = []
-    while message_length > 0:
-        message = next(cursor)
-        _logger.debug(f"Message: {message}")
-
-        message_type, message_length, message_body = parse_message(message)
-        _logger.info(f"Message Type: {message_type}")
-
-        if message_type == "T":
-            columns = _parse_row_description(message_body)
-
-        if message_type == "D":
-            row = _parse_data_row(message_body)
-            rows.append(row)
-        
-        if message_type == "C": 
-            _logger.info("Command Complete")
-            return columns, rows
-
-        if message_type == "Z": 
-            _logger.info("End of results - ready for next query")
-            return columns, rows
-        
-    return [], [()]
-
-
-def get_row(cursor: Generator[bytes, None, None]) -> Tuple[list, tuple]:
-    columns = []
-    row = ()
-    message = next(cursor)
-    _logger.debug(f"Message: {message}")
-    message_type, message_length, message_body = parse_message(message)
-
-    while message_type == "Z" or message_type == "T":
-        if message_type == "Z": 
-            _logger.debug("End of last results - ready for next query")
-            message = next(cursor)
-            _logger.debug(f"Message: {message}")
-            message_type, message_length, message_body = parse_message(message)
-            _logger.info(f"Message Type: {message_type}")
-        
-        if message_type == "T":
-            # Move to next if it is a start of transaction type
-            columns = _parse_row_description(message_body)
-            message = next(cursor)
-            _logger.debug(f"Message: {message}")
-            message_type, message_length, message_body = parse_message(message)
-
-    if message_type == "D":
-        row = _parse_data_row(message_body)
-        return columns, row
-    
-    if message_type == "C": 
-        _logger.info("Command Complete")
-        return None, None
+    # Int32(80877102) - The cancel request code.
+    # Int32 - The process ID of the target backend.
+    # Byten - The secret key for the target backend.
+    body = (80877102).to_bytes(4, 'big') + backend_pid.to_bytes(4, 'big') + secret_key
+    return (len(body) + 4).to_bytes(4, 'big') + body
+
+
+def cancel(handle: ConnectionHandle, timeout: Optional[float] = CANCEL_GRACE) -> None:
+    # Ask the server to cancel the query running on handle.
+    # The request goes over a new connection, so this can be called from
+    # another thread while one is blocked reading the results.
+    # The query ends with an Error Response (57014 query_canceled) if it was
+    # still running, there is no reply to the request itself.
+    if handle.backend_pid is None:
+        raise DatabaseError({'S': 'ERROR', 'M': "The server didn't send Backend Key Data, queries can't be canceled"})
+    options = SocketOptions(connect_timeout=timeout)
+    with connect_socket(*handle.address, options) as sock:
+        sock.sendall(create_cancel_request(handle.backend_pid, handle.secret_key))
+        # the server closes the connection once it has handled the request
+        sock.settimeout(timeout)
+        try:
+            sock.recv(1)
+        except socket.timeout:
+            pass
+
+
+def _cancel_and_drain(handle: ConnectionHandle) -> None:
+    # After a StatementTimeout, read what is left of the canceled query's results
+    read_buffer = handle.read_buffer
+    read_buffer.deadline = time.monotonic() + CANCEL_GRACE
+    try:
+        cancel(handle)
+        sync(handle)
+        while handle.pending_results > 0:
+            handle.protocol.handle_message(read_buffer.read_message(handle.sock))
+    except (StatementTimeout, OSError) as e:
+        # the server didn't end the query, the connection can't be used anymore
+        _logger.error(f"Closing the connection, the query couldn't be canceled: {e}")
+        handle.pending_results = 0
+        handle.sock.close()
+    finally:
+        read_buffer.deadline = None
+
+
+def create_copy_data_message(data: bytes) -> bytes:
+    # Byte1('d') - Identifies the message as COPY data.
+    # Byten - Data that forms part of a COPY data stream.
+    # Messages don't have to line up with rows.
+    return create_copy_data_header(data) + data
+
+
+def create_copy_data_header(data: bytes) -> bytes:
+    # The Copy Data tag and length, send the data after it
+    # (ex: from the caller's buffer, without copying it into one message)
+    return b'd' + (4 + len(data)).to_bytes(4, 'big')
+
+
+def create_copy_done_message() -> bytes:
+    # Byte1('c') - Identifies the message as a COPY-complete indicator.
+    return b'c\x00\x00\x00\x04'
+
+
+def create_copy_fail_message(reason: str) -> bytes:
+    # Byte1('f') - Identifies the message as a COPY-failure indicator.
+    # String - An error message to report as the cause of failure.
+    return _create_message(b'f', reason.encode('utf-8') + b'\x00')
+
+
+def read_result(handle: ConnectionHandle, reader: ResultReader) -> str:
+    # Feed reader (see pg_machine.ResultReader) the events from the server
+    # until it is done, returns where the results were left (reader.status)
+    for event in fetch_events(handle):
+        if reader.feed(event):
+            break
+    return reader.status
 
-    return None, None
+
+def read_command_complete(handle: ConnectionHandle) -> str:
+    # read up to Ready for Query and return the Command Complete tag (ex: 'COPY 10')
+    tag = ''
+    while True:
+        reader = ResultReader()
+        read_result(handle, reader)
+        kind = type(reader.end)
+        if kind is CommandComplete:
+            tag = reader.end.tag
+        elif kind is ReadyForQuery:
+            return tag
+
+
+def copy_in(handle: ConnectionHandle, query: str, chunks: Iterable[bytes]) -> str:
+    # Run a COPY ... FROM STDIN query and stream the chunks to the server.
+    # Returns the command tag (ex: 'COPY 10').
+    # 'G': Copy In Response (server is ready for data)
+    # 'd': Copy Data from the client, 'c': Copy Done (or 'f': Copy Fail)
+    # 'C': Command Complete
+    # 'Z': Ready for Query
+    execute(handle, query)
+    if read_result(handle, ResultReader()) != "G":
+        # not a COPY FROM STDIN query
+        read_command_complete(handle)
+        return ''
+
+    # the chunks are queued and sent in batches of about flush_threshold bytes,
+    # large chunks are sent from their own buffer without being copied
+    try:
+        for chunk in chunks:
+            if chunk:
+                send(handle, [create_copy_data_header(chunk), chunk], flush=False)
+    except Exception as e:
+        # let the server roll back the copy, then raise the original error
+        send(handle, [create_copy_fail_message(f"COPY from client failed: {e}")])
+        try:
+            read_command_complete(handle)
+        except DatabaseError:
+            pass
+        raise
+
+    send(handle, [create_copy_done_message()])
+    return read_command_complete(handle)
+
+
+def copy_out(
+        handle: ConnectionHandle,
+        query: str,
+        write: Callable[[bytes], object],
+        chunk_size: int = 65536
+) -> str:
+    # Run a COPY ... TO STDOUT query and pass the data to write.
+    # The server sends one Copy Data message per row, these are
+    # collected into chunks of about chunk_size bytes so write is
+    # called a few times instead of once per row.
+    # Returns the command tag (ex: 'COPY 10').
+    # 'H': Copy Out Response
+    # 'd': Copy Data, 'c': Copy Done
+    # 'C': Command Complete
+    # 'Z': Ready for Query
+    execute(handle, query)
+    if read_result(handle, ResultReader()) != "H":
+        # not a COPY TO STDOUT query
+        read_command_complete(handle)
+        return ''
+
+    chunk = bytearray()
+
+    def add_data(event: CopyData) -> None:
+        chunk.extend(event.data)
+        if len(chunk) >= chunk_size:
+            write(bytes(chunk))
+            chunk.clear()
+
+    read_result(handle, ResultReader(add_data))
+    if chunk:
+        write(bytes(chunk))
+    return read_command_complete(handle)
+
+
+def get_data(
+        events: Generator[object, None, None],
+        description: Optional[list] = None,
+        type_catalog: Optional[pg_types.TypeCatalog] = None
+) -> Tuple[list, List[tuple]]:
+    # Read the rows of one set of results from events (see fetch_events),
+    # up to its end or the portal being suspended.
+    # A Ready for Query left from the last set read this way is skipped,
+    # so the results of pipelined queries can be read one call each.
+    # If a description list is passed in, it is filled with the
+    # ColumnDescription of each result column
+    # With a type_catalog, binary arrays and composites are decoded (see load_type_catalog)
+    rows = DecodedRows(description, type_catalog)
+    reader = ResultReader(rows.add_row, rows.describe, description=description, skip_ready=True)
+    for event in events:
+        if reader.feed(event):
+            break
+    return reader.columns, rows.rows
+
+
+def get_row(
+        events: Generator[object, None, None],
+        description: Optional[list] = None,
+        type_catalog: Optional[pg_types.TypeCatalog] = None
+) -> Tuple[list, tuple]:
+    # If a description list is passed in, it is filled with the
+    # ColumnDescription of each result column, and used to decode
+    # rows on later calls
+    # Returns None, None once the results are finished.
+    # Like get_data, a Ready for Query left from the last results is skipped
+    rows = DecodedRows(description, type_catalog)
+    reader = ResultReader(rows.add_row, rows.describe, size=1, description=description, skip_ready=True)
+    for event in events:
+        if reader.feed(event):
+            break
+    if not rows.rows:
+        return None, None
+    return reader.columns, rows.rows[0]
+
+
+def get_many(
+        handle: ConnectionHandle,
+        size: int,
+        description: Optional[list] = None
+) -> Tuple[list, List[tuple], str]:
+    # Read up to size rows (all of them if size is negative).
+    # Returns the column names (if a Row Description was read), the rows and
+    # where the results were left:
+    # 'D' - there may be more rows
+    # 's' - the portal is suspended, call fetch_portal for more
+    # 'C' - all rows have been read
+    rows = DecodedRows(description, handle.type_catalog)
+    reader = ResultReader(rows.add_row, rows.describe, size, description)
+    status = read_result(handle, reader)
+    return reader.columns, rows.rows, status
+
+
+def skip_result(handle: ConnectionHandle) -> str:
+    # Read the rest of the current set of results without decoding the rows.
+    # Returns where the results were left, like get_many ('s' or 'C')
+    return read_result(handle, ResultReader())
+
+
+def next_result(handle: ConnectionHandle, description: Optional[list] = None) -> Optional[object]:
+    # A simple query with several statements (ex: "select 1; select 2;") returns
+    # one set of results per statement, then a single Ready for Query.
+    # Call this once the current set has been read to its end (see skip_result).
+    # Returns the RowDescription of the next set, its rows are then read as usual
+    # (get_many, get_row, ...), or the CommandComplete of a statement without
+    # rows (ex: an INSERT). Returns None once the Ready for Query has been read,
+    # the connection is then ready for the next query.
+    # An error in any statement ends the query, it is raised here.
+    while handle.pending_results > 0:
+        # stops at the Row Description
+        reader = ResultReader(size=0, description=description)
+        read_result(handle, reader)
+        kind = type(reader.end)
+        if kind is ReadyForQuery:
+            return None
+        # an Empty Query Response (ex: "select 1;;") isn't a set of results
+        if kind is not EmptyQueryResponse:
+            return reader.end
+    return None
 
 
 def process_chunk(handle: ConnectionHandle) -> Tuple[list, List[tuple]]:
@@ -278,38 +1019,143 @@ def process_chunk(handle: ConnectionHandle) -> Tuple[list, List[tuple]]:
     # 'D': Data Row
     # 'C': Command Complete
     # 'Z': Ready for Query
-    message_generator = fetch_message(handle)
-
-    columns = []
-    rows = []
-    message_length = 1
-    while message_length > 0:
-        message = next(message_generator)
-        _logger.debug(f"Message: {message}")
-
-        message_type, message_length, message_body = parse_message(message)
-        _logger.info(f"Message Type: {message_type}")
-
-        if message_type == "T":
-            columns = _parse_row_description(message_body)
-
-        if message_type == "D":
-            row = _parse_data_row(message_body)
-            rows.append(row)
-        
-        if message_type == "C": 
-            _logger.debug("Command Complete")
-            return columns, rows
-
-        if message_type == "Z": 
-            _logger.debug("End of results - ready for next query")
-            return columns, rows
-
-    return [], [()]
+    # When using the extended protocol (binary results) there is also:
+    # '1': Parse Complete
+    # '2': Bind Complete
+    # Same as get_data, with the type catalog of the handle
+    return get_data(fetch_events(handle), type_catalog=handle.type_catalog)
+
+
+# Type catalog
+# pg_type is read once per server and shared by every connection to it in
+# the process. Servers are told apart by host, port, database and version,
+# so an upgraded server is loaded again. Types created after the catalog was
+# loaded need reset_type_catalogs.
+TYPE_CATALOG_QUERY = """select
+    t.oid, t.typname, t.typtype, t.typcategory, t.typelem, t.typdelim, t.typbasetype,
+    case when t.typtype = 'c' then (
+        select string_agg(a.atttypid::text, ',' order by a.attnum)
+        from pg_attribute a
+        where a.attrelid = t.typrelid and a.attnum > 0 and not a.attisdropped
+    ) end
+from pg_type t;"""
+
+_type_catalogs: Dict[str, pg_types.TypeCatalog] = {}
+_type_catalogs_lock = threading.Lock()
+
+
+def _type_catalog_key(conn_parameters: dict, handle) -> str:
+    return "{host}:{port}/{database} {version}".format(
+        host=conn_parameters.get('host', ''),
+        port=conn_parameters.get('port', ''),
+        database=conn_parameters.get('database', ''),
+        version=handle.server_parameters.get('server_version', ''),
+    )
+
+
+def _read_type_catalog_file(path: str) -> dict:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # missing or partly written by an older version, it is just a cache
+        return {}
+
+
+def load_type_catalog(
+        handle: ConnectionHandle,
+        conn_parameters: dict,
+        path: Optional[str] = None
+) -> pg_types.TypeCatalog:
+    # Set handle.type_catalog, querying pg_type only if the catalog for this
+    # server isn't already loaded in the process (or saved in the file at path).
+    # Must be called before executing a query, ex: right after startup.
+    catalog = cached_type_catalog(handle, conn_parameters, path)
+    if catalog is None:
+        drain(handle)
+        execute(handle, TYPE_CATALOG_QUERY)
+        _, rows = get_data(fetch_events(handle))
+        catalog = save_type_catalog(handle, conn_parameters, rows, path)
+
+    handle.type_catalog = catalog
+    return catalog
+
+
+def cached_type_catalog(
+        handle,
+        conn_parameters: dict,
+        path: Optional[str] = None
+) -> Optional[pg_types.TypeCatalog]:
+    # The catalog for the server of handle (sync or async) if it is
+    # loaded in the process or saved in the file at path, otherwise None
+    key = _type_catalog_key(conn_parameters, handle)
+    with _type_catalogs_lock:
+        catalog = _type_catalogs.get(key)
+        if catalog is None and path is not None:
+            saved = _read_type_catalog_file(path).get(key)
+            if saved is not None:
+                catalog = _type_catalogs[key] = pg_types.TypeCatalog.from_dict(saved)
+    return catalog
+
+
+def save_type_catalog(
+        handle,
+        conn_parameters: dict,
+        rows: List[tuple],
+        path: Optional[str] = None
+) -> pg_types.TypeCatalog:
+    # Build the catalog from the rows of TYPE_CATALOG_QUERY and keep it
+    # for the other connections to the server (and in the file at path)
+    catalog = pg_types.TypeCatalog(
+        (
+            pg_types.TypeInfo(
+                int(oid), name, kind, category, int(element_oid), delimiter, int(base_oid),
+                tuple(int(field_oid) for field_oid in field_oids.split(',')) if field_oids else (),
+            )
+            for oid, name, kind, category, element_oid, delimiter, base_oid, field_oids in rows
+        ),
+        handle.server_parameters.get('server_version', ''),
+    )
+    key = _type_catalog_key(conn_parameters, handle)
+    with _type_catalogs_lock:
+        # another connection may have loaded it at the same time, keep the first one
+        catalog = _type_catalogs.setdefault(key, catalog)
+        if path is not None:
+            _write_type_catalog_file(path, key, catalog)
+    return catalog
+
+
+def _write_type_catalog_file(path: str, key: str, catalog: pg_types.TypeCatalog) -> None:
+    # Write to a temporary file and rename it, so other processes
+    # never read a partial file
+    saved = _read_type_catalog_file(path)
+    saved[key] = catalog.to_dict()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(saved, file)
+    os.replace(temp_path, path)
+
+
+def reset_type_catalogs(path: Optional[str] = None) -> None:
+    # Forget the loaded catalogs (and delete the file at path), they are
+    # loaded again by the next load_type_catalog. Connections that already
+    # have a catalog keep using it.
+    with _type_catalogs_lock:
+        _type_catalogs.clear()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
 
 def disconnect(handle: ConnectionHandle) -> None:
     sock = handle.sock
+    if sock is None:
+        # never connected
+        return None
+    try:
+        send(handle, [create_terminate_message()])
+    except OSError:
+        # the connection is already broken, close it anyway
+        pass
     sock.shutdown(socket.SHUT_RDWR)
     sock.close()
     return None
@@ -0,0 +1,24 @@
+import re
+
+# Helpers for looking at query text without parsing it, shared by the
+# statement cache (pep_249), the result cache and the query statistics.
+# They know about comments and single quoted strings, not dollar quoting.
+#
+# strip_literals("select ';' -- comment") # "select '' "
+# is_single_statement("select 1; select 2;") # False
+
+
+COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+STRING = re.compile(r"'(?:[^']|'')*'")
+
+
+def strip_literals(query: str, replacement: str = "''") -> str:
+    # comments become a space and string literals become replacement,
+    # so what's left is only the statement's own keywords and punctuation
+    return STRING.sub(replacement, COMMENT.sub(' ', query))
+
+
+def is_single_statement(query: str) -> bool:
+    # False if the query has ';' between statements (outside strings and comments).
+    # Dollar quoted bodies aren't parsed, a ';' inside one counts as several statements
+    return ';' not in strip_literals(query).rstrip().rstrip(';')
@@ -0,0 +1,47 @@
+from db_utils.async_pep_249 import connect
+import asyncio
+import pytest
+
+
+parameters = {
+    'host': 'localhost',
+    'port': 5432,
+    'user': 'postgres',
+    'database': 'postgres',
+}
+
+query = """select 
+    table_name,
+    table_schema as schema_name, 
+    table_catalog as database_name 
+from information_schema.tables limit 5;"""
+
+
+async def get_results():
+    conn = await connect(parameters)
+    cursor = conn.cursor()
+
+    await cursor.execute(query)
+    rows = await cursor.fetchall()
+
+    await cursor.execute(query)
+    iterated_rows = [row async for row in cursor]
+
+    await conn.close()
+    return rows, iterated_rows
+
+
+def test_get_results(start_postgres, wait_for_postgres):
+
+    rows, iterated_rows = asyncio.run(get_results())
+    assert len(rows) == 5
+    assert iterated_rows == rows
+
+
+def test_concurrent_queries(start_postgres, wait_for_postgres):
+
+    async def run_all():
+        return await asyncio.gather(*[get_results() for _ in range(10)])
+
+    results = asyncio.run(run_all())
+    assert all(len(rows) == 5 for rows, _ in results)
@@ -1,4 +1,10 @@
-from db_utils.pep_249 import connect
+from db_utils.pep_249 import connect, Cursor, StatementCache, Pipeline, DatabaseError
+from decimal import Decimal
+import io
+from array import array
+from db_utils.query_stats import StatsCollector
+from db_utils.result_cache import ResultCache
+from db_utils.simple_pg_protocol import reset_type_catalogs
 import pytest
 
 
@@ -36,3 +42,261 @@ def test_get_results(test_query_execution):
     rows = test_query_execution.fetchall()
     assert len(rows) == 5
 
+
+def test_binary_results(test_query_execution):
+    # drain the results from the autouse query first
+    test_query_execution.fetchall()
+
+    cursor = Cursor(test_query_execution.handle, binary=True)
+    cursor.execute("select 1::int4 as a, 2.5::float8 as b, true as c, 'abc'::text as d, 12.34::numeric as e;")
+    rows = cursor.fetchall()
+    assert rows == [(1, 2.5, True, 'abc', Decimal('12.34'))]
+
+
+def test_typed_results(test_query_execution):
+    test_query_execution.fetchall()
+
+    test_query_execution.execute("select 1::int4 as a, 12.34::numeric(10, 2) as b, null::text as c;")
+    rows = test_query_execution.fetchall()
+    assert rows == [(1, Decimal('12.34'), None)]
+
+    description = test_query_execution.description
+    assert [column[0] for column in description] == ['a', 'b', 'c']
+    assert description[1][4:6] == (10, 2)
+
+
+def test_prepared_statement_cache(test_query_execution):
+    test_query_execution.fetchall()
+
+    cursor = Cursor(test_query_execution.handle, statement_cache=StatementCache(max_size=1))
+    for value in range(3):
+        cursor.execute("select $1::int4 + 1 as a;", (value,))
+        assert cursor.fetchall() == [(value + 1,)]
+    assert len(cursor.statement_cache) == 1
+
+    # evicts and closes the first statement
+    cursor.execute("select $1::text as b;", ("abc",))
+    assert cursor.fetchall() == [("abc",)]
+    assert len(cursor.statement_cache) == 1
+
+    # queries without parameters are prepared the second time they run,
+    # queries with several statements never are
+    cursor.statement_cache = StatementCache(max_size=2)
+    for count in range(2):
+        cursor.execute("select 1 as c;")
+        assert cursor.fetchall() == [(1,)]
+        assert len(cursor.statement_cache) == count
+    cursor.execute("select 1; select 2;")
+    cursor.execute("select 1; select 2;")
+    assert len(cursor.statement_cache) == 1
+
+
+def test_pipeline(test_query_execution):
+    test_query_execution.fetchall()
+
+    pipeline = Pipeline(test_query_execution.handle)
+    pipeline.execute("select 1::int4 as a;")
+    pipeline.execute("select * from table_that_does_not_exist;")
+    pipeline.execute("select $1::int4 as b;", (2,))
+    results = pipeline.sync()
+
+    assert results[0] == [(1,)]
+    assert isinstance(results[1], DatabaseError)
+    assert results[2] == [(2,)]
+
+
+def test_copy(test_query_execution):
+    test_query_execution.fetchall()
+
+    test_query_execution.execute("create temporary table copy_test (a int4, b text);")
+    test_query_execution.fetchall()
+
+    rows = [(value, None if value % 2 else f"row\t{value}") for value in range(2500)]
+    assert test_query_execution.copy_from(rows, "copy_test", ["a", "b"]) == 2500
+
+    output = io.BytesIO()
+    assert test_query_execution.copy_to(output, "copy_test") == 2500
+    assert output.getvalue().startswith(b"0\trow\\t0\n1\t\\N\n")
+
+
+def test_streaming_fetch(test_query_execution):
+    test_query_execution.fetchall()
+
+    cursor = Cursor(test_query_execution.handle, portal_rows=3)
+    cursor.execute("select generate_series(1, 10)::int4 as a;")
+    assert cursor.fetchone() == (1,)
+    assert cursor.fetchmany(4) == [(2,), (3,), (4,), (5,)]
+    assert [row for row in cursor] == [(value,) for value in range(6, 11)]
+    assert cursor.fetchone() is None
+
+    # re-executing after a partial fetch closes the open portal
+    cursor.execute("select generate_series(1, 10)::int4 as a;")
+    assert cursor.fetchmany(2) == [(1,), (2,)]
+    cursor.execute("select 'abc'::text as b;")
+    assert cursor.fetchall() == [("abc",)]
+
+
+def test_fetch_columns(test_query_execution):
+    test_query_execution.fetchall()
+
+    test_query_execution.execute("select value::int4 as a, nullif(value, 2)::float8 as b, value::text as c from generate_series(1, 5) as value;")
+    a, b, c = test_query_execution.fetch_columns()
+    assert a.values == array('i', [1, 2, 3, 4, 5])
+    assert a.nulls is None
+    assert b.values == array('d', [1.0, 0.0, 3.0, 4.0, 5.0])
+    assert b.nulls == bytearray(b'\x00\x01\x00\x00\x00')
+    assert c.values == ['1', '2', '3', '4', '5']
+
+    cursor = Cursor(test_query_execution.handle, binary=True)
+    cursor.execute("select generate_series(1, 5)::int8 as a;")
+    assert [list(columns[0].values) for columns in cursor.fetch_column_batches(2)] == [[1, 2], [3, 4], [5]]
+
+
+def test_query_stats(test_query_execution, tmp_path):
+    test_query_execution.fetchall()
+
+    stats = StatsCollector()
+    test_query_execution.handle.stats = stats
+    try:
+        for value in (3, 5):
+            test_query_execution.execute(f"select generate_series(1, {value}) as a;")
+            test_query_execution.fetchall()
+    finally:
+        test_query_execution.handle.stats = None
+
+    snapshot = stats.snapshot()
+    query_stats = snapshot["select generate_series(?, ?) as a"]
+    assert query_stats["calls"] == 2
+    assert query_stats["rows"] == 8
+    assert query_stats["bytes_received"] > 0
+    assert query_stats["latency"]["p50"] > 0
+
+    path = tmp_path / "db_utils.prom"
+    stats.write_prometheus(str(path))
+    assert 'db_utils_query_calls_total{fingerprint="select generate_series(?, ?) as a"} 2' in path.read_text()
+
+
+def test_type_catalog(test_query_execution, tmp_path):
+    test_query_execution.fetchall()
+
+    for query in (
+        "drop type if exists catalog_pair;",
+        "drop type if exists catalog_mood;",
+        "create type catalog_mood as enum ('happy', 'sad');",
+        "create type catalog_pair as (id int4, name text);",
+    ):
+        test_query_execution.execute(query)
+        test_query_execution.fetchall()
+    test_query_execution.execute("select 1;")
+    test_query_execution.fetchall()
+    # the types were created after any catalog was loaded
+    reset_type_catalogs()
+
+    parameters = {
+        'host': 'localhost',
+        'port': 5432,
+        'user': 'postgres',
+        'database': 'postgres',
+    }
+    path = tmp_path / "types.json"
+    conn = connect(parameters, type_catalog_path=str(path))
+    assert path.exists()
+    query = """select
+        array[1, null, 3] as numbers,
+        array[['a', 'b c'], ['d', null]] as names,
+        'sad'::catalog_mood as mood,
+        row(1, 'x y')::catalog_pair as pair,
+        array[row(2, null)::catalog_pair] as pairs;"""
+    expected = [(
+        [1, None, 3],
+        [['a', 'b c'], ['d', None]],
+        'sad',
+        (1, 'x y'),
+        [(2, None)],
+    )]
+    for binary in (False, True):
+        cursor = conn.cursor(binary=binary)
+        cursor.execute(query)
+        assert cursor.fetchall() == expected
+    conn.close()
+
+
+def test_result_cache(test_query_execution):
+    test_query_execution.fetchall()
+
+    parameters = {
+        'host': 'localhost',
+        'port': 5432,
+        'user': 'postgres',
+        'database': 'postgres',
+    }
+    cache = ResultCache(max_bytes=1024 * 1024, ttl=60.0)
+    conn = connect(parameters, result_cache=cache)
+    cursor = conn.cursor()
+    for query in (
+        "drop table if exists cached_orders;",
+        "create table cached_orders (id int4, status text);",
+        "insert into cached_orders values (1, 'open'), (2, 'closed'), (3, 'open');",
+    ):
+        cursor.execute(query)
+        cursor.fetchall()
+    assert len(cache) == 0
+
+    query = "select id from public.cached_orders where status = $1 order by id;"
+    cursor.execute(query, ('open',))
+    assert cursor.fetchall() == [(1,), (3,)]
+    assert len(cache) == 1
+
+    # served from the cache, the new row isn't seen until the table is invalidated
+    cursor.execute("insert into cached_orders values (4, 'open');")
+    cursor.fetchall()
+    cursor.execute(query, ('open',))
+    assert cursor.description[0][0] == 'id'
+    assert cursor.fetchone() == (1,)
+    assert cursor.fetchall() == [(3,)]
+    assert cache.snapshot()['hits'] == 1
+
+    assert cache.invalidate('cached_orders') == 1
+    cursor.execute(query, ('open',))
+    assert cursor.fetchall() == [(1,), (3,), (4,)]
+
+    # not cached inside a transaction block
+    cursor.execute("begin;")
+    cursor.fetchall()
+    cursor.execute("select count(*) from cached_orders;")
+    assert cursor.fetchall() == [(4,)]
+    conn.rollback()
+    assert len(cache) == 1
+
+    cursor.execute("drop table cached_orders;")
+    cursor.fetchall()
+    conn.close()
+
+
+def test_nextset(test_query_execution):
+    cursor = test_query_execution
+    cursor.fetchall()
+
+    cursor.execute(
+        "create temp table nextset_rows (id int4);"
+        "insert into nextset_rows select generate_series(1, 3);"
+        "select id from nextset_rows order by id;"
+        "select 'done' as status;"
+    )
+    assert cursor.fetchall() == []
+    assert cursor.nextset()
+    assert cursor.rowcount == 3
+    assert cursor.nextset()
+    assert cursor.fetchone() == (1,)
+    assert cursor.nextset()
+    assert cursor.description[0][0] == 'status'
+    assert cursor.fetchall() == [('done',)]
+    assert cursor.nextset() is None
+
+    # an error ends the query
+    cursor.execute("select 1; select 1 / 0; select 2;")
+    assert cursor.fetchall() == [(1,)]
+    with pytest.raises(DatabaseError):
+        cursor.nextset()
+    cursor.execute("select 3 as a;")
+    assert cursor.fetchall() == [(3,)]
@@ -0,0 +1,533 @@
+from db_utils.pep_249 import connect, Cursor, DatabaseError
+import db_utils.simple_pg_protocol as pg
+from db_utils.fake_pg_server import FakePostgresServer, ResultShape, POSINT_OID
+from db_utils.parallel_decode import ParallelDecoder
+from db_utils.columnar_file import ColumnarFile
+from db_utils.lazy_rows import LazyRow
+from db_utils import pg_machine
+from db_utils import pg_types
+from db_utils import async_pep_249
+import db_utils.odbc_driver as odbc
+import db_utils.pep_249_odbc_manager as odbc_manager
+from array import array
+import asyncio
+import pickle
+import pytest
+import socket
+import threading
+
+
+@pytest.fixture(scope='module')
+def fake_server():
+    with FakePostgresServer(shape=ResultShape(rows=10, columns=2)) as server:
+        yield server
+
+
+def test_fake_server_results(fake_server):
+    conn = connect(fake_server.params)
+    cursor = conn.cursor()
+
+    cursor.execute("select 1;")
+    rows = cursor.fetchall()
+    assert len(rows) == 10 and cursor.rowcount == 10
+    assert rows[3] == (3, "3333333333333333")
+
+    # known once the Command Complete has been read
+    cursor.execute("insert rows=7;")
+    assert cursor.rowcount == -1
+    assert cursor.fetchall() == [] and cursor.rowcount == 7
+
+    cursor.execute("select rows=5 columns=3 nulls=0.5 types=int8,float8,bool;")
+    assert len(cursor.fetchall()) == 5
+    assert [column[1] for column in cursor.description] == [20, 701, 16]
+
+    # wide results, postgres allows up to 1664 columns
+    cursor.execute("select rows=2 columns=1000;")
+    assert len(cursor.fetchall()[1]) == 1000 and len(cursor.description) == 1000
+
+    binary_cursor = conn.cursor(binary=True, portal_rows=2)
+    binary_cursor.execute("select rows=5;")
+    assert [row[0] for row in binary_cursor] == [0, 1, 2, 3, 4]
+    assert binary_cursor.rowcount == 5
+
+    with pytest.raises(DatabaseError):
+        cursor.execute("error")
+        cursor.fetchall()
+    conn.close()
+
+
+def test_coalesced_writes(fake_server):
+    conn = connect(fake_server.params)
+    handle = conn.handle
+    write_buffer = handle.write_buffer
+
+    # 50 queries, one send
+    send_calls = write_buffer.send_calls
+    pg.execute_pipeline(handle, [pg.create_query_message(f"select rows={i};") for i in range(50)])
+    assert write_buffer.send_calls == send_calls + 1
+    assert write_buffer.pending == 0
+
+    for i in range(50):
+        columns, rows = pg.get_data(pg.fetch_events(handle))
+        assert len(rows) == i
+
+    # queued without flush until the threshold
+    pg.send(handle, [pg.create_query_message("select rows=3;")], flush=False)
+    assert write_buffer.pending > 0
+    pg.flush(handle)
+    handle.pending_results += 1
+    assert len(pg.get_data(pg.fetch_events(handle))[1]) == 3
+    conn.close()
+
+
+def test_protocol_machine(fake_server):
+    # raw bytes from the server, fed to the machine a few at a time
+    sock = socket.create_connection((fake_server.params['host'], fake_server.params['port']))
+    sock.sendall(pg.create_startup_message({'user': 'postgres', 'database': 'postgres'}))
+    queries = ["select rows=3 notice=careful;", "", "error", "set application_name = 'bench';"]
+    sock.sendall(b''.join(pg.create_query_message(query) for query in queries))
+    machine = pg_machine.ProtocolMachine()
+    machine.queries_sent(len(queries) + 1)
+    events = []
+    while machine.pending_results:
+        data = sock.recv(65536)
+        assert data
+        for start in range(0, len(data), 7):
+            machine.receive_data(data[start:start + 7])
+            events.extend(machine.events())
+    sock.sendall(b'X\x00\x00\x00\x04')
+    sock.close()
+
+    kinds = [type(event).__name__ for event in events]
+    assert kinds == [
+        'Authentication', 'ParameterStatus', 'ParameterStatus', 'BackendKeyData', 'ReadyForQuery',
+        'NoticeResponse', 'RowDescription', 'DataRow', 'DataRow', 'DataRow', 'CommandComplete', 'ReadyForQuery',
+        'EmptyQueryResponse', 'ReadyForQuery',
+        'ErrorResponse', 'ReadyForQuery',
+        'ParameterStatus', 'CommandComplete', 'ReadyForQuery',
+    ]
+    assert events[6].columns[0].name == 'column_0'
+    assert pg._parse_data_row(events[9].body) == ('2', '2222222222222222')
+    assert events[10].rowcount == 3
+    assert events[14].error.sqlstate == '42601'
+    assert events[17].tag == 'SET' and events[17].rowcount == -1
+    assert machine.server_parameters == {
+        'server_version': '16.0', 'client_encoding': 'UTF8', 'application_name': 'bench'
+    }
+    assert machine.backend_pid is not None
+    assert list(machine.notices)[0]['M'] == 'careful'
+
+
+def test_notices_and_parameters(fake_server):
+    # Notice Response and Parameter Status don't get in the way of the results
+    conn = connect(fake_server.params)
+    cursor = conn.cursor()
+    cursor.execute("select rows=4 notice=careful;")
+    assert len(cursor.fetchall()) == 4
+    assert conn.handle.protocol.notices[-1]['S'] == 'WARNING'
+
+    pg.execute(conn.handle, "set application_name = 'bench';")
+    assert pg.get_data(pg.fetch_events(conn.handle)) == ([], [])
+    assert conn.handle.server_parameters['application_name'] == 'bench'
+
+    cursor.execute("select rows=2 notice=again;")
+    assert cursor.fetchone() == (0, '0000000000000000')
+    conn.close()
+
+
+def test_nextset(fake_server):
+    query = "select rows=3; insert rows=7; select rows=2 columns=1; select rows=4;"
+    conn = connect(fake_server.params)
+    for lazy_rows in (False, True):
+        cursor = conn.cursor(lazy_rows=lazy_rows)
+        cursor.execute(query)
+        assert len(cursor.fetchall()) == 3
+        assert cursor.nextset()
+        assert cursor.description is None and cursor.rowcount == 7
+        assert cursor.fetchall() == []
+        assert cursor.nextset()
+        assert cursor.columns == ['column_0']
+        assert cursor.fetchone() == (0,)
+        # the rest of the set is skipped
+        assert cursor.nextset()
+        assert len(cursor.fetchall()) == 4
+        assert cursor.nextset() is None
+        assert conn.handle.pending_results == 0
+        assert cursor.nextset() is None
+
+    # an error in a later statement
+    cursor.execute("select rows=2; error; select rows=5;")
+    assert len(cursor.fetchall()) == 2
+    with pytest.raises(DatabaseError):
+        cursor.nextset()
+    assert conn.handle.pending_results == 0
+
+    # only the first set of each query in a pipeline
+    pipeline = conn.pipeline()
+    pipeline.execute("select rows=1; select rows=2;")
+    pipeline.execute("select rows=3;")
+    assert [len(rows) for rows in pipeline.sync()] == [1, 3]
+
+    # the next query isn't affected by the sets that weren't read
+    cursor.execute("select rows=2; select rows=3;")
+    cursor.execute("select rows=6;")
+    assert len(cursor.fetchall()) == 6
+    conn.close()
+
+
+def test_nextset_async(fake_server):
+    async def run():
+        conn = await async_pep_249.connect(fake_server.params)
+        cursor = conn.cursor()
+        await cursor.execute("select rows=3; insert rows=7; select rows=2;")
+        assert await cursor.fetchone() == (0, '0000000000000000')
+        assert await cursor.nextset()
+        assert cursor.rowcount == 7 and await cursor.fetchall() == []
+        assert await cursor.nextset()
+        assert len(await cursor.fetchall()) == 2 and cursor.rowcount == 2
+        assert await cursor.nextset() is None
+        await cursor.execute("select rows=4;")
+        assert cursor.rowcount == -1
+        assert len(await cursor.fetchall()) == 4 and cursor.rowcount == 4
+
+        await cursor.execute("select rows=5;")
+        assert await cursor.fetchmany() == [(0, '0000000000000000')]
+        assert len(await cursor.fetchmany(3)) == 3 and cursor.rowcount == -1
+        assert await cursor.fetchmany(3) == [(4, '4444444444444444')] and cursor.rowcount == 5
+        assert await cursor.fetchmany(3) == []
+        await conn.close()
+    asyncio.run(run())
+
+
+def test_more_results(fake_server):
+    query = "select rows=3; insert rows=7; select rows=2 columns=1;"
+    handle = odbc.ConnectionHandle()
+    server_name = f"{fake_server.params['host']}:{fake_server.params['port']}"
+    odbc.SQLConnect(handle, server_name, len(server_name), 'postgres', 8, 'none', 4)
+    odbc.SQLExecDirect(handle, query, len(query))
+    columns, rows = odbc.SQLGetData(odbc.SQLFetch(handle))
+    assert len(rows) == 3
+    # the set has been read
+    assert odbc.SQLFetch(handle).code_name == "SQL_NO_DATA"
+    assert odbc.SQLMoreResults(handle).code_name == "SQL_SUCCESS"
+    assert odbc.SQLNumResultCols(handle) == 0
+    assert odbc.SQLRowCount(handle) == 7
+    assert odbc.SQLMoreResults(handle).code_name == "SQL_SUCCESS"
+    assert odbc.SQLDescribeCol(handle, 1).name == 'column_0'
+    assert odbc.SQLGetData(odbc.SQLFetch(handle))[1] == [('0',), ('1',)]
+    assert odbc.SQLMoreResults(handle).code_name == "SQL_NO_DATA"
+    assert handle.pending_results == 0
+    odbc.SQLDisconnect(handle)
+
+    conn = odbc_manager.connect(fake_server.params)
+    cursor = conn.cursor()
+    cursor.execute(query)
+    assert cursor.fetchone() == ('0', '0000000000000000')
+    assert cursor.nextset()
+    assert cursor.rowcount == 7 and cursor.fetchall() == []
+    assert cursor.nextset()
+    assert cursor.columns == ['column_0']
+    assert cursor.fetchall() == [('0',), ('1',)]
+    assert cursor.nextset() is None
+    conn.close()
+
+
+def test_unix_socket(tmp_path):
+    with FakePostgresServer(host=str(tmp_path), port=5433) as server:
+        assert (tmp_path / ".s.PGSQL.5433").exists()
+        conn = connect({**server.params, 'connect_timeout': 5, 'receive_buffer_size': 1 << 20})
+        assert conn.handle.sock.family == socket.AF_UNIX
+        cursor = conn.cursor()
+        cursor.execute("select rows=5;")
+        assert len(cursor.fetchall()) == 5
+        conn.close()
+
+
+def test_socket_options(fake_server):
+    conn = connect({**fake_server.params, 'keepalives': 1, 'keepalives_idle': 30, 'tcp_nodelay': 'off'})
+    sock = conn.handle.sock
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 1
+    assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) == 0
+    assert conn.handle.socket_options.keepalive_idle == 30
+    cursor = conn.cursor()
+    cursor.execute("select rows=3;")
+    assert len(cursor.fetchall()) == 3
+    conn.close()
+
+
+def test_parallel_decode(fake_server):
+    conn = connect(fake_server.params)
+    query = "select rows=20000 columns=3 nulls=0.1 types=int4,text,float8;"
+    with ParallelDecoder(workers=2, batch_bytes=64 * 1024) as decoder:
+        for binary in (False, True):
+            cursor = conn.cursor(binary=binary)
+            cursor.execute(query)
+            expected = cursor.fetch_columns()
+            cursor.execute(query)
+            assert cursor.fetch_columns(decoder=decoder) == expected
+
+        # rows already read with fetchone, and a portal
+        cursor = conn.cursor(portal_rows=5000)
+        cursor.execute(query)
+        assert cursor.fetchone()[0] == 0
+        columns = cursor.fetch_columns(decoder=decoder)
+        assert columns[0].values == expected[0].values[1:]
+        assert columns[1].values == expected[1].values[1:]
+
+        with pytest.raises(DatabaseError):
+            cursor.execute("error")
+            cursor.fetch_columns(decoder=decoder)
+    conn.close()
+
+
+def test_export_columnar(fake_server, tmp_path):
+    conn = connect(fake_server.params)
+    query = "select rows=10003 columns=3 nulls=0.1 types=int4,text,float8;"
+    path = str(tmp_path / "results.cols")
+    for binary in (False, True):
+        cursor = conn.cursor(binary=binary)
+        cursor.execute(query)
+        expected = cursor.fetch_columns()
+        cursor.execute(query)
+        assert cursor.export_columnar(path, batch_rows=999) == 10003
+
+        with ColumnarFile(path) as file:
+            assert file.columns == cursor.columns
+            assert len(file) == 10003
+            ids = file.values(0)
+            assert ids.format == 'i'
+            assert ids.tolist() == expected[0].values.tolist()
+            del ids
+            for index, column in enumerate(expected):
+                assert file.column_data(index) == column
+
+    # rows already read with fetchone, and a portal
+    cursor = conn.cursor(portal_rows=3000)
+    cursor.execute(query)
+    assert cursor.fetchone()[0] == 0
+    assert cursor.export_columnar(path) == 10002
+    with ColumnarFile(path) as file:
+        assert file.values(1)[0] == expected[1].values[1]
+        assert file.values(1)[:] == expected[1].values[1:]
+
+    with pytest.raises(DatabaseError):
+        cursor.execute("error")
+        cursor.export_columnar(str(tmp_path / "error.cols"))
+    assert not (tmp_path / "error.cols").exists()
+    conn.close()
+
+
+def test_lazy_rows(fake_server):
+    conn = connect(fake_server.params)
+    query = "select rows=2000 columns=4 nulls=0.1 types=int4,text,float8,bool;"
+    for binary in (False, True):
+        cursor = conn.cursor(binary=binary)
+        cursor.execute(query)
+        expected = cursor.fetchall()
+
+        cursor = conn.cursor(binary=binary, portal_rows=500, lazy_rows=True)
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        assert all(isinstance(row, LazyRow) for row in rows)
+        assert rows == expected
+
+        row = rows[7]
+        assert row.column_2 == row['column_2'] == row[2] == row[-2] == expected[7][2]
+        assert row[1:3] == expected[7][1:3]
+        assert tuple(row) == expected[7]
+        assert row._asdict() == dict(zip(cursor.columns, expected[7]))
+        with pytest.raises(AttributeError):
+            row.missing
+        # rows from the result cache are pickled
+        assert pickle.loads(pickle.dumps(row)) == row
+        assert pickle.loads(pickle.dumps(row)).column_1 == expected[7][1]
+    conn.close()
+
+
+def test_statement_timeout(fake_server):
+    conn = connect(fake_server.params)
+    assert conn.handle.backend_pid is not None
+    cursor = conn.cursor()
+
+    with pytest.raises(pg.StatementTimeout):
+        cursor.execute("select rows=5 sleep=30;", timeout=0.2)
+        cursor.fetchall()
+    # canceled and drained, the connection can be used again
+    assert conn.handle.pending_results == 0
+    cursor.execute("select rows=5;")
+    assert len(cursor.fetchall()) == 5
+
+    cursor.timeout = 5
+    cursor.execute("select rows=5 sleep=0.1;")
+    assert len(cursor.fetchall()) == 5
+
+    # cancel from another thread
+    cursor.timeout = None
+    threading.Timer(0.2, conn.cancel).start()
+    with pytest.raises(DatabaseError) as error:
+        cursor.execute("select rows=5 sleep=30;")
+        cursor.fetchall()
+    assert error.value.sqlstate == '57014'
+    cursor.execute("select rows=2;")
+    assert len(cursor.fetchall()) == 2
+    conn.close()
+
+
+def test_odbc_parameter_arrays(fake_server):
+    conn = connect(fake_server.params)
+    handle = conn.handle
+    paramset_size = 5000 # several batches
+    ids = array('i', range(paramset_size))
+    param_status = array('H', [0] * paramset_size)
+    params_processed = [0]
+
+    def execute(query: str, size: int) -> odbc.ReturnCode:
+        statement = odbc.SQLAllocHandle(odbc.SQL_HANDLE_STMT, handle)
+        assert odbc.SQLPrepare(statement, query, len(query)).code_name == "SQL_SUCCESS"
+        odbc.SQLSetStmtAttr(statement, odbc.SQL_ATTR_PARAMSET_SIZE, size)
+        odbc.SQLSetStmtAttr(statement, odbc.SQL_ATTR_PARAM_STATUS_PTR, param_status)
+        odbc.SQLSetStmtAttr(statement, odbc.SQL_ATTR_PARAMS_PROCESSED_PTR, params_processed)
+        odbc.SQLBindParameter(statement, 1, odbc.SQL_PARAM_INPUT, odbc.SQL_C_SLONG, 0, 0, 0, ids)
+        return odbc.SQLExecute(statement), odbc.SQLRowCount(statement)
+
+    assert execute("select rows=1 ?", paramset_size) == (odbc.ReturnCode("SQL_SUCCESS"), paramset_size)
+    assert params_processed == [paramset_size] and set(param_status) == {odbc.SQL_PARAM_SUCCESS}
+
+    return_code, rowcount = execute("error ?", 3)
+    assert return_code.code_name == "SQL_ERROR" and return_code.value == '42601' and rowcount == 0
+    assert params_processed == [1]
+    assert list(param_status[:3]) == [odbc.SQL_PARAM_ERROR, odbc.SQL_PARAM_UNUSED, odbc.SQL_PARAM_UNUSED]
+    assert handle.pending_results == 0 and not handle.portal_open
+
+    # SQLGetData keeps the server's SQLSTATE
+    odbc.SQLExecDirect(handle, "error", 5)
+    assert odbc.SQLGetData(odbc.SQLFetch(handle)).value == '42601'
+    conn.close()
+
+
+def test_stale_cached_statement(fake_server):
+    # queries without parameters are prepared the second time they run
+    conn = connect(fake_server.params)
+    cursor = conn.cursor()
+    for _ in range(2):
+        cursor.execute("select rows=2;")
+        assert len(cursor.fetchall()) == 2
+    assert "select rows=2;" in conn.statement_cache
+
+    # the other connection doesn't have the cached statement (26000),
+    # it's prepared again and the query runs
+    other = connect(fake_server.params)
+    for lazy_rows in (False, True):
+        for handle in (other.handle, conn.handle):
+            # the statement was last prepared on the other connection
+            shared = Cursor(handle, statement_cache=conn.statement_cache, lazy_rows=lazy_rows)
+            shared.execute("select rows=2;")
+            assert len(shared.fetchall()) == 2
+    shared = Cursor(other.handle, statement_cache=conn.statement_cache)
+    shared.execute("select rows=2;")
+    assert len(shared.fetch_columns()[0].values) == 2
+
+    # once it's stale for the pipeline, it's prepared again next time
+    cursor.execute("select rows=3;")
+    cursor.execute("select rows=3;")
+    cursor.fetchall()
+    pipeline = other.pipeline()
+    pipeline.statement_cache = conn.statement_cache
+    pipeline.execute("select rows=3;")
+    assert isinstance(pipeline.sync()[0], DatabaseError)
+    pipeline.execute("select rows=3;")
+    assert len(pipeline.sync()[0]) == 3
+    conn.close()
+    other.close()
+
+    async def run():
+        first = await async_pep_249.connect(fake_server.params)
+        second = await async_pep_249.connect(fake_server.params)
+        for _ in range(2):
+            for handle in (first.handle, second.handle):
+                shared = async_pep_249.AsyncCursor(handle, statement_cache=first.statement_cache)
+                await shared.execute("select rows=2;")
+                assert len(await shared.fetchall()) == 2
+        await first.close()
+        await second.close()
+    asyncio.run(run())
+
+
+def test_result_reader(fake_server):
+    # every way of reading results ends them the same way, see pg_machine.ResultReader
+    conn = connect(fake_server.params)
+    handle = conn.handle
+
+    # an error in an open portal, the Sync it waits for is sent while reading the error
+    cursor = conn.cursor(portal_rows=2)
+    cursor.execute("error")
+    with pytest.raises(DatabaseError):
+        cursor.fetchall()
+    assert handle.pending_results == 0 and not handle.portal_open
+    cursor.execute("select rows=3;")
+    assert len(cursor.fetchall()) == 3
+
+    pg.execute(handle, "select rows=2;")
+    description = []
+    assert pg.get_row(pg.fetch_events(handle), description) == (['column_0', 'column_1'], ('0', '0000000000000000'))
+    assert pg.get_row(pg.fetch_events(handle), description) == ([], ('1', '1111111111111111'))
+    assert pg.get_row(pg.fetch_events(handle), description) == (None, None)
+    pg.drain(handle)
+
+    # bound columns, a rowset at a time
+    statement = odbc.SQLAllocHandle(odbc.SQL_HANDLE_STMT, handle)
+    query = "error"
+    assert odbc.SQLPrepare(statement, query, len(query)).code_name == "SQL_SUCCESS"
+    assert odbc.SQLExecute(statement).value == '42601'
+    assert handle.pending_results == 0
+    query = "select rows=10 ?"
+    assert odbc.SQLPrepare(statement, query, len(query)).code_name == "SQL_SUCCESS"
+    odbc.SQLBindParameter(statement, 1, odbc.SQL_PARAM_INPUT, odbc.SQL_C_SLONG, 0, 0, 0, array('i', [1]))
+    values = array('i', [0] * 4)
+    rows_fetched = [0]
+    odbc.SQLSetStmtAttr(statement, odbc.SQL_ATTR_ROW_ARRAY_SIZE, 4)
+    odbc.SQLSetStmtAttr(statement, odbc.SQL_ATTR_ROWS_FETCHED_PTR, rows_fetched)
+    odbc.SQLBindCol(statement, 1, odbc.SQL_C_SLONG, values)
+    assert odbc.SQLExecute(statement).code_name == "SQL_SUCCESS"
+    fetched = []
+    while odbc.SQLFetch(statement).code_name == "SQL_SUCCESS":
+        fetched.extend(values[:rows_fetched[0]])
+    assert fetched == list(range(10))
+    assert odbc.SQLRowCount(statement) == 10
+    conn.close()
+
+
+def test_type_catalog_async(fake_server, tmp_path):
+    # the async cursor decodes with the handle's type catalog, like the sync one
+    path = str(tmp_path / "types.json")
+    conn = connect(fake_server.params)
+    pg.save_type_catalog(conn.handle, fake_server.params, [
+        (str(POSINT_OID), 'posint', 'd', 'N', '0', ',', str(pg_types.INT4_OID), None),
+    ], path)
+    conn.close()
+    pg.reset_type_catalogs()
+    query = "select rows=3 columns=1 types=posint;"
+    expected = {False: [('0',), ('1',), ('2',)], True: [(0,), (1,), (2,)]}
+
+    def sync_rows(type_catalog_path, binary):
+        conn = connect(fake_server.params, type_catalog_path=type_catalog_path)
+        cursor = conn.cursor(binary=binary)
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    async def async_rows(type_catalog_path, binary):
+        conn = await async_pep_249.connect(fake_server.params, type_catalog_path=type_catalog_path)
+        cursor = conn.cursor(binary=binary)
+        await cursor.execute(query)
+        rows = [await cursor.fetchone()] + await cursor.fetchmany(1) + await cursor.fetchall()
+        await conn.close()
+        return rows
+
+    try:
+        for binary in (False, True):
+            assert sync_rows(path, binary) == asyncio.run(async_rows(path, binary)) == expected[True]
+        assert sync_rows(None, False) == asyncio.run(async_rows(None, False)) == expected[False]
+    finally:
+        pg.reset_type_catalogs(path)
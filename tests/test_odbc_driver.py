@@ -5,8 +5,38 @@ from db_utils import (
     SQLExecDirect, 
     SQLFetch, 
     SQLGetData, 
+    SQLBindCol,
+    SQLSetStmtAttr,
+    SQLFetchScroll,
+    SQLAllocHandle,
+    SQLFreeHandle,
+    SQLPrepare,
+    SQLBindParameter,
+    SQLExecute,
+    SQLRowCount,
     SQLDisconnect
 )
+from db_utils.odbc_driver import (
+    SQL_ATTR_PARAM_STATUS_PTR,
+    SQL_ATTR_PARAMS_PROCESSED_PTR,
+    SQL_ATTR_PARAMSET_SIZE,
+    SQL_ATTR_ROW_ARRAY_SIZE,
+    SQL_ATTR_ROW_STATUS_PTR,
+    SQL_ATTR_ROWS_FETCHED_PTR,
+    SQL_C_CHAR,
+    SQL_C_SLONG,
+    SQL_FETCH_NEXT,
+    SQL_HANDLE_STMT,
+    SQL_NTS,
+    SQL_NULL_DATA,
+    SQL_PARAM_ERROR,
+    SQL_PARAM_INPUT,
+    SQL_PARAM_SUCCESS,
+    SQL_PARAM_UNUSED,
+    SQL_ROW_NOROW,
+    SQL_ROW_SUCCESS,
+)
+from array import array
 import logging
 logging.basicConfig()
 logging.getLogger().setLevel(logging.DEBUG)
@@ -52,3 +82,76 @@ def test_get_results(establish_connection, test_query_execution):
     assert len(rows) == 5
     assert len(columns) == 3
 
+
+
+def test_bound_columns(test_query_execution):
+    SQLGetData(SQLFetch(test_query_execution))
+
+    row_array_size = 4
+    values = array('i', [0] * row_array_size)
+    indicators = array('q', [0] * row_array_size)
+    row_status = array('H', [0] * row_array_size)
+    rows_fetched = [0]
+    SQLSetStmtAttr(test_query_execution, SQL_ATTR_ROW_ARRAY_SIZE, row_array_size)
+    SQLSetStmtAttr(test_query_execution, SQL_ATTR_ROW_STATUS_PTR, row_status)
+    SQLSetStmtAttr(test_query_execution, SQL_ATTR_ROWS_FETCHED_PTR, rows_fetched)
+
+    query = "select nullif(value, 2) from generate_series(1, 6) as value;"
+    SQLExecDirect(test_query_execution, query, len(query))
+    SQLBindCol(test_query_execution, 1, SQL_C_SLONG, values, 0, indicators)
+
+    assert SQLFetchScroll(test_query_execution, SQL_FETCH_NEXT).code_name == "SQL_SUCCESS"
+    assert rows_fetched == [4]
+    assert values[0] == 1 and values[2:4] == array('i', [3, 4])
+    assert indicators[1] == SQL_NULL_DATA
+
+    assert SQLFetch(test_query_execution).code_name == "SQL_SUCCESS"
+    assert rows_fetched == [2]
+    assert values[0:2] == array('i', [5, 6])
+    assert list(row_status) == [SQL_ROW_SUCCESS, SQL_ROW_SUCCESS, SQL_ROW_NOROW, SQL_ROW_NOROW]
+
+    assert SQLFetch(test_query_execution).code_name == "SQL_NO_DATA"
+    SQLBindCol(test_query_execution, 1, SQL_C_SLONG, None)
+
+
+def test_parameter_arrays(test_query_execution):
+    SQLGetData(SQLFetch(test_query_execution))
+
+    query = "create temporary table odbc_bulk (id int primary key, name text);"
+    SQLExecDirect(test_query_execution, query, len(query))
+    SQLGetData(SQLFetch(test_query_execution))
+
+    statement = SQLAllocHandle(SQL_HANDLE_STMT, test_query_execution)
+    query = "insert into odbc_bulk values (?, ?);"
+    assert SQLPrepare(statement, query, len(query)).code_name == "SQL_SUCCESS"
+
+    paramset_size = 1000
+    ids = array('i', range(paramset_size))
+    names = bytearray(b''.join(f"name {i}".encode('utf-8').ljust(16, b'\x00') for i in range(paramset_size)))
+    indicators = array('q', [SQL_NTS] * paramset_size)
+    indicators[10] = SQL_NULL_DATA
+    param_status = array('H', [0] * paramset_size)
+    params_processed = [0]
+    SQLSetStmtAttr(statement, SQL_ATTR_PARAMSET_SIZE, paramset_size)
+    SQLSetStmtAttr(statement, SQL_ATTR_PARAM_STATUS_PTR, param_status)
+    SQLSetStmtAttr(statement, SQL_ATTR_PARAMS_PROCESSED_PTR, params_processed)
+    SQLBindParameter(statement, 1, SQL_PARAM_INPUT, SQL_C_SLONG, 0, 0, 0, ids)
+    SQLBindParameter(statement, 2, SQL_PARAM_INPUT, SQL_C_CHAR, 0, 16, 0, names, 16, indicators)
+
+    assert SQLExecute(statement).code_name == "SQL_SUCCESS"
+    assert params_processed == [paramset_size]
+    assert set(param_status) == {SQL_PARAM_SUCCESS}
+    assert SQLRowCount(statement) == paramset_size
+
+    # duplicate key on the third parameter set, the batch is rolled back
+    ids[0:4] = array('i', [1000, 1001, 1000, 1003])
+    SQLSetStmtAttr(statement, SQL_ATTR_PARAMSET_SIZE, 4)
+    assert SQLExecute(statement).code_name == "SQL_ERROR"
+    assert list(param_status[:4]) == [SQL_PARAM_UNUSED, SQL_PARAM_UNUSED, SQL_PARAM_ERROR, SQL_PARAM_UNUSED]
+    assert params_processed == [3]
+    SQLFreeHandle(SQL_HANDLE_STMT, statement)
+
+    query = "select count(*), count(name) from odbc_bulk;"
+    SQLExecDirect(test_query_execution, query, len(query))
+    columns, rows = SQLGetData(SQLFetch(test_query_execution))
+    assert rows == [('1000', '999')]
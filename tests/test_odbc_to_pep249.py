@@ -36,3 +36,18 @@ def test_get_results(test_query_execution):
     rows = test_query_execution.fetchall()
     assert len(rows) == 5
 
+
+
+def test_streaming_fetch(test_query_execution):
+    test_query_execution.fetchall()
+
+    test_query_execution.arraysize = 3
+    query = "select value, nullif(value % 4, 0) from generate_series(1, 10) as value;"
+    test_query_execution.execute(query)
+
+    assert test_query_execution.fetchone() == ('1', '1')
+    assert test_query_execution.fetchmany(4) == [('2', '2'), ('3', '3'), ('4', None), ('5', '1')]
+    assert test_query_execution.columns == ['value', 'nullif']
+    assert [row[0] for row in test_query_execution] == ['6', '7', '8', '9', '10']
+    assert test_query_execution.fetchone() is None
+    test_query_execution.arraysize = 100
@@ -0,0 +1,41 @@
+from db_utils.pool import ConnectionPool, PoolTimeout
+import pytest
+
+
+@pytest.fixture(scope='module', autouse=True)
+def get_pool(start_postgres, wait_for_postgres):
+
+    parameters = {
+        'host': 'localhost',
+        'port': 5432,
+        'user': 'postgres',
+        'database': 'postgres',
+    }
+
+    pool = ConnectionPool(parameters, min_size=1, max_size=2, timeout=1)
+
+    yield pool
+    pool.close()
+
+
+def test_get_results(get_pool):
+
+    with get_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("select table_name from information_schema.tables limit 5;")
+        rows = cursor.fetchall()
+
+    assert len(rows) == 5
+    stats = get_pool.get_stats()
+    assert stats['checkouts'] >= 1
+    assert stats['in_use'] == 0
+
+
+def test_timeout(get_pool):
+
+    connections = [get_pool.getconn() for _ in range(2)]
+    with pytest.raises(PoolTimeout):
+        get_pool.getconn(timeout=0.1)
+
+    for conn in connections:
+        get_pool.putconn(conn)
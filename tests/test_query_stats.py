@@ -0,0 +1,13 @@
+from db_utils.query_stats import fingerprint
+
+
+def test_fingerprint():
+    assert fingerprint("select generate_series(1, 3) as a;") == "select generate_series(?, ?) as a"
+    assert fingerprint(
+        "select * from t where id = 1 and name in ('a', 'b', 'c');"
+    ) == "select * from t where id = ? and name in (?)"
+    assert fingerprint("select * from t where id IN ($1, $2)") == "select * from t where id IN (?)"
+    assert fingerprint(
+        "insert into t values (1, 'a'), (2, 'b'), (3, 'c');"
+    ) == fingerprint("insert into t values (4, 'd');") == "insert into t values (?)"
+    assert fingerprint("select coalesce(a, 0), round(b, 2) from t -- comment") == "select coalesce(a, ?), round(b, ?) from t"